@@ -0,0 +1,329 @@
+import asyncio
+import math
+import os
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from dataclasses import asdict, dataclass, field
+from typing import AsyncIterator
+
+from starlette.responses import JSONResponse, Response
+from starlette.types import Receive, Scope, Send
+
+
+class Rejected(Exception):
+    """Raised by AdmissionController.acquire() when a request is turned away: 429 when the wait queue is full, 503 when the request
+    waited in the queue for longer than the queue timeout.
+    """
+
+    def __init__(self, status_code: int, reason: str, retry_after: int):
+        super().__init__(reason)
+        self.status_code = status_code
+        self.reason = reason
+        self.retry_after = retry_after
+
+    def response(self) -> JSONResponse:
+        return JSONResponse(status_code=self.status_code, content=self.reason, headers={"Retry-After": str(self.retry_after)})
+
+
+@dataclass
+class AdmissionStats:
+    max_concurrent: int
+    max_queue: int
+    active: int
+    queued: int
+    queued_peak: int
+    admitted: int
+    rejected_full: int
+    rejected_timeout: int
+    mean_wait_ms: float
+    mean_service_ms: float
+
+
+# the user of the requests that do not say who sent them
+ANONYMOUS = "anonymous"
+
+
+@dataclass
+class UserStats:
+    weight: int
+    active: int = 0
+    queued: int = 0
+    admitted: int = 0
+    rejected: int = 0
+    mean_wait_ms: float = 0.0
+    max_wait_ms: float = 0.0
+    mean_service_ms: float = 0.0
+
+
+@dataclass
+class _User:
+    weight: int
+    active: int = 0
+    waiters: deque["asyncio.Future[None]"] = field(default_factory=deque)
+    admitted: int = 0
+    rejected: int = 0
+    wait_total: float = 0.0
+    wait_max: float = 0.0
+    service_ewma: float = 0.0
+
+
+class AdmissionController:
+    """Bounds the number of chat requests running at once, and shares the slots fairly between the users sending them.
+    At most max_concurrent requests run, at most max_per_user of them for the same user; up to max_queue more wait, at most max_user_queue of
+    them for the same user, for at most queue_timeout seconds. A request finding the queue full is rejected at once. The waiters of a user
+    are served in FIFO order; a freed slot goes to the users having waiters in weighted round-robin, a user of weight n getting up to n slots
+    in its turn, so that a user sending many requests does not make the others wait behind all of them. The Retry-After of the rejections is
+    estimated from the mean time a request holds its slot.
+    The controller lives on the event loop: acquire() and release() must be called from it.
+    """
+
+    def __init__(
+        self,
+        max_concurrent: int,
+        max_queue: int,
+        queue_timeout: float,
+        max_per_user: int | None = None,
+        max_user_queue: int | None = None,
+        weights: dict[str, int] | None = None,
+    ):
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.max_per_user = max_per_user or max_concurrent
+        self.max_user_queue = max_user_queue if max_user_queue is not None else max_queue
+        self.weights = weights or {}
+        self._active = 0
+        self._queued = 0
+        self._users: dict[str, _User] = {}
+        # users with waiters, in the order of their turns; the first one is being served, _turn_grants slots so far
+        self._ring: deque[str] = deque()
+        self._turn_grants = 0
+        self._queued_peak = 0
+        self._admitted = 0
+        self._rejected_full = 0
+        self._rejected_timeout = 0
+        self._wait_total = 0.0
+        # exponentially weighted mean of the time a request keeps its slot, seeded with a guess at a typical chat exchange
+        self._service_ewma = 10.0
+
+    def _user(self, user: str) -> _User:
+        if (state := self._users.get(user)) is None:
+            state = self._users[user] = _User(max(1, self.weights.get(user, 1)))
+        return state
+
+    async def acquire(self, user: str = ANONYMOUS) -> None:
+        state = self._user(user)
+        # a free slot with nobody eligible waiting for it (release() hands slots over at once) goes to the request straight away
+        if self._active < self.max_concurrent and state.active < self.max_per_user and not state.waiters:
+            self._grant(state)
+            self._admitted += 1
+            state.admitted += 1
+            return
+        if self._queued >= self.max_queue or len(state.waiters) >= self.max_user_queue:
+            self._rejected_full += 1
+            state.rejected += 1
+            if self._queued >= self.max_queue:
+                raise Rejected(429, "Too many chat requests, try again later", self._retry_after(state))
+            raise Rejected(429, "Too many chat requests of yours are waiting, try again later", self._retry_after(state))
+
+        waiter: asyncio.Future[None] = asyncio.get_running_loop().create_future()
+        state.waiters.append(waiter)
+        self._queued += 1
+        if user not in self._ring:
+            self._ring.append(user)
+        self._queued_peak = max(self._queued_peak, self._queued)
+        start = time.monotonic()
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter), self.queue_timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            if waiter.done() and not waiter.cancelled():
+                # the slot was handed over just as the wait ended; pass it on
+                self.release(held=0.0, user=user)
+            else:
+                waiter.cancel()
+                state.waiters.remove(waiter)
+                self._queued -= 1
+                if not state.waiters:
+                    self._leave_ring(user)
+            if isinstance(e, asyncio.CancelledError):
+                raise
+            self._rejected_timeout += 1
+            state.rejected += 1
+            raise Rejected(503, "The service is overloaded, try again later", self._retry_after(state))
+        waited = time.monotonic() - start
+        self._wait_total += waited
+        self._admitted += 1
+        state.wait_total += waited
+        state.wait_max = max(state.wait_max, waited)
+        state.admitted += 1
+
+    def release(self, held: float | None = None, user: str = ANONYMOUS) -> None:
+        """Frees the slot of a request of user and hands the free slots to the waiters whose turn it is. held is the time the slot was
+        kept, in seconds, for the Retry-After estimate and the statistics.
+        """
+        state = self._user(user)
+        if held:
+            self._service_ewma = 0.8 * self._service_ewma + 0.2 * held
+            state.service_ewma = 0.8 * state.service_ewma + 0.2 * held if state.service_ewma else held
+        self._active -= 1
+        state.active -= 1
+        self._dispatch()
+
+    def _grant(self, state: _User) -> None:
+        self._active += 1
+        state.active += 1
+
+    def _dispatch(self) -> None:
+        while self._active < self.max_concurrent and (user := self._next_user()) is not None:
+            state = self._users[user]
+            waiter = state.waiters.popleft()
+            self._queued -= 1
+            if not state.waiters:
+                self._leave_ring(user)
+            self._grant(state)
+            waiter.set_result(None)
+
+    def _next_user(self) -> str | None:
+        """Weighted round-robin: the user whose turn it is keeps it for up to its weight in slots, as long as it is under its quota."""
+        # one look more than there are users: the first may only find that the current turn is used up
+        for _ in range(len(self._ring) + 1 if self._ring else 0):
+            state = self._users[self._ring[0]]
+            if state.active < self.max_per_user and self._turn_grants < state.weight:
+                self._turn_grants += 1
+                return self._ring[0]
+            self._ring.rotate(-1)
+            self._turn_grants = 0
+        return None
+
+    def _leave_ring(self, user: str) -> None:
+        if self._ring and self._ring[0] == user:
+            self._turn_grants = 0
+        self._ring.remove(user)
+
+    def _retry_after(self, state: _User) -> int:
+        # time for the requests ahead to drain through the available slots: all of them, or those of the user when its quota is the bound
+        slots = max(1, self.max_concurrent)
+        ahead = self._queued
+        if self.max_per_user < self.max_concurrent and len(state.waiters) * slots > self._queued * self.max_per_user:
+            slots, ahead = max(1, self.max_per_user), len(state.waiters)
+        return max(1, math.ceil(self._service_ewma * (ahead + 1) / slots))
+
+    def stats(self) -> AdmissionStats:
+        return AdmissionStats(
+            max_concurrent=self.max_concurrent,
+            max_queue=self.max_queue,
+            active=self._active,
+            queued=self._queued,
+            queued_peak=self._queued_peak,
+            admitted=self._admitted,
+            rejected_full=self._rejected_full,
+            rejected_timeout=self._rejected_timeout,
+            mean_wait_ms=round(1000.0 * self._wait_total / self._admitted, 3) if self._admitted else 0.0,
+            mean_service_ms=round(1000.0 * self._service_ewma, 3),
+        )
+
+    def as_dict(self) -> dict[str, int | float]:
+        return asdict(self.stats())
+
+    def user_stats(self) -> dict[str, UserStats]:
+        return {
+            user: UserStats(
+                weight=state.weight,
+                active=state.active,
+                queued=len(state.waiters),
+                admitted=state.admitted,
+                rejected=state.rejected,
+                mean_wait_ms=round(1000.0 * state.wait_total / state.admitted, 3) if state.admitted else 0.0,
+                max_wait_ms=round(1000.0 * state.wait_max, 3),
+                mean_service_ms=round(1000.0 * state.service_ewma, 3),
+            )
+            for user, state in self._users.items()
+        }
+
+    def users_as_dict(self) -> dict[str, dict[str, int | float]]:
+        return {user: asdict(stats) for user, stats in self.user_stats().items()}
+
+
+class AdmittedResponse(Response):
+    """Wraps the response of an admitted request and releases its slot once the response is over, whether it completed, failed or the
+    client went away. Streaming responses thus hold the slot for as long as the answer is being produced.
+    """
+
+    def __init__(self, response: Response, controller: AdmissionController, user: str = ANONYMOUS):
+        self.response = response
+        self.controller = controller
+        self.user = user
+        self.status_code = response.status_code
+        self.raw_headers = response.raw_headers
+        self.background = None
+        self._start = time.monotonic()
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        try:
+            await self.response(scope, receive, send)
+        finally:
+            self.controller.release(time.monotonic() - self._start, self.user)
+
+
+class BatchSlots:
+    """The chat slots of the questions of a batch, one per question running. The batch is admitted like any request, and the slot of its
+    AdmittedResponse serves one question at a time; every other question running alongside takes a slot of its own as it starts and gives
+    it back as it ends, so that a batch counts against max_concurrent and the quota of its user as the questions it runs at once.
+    """
+
+    def __init__(self, controller: AdmissionController, user: str = ANONYMOUS):
+        self.controller = controller
+        self.user = user
+        self._admitted_free = True
+
+    @asynccontextmanager
+    async def __call__(self) -> AsyncIterator[None]:
+        if self._admitted_free:
+            self._admitted_free = False
+            try:
+                yield
+            finally:
+                self._admitted_free = True
+            return
+        await self.controller.acquire(self.user)
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.controller.release(time.monotonic() - start, self.user)
+
+
+def parse_weights(spec: str) -> dict[str, int]:
+    """Parses "code=2,other=3" into the weights of the users; a user not listed has weight 1."""
+    weights: dict[str, int] = {}
+    for item in spec.split(","):
+        if item.strip():
+            user, _, weight = item.partition("=")
+            weights[user.strip()] = int(weight)
+    return weights
+
+
+def per_worker(limit: int, workers: int) -> int:
+    """The share of a server-wide limit enforced by each of workers processes, rounded up."""
+    return math.ceil(limit / max(1, workers))
+
+
+def create_admission_controller() -> AdmissionController:
+    """Builds the controller from the environment: CHAT_MAX_CONCURRENT (default 8) requests run, CHAT_MAX_QUEUE (default 32) wait, for
+    at most CHAT_QUEUE_TIMEOUT (default 10) seconds. CHAT_USER_WEIGHTS ("code=2,other=3") gives some users a larger share of the slots.
+
+    Every worker process of serve.py has a controller of its own and the requests of a user are spread over all of them: the limits
+    above hold for each worker, while the per user quotas CHAT_USER_MAX_CONCURRENT (default 4) and CHAT_USER_MAX_QUEUE (default 16) are
+    meant for the whole server and divided between the WEB_CONCURRENCY workers. A user may thus be turned away by one worker while
+    another would still take the request.
+    """
+    workers = int(os.getenv('WEB_CONCURRENCY', '1') or '1')
+    return AdmissionController(
+        int(os.getenv('CHAT_MAX_CONCURRENT', '8')),
+        int(os.getenv('CHAT_MAX_QUEUE', '32')),
+        float(os.getenv('CHAT_QUEUE_TIMEOUT', '10')),
+        max_per_user=per_worker(int(os.getenv('CHAT_USER_MAX_CONCURRENT', '4')), workers),
+        max_user_queue=per_worker(int(os.getenv('CHAT_USER_MAX_QUEUE', '16')), workers),
+        weights=parse_weights(os.getenv('CHAT_USER_WEIGHTS', '')),
+    )
@@ -0,0 +1,110 @@
+import asyncio
+import os
+import unittest
+from unittest import mock
+
+from api.admission import AdmissionController, Rejected, create_admission_controller
+
+
+class TestAdmissionController(unittest.TestCase):
+    def test_queue_full_is_rejected_with_429(self):
+        async def scenario():
+            controller = AdmissionController(max_concurrent=1, max_queue=1, queue_timeout=5)
+            await controller.acquire()
+            waiting = asyncio.create_task(controller.acquire())
+            await asyncio.sleep(0)
+            with self.assertRaises(Rejected) as ctx:
+                await controller.acquire()
+            self.assertEqual(ctx.exception.status_code, 429)
+            self.assertGreaterEqual(ctx.exception.retry_after, 1)
+            controller.release(0.1)
+            await waiting
+            return controller.stats()
+
+        stats = asyncio.run(scenario())
+        self.assertEqual((stats.active, stats.queued, stats.admitted, stats.rejected_full), (1, 0, 2, 1))
+
+    def test_queue_timeout_is_rejected_with_503(self):
+        async def scenario():
+            controller = AdmissionController(max_concurrent=1, max_queue=4, queue_timeout=0.01)
+            await controller.acquire()
+            with self.assertRaises(Rejected) as ctx:
+                await controller.acquire()
+            self.assertEqual(ctx.exception.status_code, 503)
+            controller.release(0.1)
+            return controller.stats()
+
+        stats = asyncio.run(scenario())
+        self.assertEqual((stats.active, stats.queued, stats.rejected_timeout), (0, 0, 1))
+
+    def test_waiters_are_served_in_order(self):
+        async def scenario():
+            controller = AdmissionController(max_concurrent=1, max_queue=4, queue_timeout=5)
+            await controller.acquire()
+            order: list[int] = []
+
+            async def request(n: int):
+                await controller.acquire()
+                order.append(n)
+                controller.release(0.0)
+
+            tasks = [asyncio.create_task(request(n)) for n in range(3)]
+            await asyncio.sleep(0)
+            controller.release(0.0)
+            await asyncio.gather(*tasks)
+            return order, controller.stats().active
+
+        self.assertEqual(asyncio.run(scenario()), ([0, 1, 2], 0))
+
+    def test_slots_are_shared_between_users_by_weight(self):
+        async def scenario():
+            controller = AdmissionController(max_concurrent=1, max_queue=16, queue_timeout=5, weights={"heavy": 2})
+            await controller.acquire("heavy")
+            order: list[str] = []
+
+            async def request(user: str):
+                await controller.acquire(user)
+                order.append(user)
+                await asyncio.sleep(0)
+                controller.release(0.0, user)
+
+            # the heavy user queues all of its requests first, the light one comes after
+            tasks = [asyncio.create_task(request("heavy")) for _ in range(4)] + [asyncio.create_task(request("light")) for _ in range(2)]
+            await asyncio.sleep(0)
+            controller.release(0.0, "heavy")
+            await asyncio.gather(*tasks)
+            return order, controller.user_stats()
+
+        order, stats = asyncio.run(scenario())
+        self.assertEqual(order, ["heavy", "heavy", "light", "heavy", "heavy", "light"])
+        self.assertEqual((stats["heavy"].admitted, stats["light"].admitted, stats["light"].active), (5, 2, 0))
+
+    def test_user_quota_leaves_slots_to_the_others(self):
+        async def scenario():
+            controller = AdmissionController(max_concurrent=3, max_queue=4, queue_timeout=5, max_per_user=1, max_user_queue=1)
+            await controller.acquire("a")
+            waiting = asyncio.create_task(controller.acquire("a"))
+            await asyncio.sleep(0)
+            with self.assertRaises(Rejected) as ctx:
+                await controller.acquire("a")
+            self.assertEqual(ctx.exception.status_code, 429)
+            # a free slot is not given to a user over its quota, but to another one at once
+            await controller.acquire("b")
+            queued = controller.user_stats()["a"].queued
+            controller.release(0.1, "a")
+            await waiting
+            return queued, controller.stats(), controller.user_stats()
+
+        queued, stats, users = asyncio.run(scenario())
+        self.assertEqual((queued, stats.active, stats.queued), (1, 2, 0))
+        self.assertEqual((users["a"].active, users["a"].rejected, users["b"].active), (1, 1, 1))
+
+    def test_user_quotas_are_divided_between_the_workers(self):
+        environment = {"WEB_CONCURRENCY": "3", "CHAT_USER_MAX_CONCURRENT": "4", "CHAT_USER_MAX_QUEUE": "0", "CHAT_MAX_CONCURRENT": "8"}
+        with mock.patch.dict(os.environ, environment):
+            controller = create_admission_controller()
+        self.assertEqual((controller.max_concurrent, controller.max_per_user, controller.max_user_queue), (8, 2, 0))
+
+
+if __name__ == "__main__":
+    unittest.main()
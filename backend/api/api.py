@@ -1,19 +1,34 @@
+import html
 import json
 import logging
 import os
 import time
-from typing import TypedDict
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Callable, Iterator, TypedDict
 
+from fastapi import Depends, Header, Query, Request, WebSocket
 from fastapi.applications import FastAPI
 from loguru import logger
-from starlette.responses import FileResponse, JSONResponse, StreamingResponse
-from starlette.staticfiles import StaticFiles
-from typing_extensions import Generator
-
-from api.dto import AuthenticationRequest, AuthenticationResponse, ChatRequest
+from starlette.responses import JSONResponse, Response, StreamingResponse
+
+from api.admission import ANONYMOUS, AdmissionController, AdmittedResponse, BatchSlots, Rejected, create_admission_controller
+from api.batch import BATCH_MAX_QUESTIONS, batch_frames, parallelism
+from api.dto import AuthenticationRequest, AuthenticationResponse, BatchRequest, ChatRequest, SessionResponse
+from api.export import FORMATS, create_export_admission, export_stream, pyarrow_available
+from api.images import image_response, image_url
+from api.jobs import JobWorker, relay, reply_topic, submit
+from api.protocol import NDJSON_MEDIA_TYPE, STREAMING_HEADERS, OnHistory, frame_response
+from api.sessions import SessionStore, create_session_store
+from api.static import IndexPage, PrecompressedStaticFiles
+from api.tables import render_table, table_page
+from api.warmup import Warmup, create_warmup
+from api.websocket import serve_conversation
 from blockz.LLMBlockz import RecStrDict
 from dm050.setup import DM050Shell
-from dm050.shellutils import GraphicsElement, TableElement, TextElement
+from dm050.shellutils import Element, GraphicsElement, HistoryUpdate, PagedTableElement, Progress, TableElement, TextElement, parse_history
+from langutils.broker import Broker, InProcessBroker, create_broker
+from langutils import profiling
+from langutils.metrics import ADMISSION, CONTENT_TYPE, REGISTRY, STAGE_SECONDS, USER_ADMISSION, timed_chunks
 
 # from shell.llm import History, TextElement
 
@@ -35,7 +50,18 @@ class InterceptHandler(logging.Handler):
         logger.opt(depth=depth, exception=record.exc_info).log(level, record.getMessage())
 
 
+_loguru_configured = False
+
+
 def configure_loguru():
+    """Routes the standard logging to loguru and adds the file sink. Runs once per process, from the lifespan of the application rather
+    than on import, so that importing the API (tests, tools, the parent of serve.py) has no side effects.
+    """
+    global _loguru_configured
+    if _loguru_configured:
+        return
+    _loguru_configured = True
+
     # Remove existing handlers
     for handler in logging.root.handlers[:]:
         logging.root.removeHandler(handler)
@@ -65,12 +91,73 @@ def configure_loguru():
     logger.info('Logger {} configured', 'succesfully')
 
 
-app = FastAPI()
-configure_loguru()
+@asynccontextmanager
+async def lifespan(app: FastAPI) -> AsyncIterator[None]:
+    configure_loguru()
+    # One shell per worker process: the OpenAI client, the SQL context, the similarity cache and the image cache are built once here
+    # instead of on every chat request.
+    app.state.shell = DM050Shell()
+    logger.info('DM050Shell created')
+    app.state.sessions = create_session_store()
+    app.state.admission = create_admission_controller()
+    app.state.exports = create_export_admission()
+    # the costs of the first question (fonts, SQL dialect, TLS handshakes, database connections, similarity data) are paid in the
+    # background; /ready tells the load balancer when they are over
+    app.state.warmup = create_warmup()
+    if app.state.warmup is not None:
+        app.state.warmup.start(app.state.shell)
+    # job mode (see api.jobs): with a STOMP broker the jobs are run by the workers of python -m api.jobs, with the in-process stand-in
+    # by this process
+    app.state.broker = create_broker()
+    job_worker = None
+    if app.state.broker is not None:
+        await app.state.broker.connect()
+        if isinstance(app.state.broker, InProcessBroker):
+            job_worker = JobWorker(app.state.broker, app.state.shell, int(os.getenv('JOB_CONCURRENCY', '2')))
+            await job_worker.start()
+    try:
+        yield
+    finally:
+        if job_worker is not None:
+            await job_worker.stop(timeout=0)
+        if app.state.broker is not None:
+            await app.state.broker.close()
+        if app.state.warmup is not None:
+            await app.state.warmup.stop()
+        await app.state.shell.aclose()
+        app.state.sessions.close()
+
+
+def get_shell(request: Request) -> DM050Shell:
+    return request.app.state.shell
+
+
+def get_sessions(request: Request) -> SessionStore:
+    return request.app.state.sessions
+
+
+def get_admission(request: Request) -> AdmissionController:
+    return request.app.state.admission
+
+
+def get_exports(request: Request) -> AdmissionController:
+    return request.app.state.exports
+
+
+def get_warmup(request: Request) -> Warmup | None:
+    return request.app.state.warmup
 
 
-# Mount dist files
-app.mount("/assets", StaticFiles(directory="dist/assets"), name="assets")
+def get_broker(request: Request) -> Broker | None:
+    return request.app.state.broker
+
+
+app = FastAPI(lifespan=lifespan)
+
+
+# Mount dist files, precompressed at build time (see api.static); the directory is looked up on the first request, not on import
+app.mount("/assets", PrecompressedStaticFiles(directory="dist/assets", check_dir=False), name="assets")
+index_page = IndexPage("dist/index.html")
 
 
 class UserDict(TypedDict):
@@ -99,65 +186,323 @@ def authenticate(request: AuthenticationRequest):
     return JSONResponse(status_code=404, content='Not found')
 
 
+def request_user(code: str | None) -> str:
+    """The user a request counts against in the fair sharing of the chat slots: the code of a known user, anonymous otherwise."""
+    return code if code is not None and any(user['code'] == code for user in users) else ANONYMOUS
+
+
+def get_user(x_user_code: str | None = Header(default=None)) -> str:
+    """The user of a request, from the X-User-Code header (the code returned by /api/authenticate)."""
+    return request_user(x_user_code)
+
+
+def get_profile_id(x_profile_token: str | None = Header(default=None), profile: str | None = Query(default=None)) -> str | None:
+    """The id of a new profile when the request asks to be profiled and presents PROFILE_TOKEN (see langutils.profiling), else None."""
+    return profiling.new_profile_id() if profiling.authorized(x_profile_token or profile) else None
+
+
 def generate_numbers():
     for i in range(1, 11):
         yield f"{i}\n"
         time.sleep(1)  # simulate streaming delay
 
 
-def combine_response(response: Generator[str], history: list[RecStrDict]):
-    for item in response:
-        yield item
-    yield "\n===========##}}\n"
-    yield json.dumps(history)
-
-
-def process_result(result) -> Generator[str]:
-    for item in result:
+async def combine_response(
+    stream: AsyncIterator[Element | Progress | HistoryUpdate],
+    on_history: OnHistory | None = None,
+) -> AsyncIterator[str]:
+    """Renders the elements as they come out of the shell, then appends the separator and the history.
+    Progress reports are forwarded as HTML comments, so that they reach the client as they happen without showing up in the rendered answer.
+    on_history, if set, receives the complete new history and returns what is to be sent to the client instead.
+    """
+    async for item in stream:
         match item:
-            case TextElement():
-                # Process TextElement if needed
-                yield item.getcontent()
-            case GraphicsElement():
-                yield "<img src=\"data:image/png;base64," + item.getcontent() + "\">"
-            case TableElement():
-                # Process TableElement if needed
-                yield convert_table_to_html(item.getcontent())
-
-
-def convert_table_to_html(table_data: list[dict[str, str]]) -> str:
-    if not table_data:
-        return "<table></table>"
-    headers = table_data[0].keys()
-    html = "<table><tr>"
-    for header in headers:
-        html += f"<th>{header}</th>"
-    html += "</tr>"
-    for row in table_data:
-        html += "<tr>"
-        for header in headers:
-            html += f"<td>{row[header]}</td>"
-        html += "</tr>"
-    html += "</table>"
-    return html
+            case HistoryUpdate(history=history):
+                yield "\n===========##}}\n"
+                yield json.dumps(history if on_history is None else await on_history(history))
+            case Progress(stage=stage, message=message, elapsed_ms=elapsed_ms):
+                yield f"<!-- progress {stage} {elapsed_ms}ms: {html.escape(message).replace('--', '- -')} -->"
+            case _:
+                for chunk in timed_chunks(process_result(item), STAGE_SECONDS, stage="serialize"):
+                    yield chunk
+
+
+def process_result(item: Element) -> Iterator[str]:
+    match item:
+        case TextElement():
+            # Process TextElement if needed
+            yield item.getcontent()
+        case GraphicsElement():
+            yield f"<img src=\"{image_url(item.getcontent())}\">"
+        case PagedTableElement(_handle=handle, _total_rows=total_rows, _export=export):
+            # the first page only; the client fetches the rest from /api/tables
+            attributes = {"data-table-id": handle, "data-total-rows": total_rows}
+            yield from render_table(item.getcontent(), attributes=attributes | ({"data-export-id": export} if export else {}))
+        case TableElement(_export=export):
+            # tables can be large; they go out in row batches rather than as one string
+            yield from render_table(item.getcontent(), attributes={"data-export-id": export} if export else None)
+        case _:
+            raise TypeError(f"Unexpected element {item}")
+
+
+Renderer = Callable[[AsyncIterator[Element | Progress | HistoryUpdate], OnHistory | None], AsyncIterator[str]]
+
+
+async def stream_chat(
+    request: ChatRequest,
+    shell: DM050Shell,
+    sessions: SessionStore,
+    admission: AdmissionController,
+    user: str,
+    render: Renderer,
+    media_type: str,
+    headers: dict[str, str] | None = None,
+    profile_id: str | None = None,
+) -> Response:
+    # everything that may turn the request down is done before it takes a slot
+    headers = dict(headers or {})
+    on_history = None
+    if request.session_id is not None:
+        if (history := await sessions.aload(request.session_id)) is None:
+            return JSONResponse(status_code=404, content='Unknown session')
+        on_history = session_delta(sessions, request.session_id, len(history))
+        headers["X-Session-Id"] = request.session_id
+    elif (history := parse_history(request.shell_history)) is None:
+        return JSONResponse(status_code=400, content='shell_history is not a JSON list')
+    try:
+        await admission.acquire(user)
+    except Rejected as e:
+        logger.warning('Chat request of {} rejected: {} ({})', user, e.reason, e.status_code)
+        return e.response()
+    try:
+        response = _chat_response(request.query, history, on_history, shell, render, media_type, headers, profile_id)
+    except BaseException:
+        # the slot is released by AdmittedResponse, which does not exist yet
+        admission.release(0.0, user)
+        raise
+    return AdmittedResponse(response, admission, user)
+
+
+def _chat_response(
+    query: str,
+    history: list[RecStrDict],
+    on_history: OnHistory | None,
+    shell: DM050Shell,
+    render: Renderer,
+    media_type: str,
+    headers: dict[str, str],
+    profile_id: str | None,
+) -> Response:
+    stream = shell.arequest_stream(query, history)
+    if profile_id is not None:
+        # the id names the file of the profile; it goes out as a header, the server having no way to send HTTP trailers
+        stream = profiling.profiled(stream, profile_id)
+        headers["X-Profile-Id"] = profile_id
+    return StreamingResponse(render(stream, on_history), media_type=media_type, headers=headers)
 
 
 @app.post("/api/chat_rq_stream", response_class=StreamingResponse)
-def chat_rq_stream(request: ChatRequest) -> StreamingResponse:
-    shell = DM050Shell()
-    result, new_history = shell.request(request.query, request.shell_history)
-
-    result_gen = process_result(result)
-    response = combine_response(result_gen, new_history)
-    return StreamingResponse(response, media_type="text/plain")
+async def chat_rq_stream(
+    request: ChatRequest,
+    shell: DM050Shell = Depends(get_shell),
+    sessions: SessionStore = Depends(get_sessions),
+    admission: AdmissionController = Depends(get_admission),
+    user: str = Depends(get_user),
+    profile_id: str | None = Depends(get_profile_id),
+) -> Response:
+    """Legacy protocol: rendered HTML, then the separator and the history. Kept for the clients that split the text on the separator."""
+    return await stream_chat(request, shell, sessions, admission, user, combine_response, "text/plain", profile_id=profile_id)
+
+
+@app.post("/api/chat_stream", response_class=StreamingResponse)
+async def chat_stream(
+    request: ChatRequest,
+    shell: DM050Shell = Depends(get_shell),
+    sessions: SessionStore = Depends(get_sessions),
+    admission: AdmissionController = Depends(get_admission),
+    user: str = Depends(get_user),
+    profile_id: str | None = Depends(get_profile_id),
+) -> Response:
+    """Framed protocol: one JSON object per line, see api.protocol."""
+    return await stream_chat(request, shell, sessions, admission, user, frame_response, NDJSON_MEDIA_TYPE, STREAMING_HEADERS, profile_id)
+
+
+@app.post("/api/chat_batch", response_class=StreamingResponse)
+async def chat_batch(
+    request: BatchRequest,
+    shell: DM050Shell = Depends(get_shell),
+    admission: AdmissionController = Depends(get_admission),
+    user: str = Depends(get_user),
+) -> Response:
+    """Answers a list of questions concurrently and streams one result frame per question as it completes, see api.batch.
+    Each question running takes a chat slot of the admission control (see BatchSlots), and no more questions run at once than the
+    quota of the user allows.
+    """
+    if not request.questions or len(request.questions) > BATCH_MAX_QUESTIONS:
+        return JSONResponse(status_code=400, content=f'A batch has 1 to {BATCH_MAX_QUESTIONS} questions')
+    if (history := parse_history(request.shell_history)) is None:
+        return JSONResponse(status_code=400, content='shell_history is not a JSON list')
+    try:
+        await admission.acquire(user)
+    except Rejected as e:
+        logger.warning('Chat batch of {} rejected: {} ({})', user, e.reason, e.status_code)
+        return e.response()
+    try:
+        width = min(parallelism(request.parallelism), admission.max_per_user)
+        results = shell.arequest_batch(request.questions, history, width, BatchSlots(admission, user))
+        response = StreamingResponse(batch_frames(results), media_type=NDJSON_MEDIA_TYPE, headers=STREAMING_HEADERS)
+    except BaseException:
+        admission.release(0.0, user)
+        raise
+    return AdmittedResponse(response, admission, user)
+
+
+@app.post('/api/jobs', status_code=202)
+async def create_job(request: ChatRequest, broker: Broker | None = Depends(get_broker)) -> Response:
+    """Queues the question for the job workers and returns at once; the frames of the answer are published to the reply_to topic.
+    Sessions are not updated by jobs nobody relays, hence session_id is only accepted by /api/jobs/stream.
+    """
+    if broker is None:
+        return JSONResponse(status_code=503, content='Job mode is off (JOB_BROKER)')
+    if request.session_id is not None:
+        return JSONResponse(status_code=400, content='session_id needs /api/jobs/stream')
+    if (history := parse_history(request.shell_history)) is None:
+        return JSONResponse(status_code=400, content='shell_history is not a JSON list')
+    job_id = await submit(broker, request.query, history)
+    return JSONResponse(status_code=202, content={"job_id": job_id, "reply_to": reply_topic(job_id)})
+
+
+@app.post("/api/jobs/stream", response_class=StreamingResponse)
+async def job_stream(
+    request: ChatRequest, broker: Broker | None = Depends(get_broker), sessions: SessionStore = Depends(get_sessions)
+) -> Response:
+    """/api/chat_stream run by the job workers: the frames of the answer are relayed from the reply topic, followed by a done frame."""
+    if broker is None:
+        return JSONResponse(status_code=503, content='Job mode is off (JOB_BROKER)')
+    headers = dict(STREAMING_HEADERS)
+    on_history = None
+    if request.session_id is not None:
+        if (history := await sessions.aload(request.session_id)) is None:
+            return JSONResponse(status_code=404, content='Unknown session')
+        on_history = session_delta(sessions, request.session_id, len(history))
+        headers["X-Session-Id"] = request.session_id
+    elif (history := parse_history(request.shell_history)) is None:
+        return JSONResponse(status_code=400, content='shell_history is not a JSON list')
+    return StreamingResponse(relay(broker, request.query, history, on_history), media_type=NDJSON_MEDIA_TYPE, headers=headers)
+
+
+@app.websocket("/api/chat_ws")
+async def chat_ws(websocket: WebSocket, session_id: str | None = None, user: str | None = None):
+    """Chat over a WebSocket: the server keeps the history of the connection and the client sends only its questions, see
+    api.websocket.Conversation for the messages. session_id resumes a session of the store instead of starting a new one. user is the code
+    of the user, given as a query parameter because browsers cannot set headers on a WebSocket (X-User-Code is read as well).
+    """
+    state = websocket.app.state
+    user = request_user(user or websocket.headers.get("x-user-code"))
+    await serve_conversation(websocket, state.shell, state.sessions, state.admission, session_id, user)
+
+
+@app.get('/metrics')
+async def metrics(admission: AdmissionController = Depends(get_admission)) -> Response:
+    """Prometheus scrape endpoint, see langutils.metrics for what is measured."""
+    for field, value in admission.as_dict().items():
+        ADMISSION.set(value, field=field)
+    for user, stats in admission.users_as_dict().items():
+        for field, value in stats.items():
+            USER_ADMISSION.set(value, user=user, field=field)
+    return Response(REGISTRY.expose(), media_type=CONTENT_TYPE)
+
+
+@app.get('/ready')
+async def ready(warmup: Warmup | None = Depends(get_warmup)) -> Response:
+    """Readiness probe: 503 until the warm-up of this worker is over, 200 afterwards. Liveness is any answer from the worker at all."""
+    if warmup is None:
+        return JSONResponse({"ready": True})
+    if not warmup.ready:
+        return JSONResponse(warmup.as_dict(), status_code=503, headers={"Retry-After": "1"})
+    return JSONResponse(warmup.as_dict())
+
+
+@app.get('/api/admission')
+async def admission_stats(admission: AdmissionController = Depends(get_admission)):
+    """Concurrency and queue depth of the chat endpoints, overall and per user."""
+    return admission.as_dict() | {"users": admission.users_as_dict()}
+
+
+def session_delta(sessions: SessionStore, session_id: str, known: int) -> OnHistory:
+    """Stores the entries added by the current exchange in the session and sends only those back to the client."""
+
+    async def on_history(history: list[RecStrDict]) -> list[RecStrDict]:
+        delta = history[known:]
+        await sessions.aappend(session_id, delta, history[:known])
+        return delta
+
+    return on_history
+
+
+@app.post('/api/sessions', response_model=SessionResponse)
+async def create_session(sessions: SessionStore = Depends(get_sessions)):
+    return SessionResponse(session_id=await sessions.acreate())
+
+
+@app.get('/api/images/{img_name}')
+def get_image(img_name: str, request: Request, shell: DM050Shell = Depends(get_shell)) -> Response:
+    if (img := shell.tools.get_image(img_name)) is None:
+        return JSONResponse(status_code=404, content='Not found')
+    return image_response(request, img)
+
+
+# largest page served by /api/tables
+MAX_TABLE_PAGE_ROWS = 1000
+
+
+@app.get('/api/tables/{table_id}')
+def get_table(
+    table_id: str,
+    offset: int = Query(0, ge=0),
+    limit: int = Query(100, ge=1, le=MAX_TABLE_PAGE_ROWS),
+    sort: str = "",
+    shell: DM050Shell = Depends(get_shell),
+) -> Response:
+    """A page of a table kept on the server. sort is a comma separated list of column names, '-' in front of a name sorts descending."""
+    if (table := shell.tools.get_table(table_id)) is None:
+        return JSONResponse(status_code=404, content='Not found')
+    try:
+        page = table_page(table, offset, limit, [key for key in sort.split(",") if key])
+    except KeyError as e:
+        return JSONResponse(status_code=400, content=f'Unknown column {e}')
+    return Response(json.dumps(page, default=str), media_type="application/json")
+
+
+@app.get('/api/exports/{handle}')
+async def export_table(
+    handle: str,
+    format: str = "csv",
+    shell: DM050Shell = Depends(get_shell),
+    exports: AdmissionController = Depends(get_exports),
+) -> Response:
+    """The full result of a table of an answer, run again and streamed as CSV, Arrow IPC or Parquet; see api.export."""
+    if (export_format := FORMATS.get(format)) is None:
+        return JSONResponse(status_code=400, content=f'Unknown format {format!r}, expected one of {", ".join(FORMATS)}')
+    if export_format.needs_pyarrow and not pyarrow_available():
+        return JSONResponse(status_code=501, content=f'The {format} export needs pyarrow on the server')
+    if (sql := shell.tools.get_query(handle)) is None:
+        return JSONResponse(status_code=404, content='Not found')
+    try:
+        await exports.acquire()
+    except Rejected as e:
+        return JSONResponse(status_code=429, content='Too many exports running, try again later', headers={"Retry-After": str(e.retry_after)})
+    headers = {"Content-Disposition": f'attachment; filename="table-{handle[:12]}.{export_format.extension}"', "Cache-Control": "no-store"}
+    response = StreamingResponse(export_stream(shell.context, sql, format), media_type=export_format.media_type, headers=headers)
+    return AdmittedResponse(response, exports)
 
 
 # static content serving
 @app.get("/")
-def serve_root():
-    return FileResponse("dist/index.html")
+def serve_root(request: Request) -> Response:
+    return index_page.response(request)
 
 
 @app.get("/{full_path:path}")
-def serve_spa(full_path: str):
-    return FileResponse("dist/index.html")
+def serve_spa(full_path: str, request: Request) -> Response:
+    return index_page.response(request)
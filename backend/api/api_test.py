@@ -0,0 +1,110 @@
+import asyncio
+import unittest
+from unittest import mock
+
+from fastapi.testclient import TestClient
+
+from api import api
+from api.admission import AdmissionController
+from api.sessions import SessionStore
+from langutils.broker import InProcessBroker
+from dm050 import batch
+from dm050.shellutils import HistoryUpdate, TextElement
+
+
+class FakeShell:
+    def arequest_stream(self, req, history):
+        if req == "boom":
+            raise RuntimeError("the shell failed before streaming")
+
+        async def stream():
+            yield TextElement(f"answer to {req}")
+            yield HistoryUpdate(history + [{"user": req}])
+
+        return stream()
+
+    def arequest_batch(self, questions, history, parallelism, slot=None):
+        if "boom" in questions:
+            raise RuntimeError("the shell failed before streaming")
+        return batch.arequest_batch(None, None, questions, history, parallelism, slot)  # type: ignore
+
+
+class QuestionStreams:
+    """Stands for dm050.shell.arequest_stream in the batches: records the questions running and the slots taken while they run."""
+
+    def __init__(self):
+        self.running = 0
+        self.seen: list[tuple[int, int]] = []
+
+    async def __call__(self, llm, tools, history, req, triage_cache=None):
+        self.running += 1
+        try:
+            await asyncio.sleep(0.02)
+            self.seen.append((self.running, api.app.state.admission.stats().active))
+            yield HistoryUpdate(history + [{"user": req}])
+        finally:
+            self.running -= 1
+
+
+class TestChatSlots(unittest.TestCase):
+    def setUp(self):
+        # the lifespan is not run: the state is that of a worker with a fake shell
+        api.app.state.shell = FakeShell()
+        api.app.state.sessions = SessionStore()
+        api.app.state.admission = AdmissionController(1, 0, 1.0)
+        self.client = TestClient(api.app, raise_server_exceptions=False)
+        self.streams = QuestionStreams()
+        patcher = mock.patch.object(batch, "arequest_stream", self.streams)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def active(self) -> int:
+        return self.client.get("/api/admission").json()["active"]
+
+    def test_failed_requests_give_their_slot_back(self):
+        self.assertEqual(self.client.post("/api/chat_stream", json={"query": "q", "shell_history": "{not json"}).status_code, 400)
+        self.assertEqual(self.client.post("/api/chat_stream", json={"query": "q", "session_id": "unknown"}).status_code, 404)
+        self.assertEqual(self.client.post("/api/chat_stream", json={"query": "boom"}).status_code, 500)
+        self.assertEqual(self.active(), 0)
+
+        response = self.client.post("/api/chat_stream", json={"query": "q"})
+        self.assertEqual(response.status_code, 200)
+        self.assertIn("answer to q", response.text)
+        self.assertEqual(self.active(), 0)
+
+    def test_failed_batches_give_their_slot_back(self):
+        self.assertEqual(self.client.post("/api/chat_batch", json={"questions": ["q"], "shell_history": "{not json"}).status_code, 400)
+        self.assertEqual(self.client.post("/api/chat_batch", json={"questions": ["boom"]}).status_code, 500)
+        self.assertEqual(self.active(), 0)
+        self.assertEqual(self.client.post("/api/chat_batch", json={"questions": ["q"]}).status_code, 200)
+        self.assertEqual(self.active(), 0)
+
+    def test_batches_take_a_slot_per_question_within_the_user_quota(self):
+        api.app.state.admission = AdmissionController(8, 8, 5.0, max_per_user=2)
+        response = self.client.post("/api/chat_batch", json={"questions": [f"q{i}" for i in range(5)], "parallelism": 4})
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('"answered": 5', response.text)
+        # at most two questions at once, each holding a slot
+        self.assertEqual(max(running for running, _ in self.streams.seen), 2)
+        self.assertTrue(all(running == active for running, active in self.streams.seen))
+        self.assertEqual(self.active(), 0)
+
+
+class TestJobRequests(unittest.TestCase):
+    def setUp(self):
+        api.app.state.broker = InProcessBroker()
+        api.app.state.sessions = SessionStore()
+        self.client = TestClient(api.app)
+
+    def tearDown(self):
+        api.app.state.broker = None
+
+    def test_malformed_history_is_refused(self):
+        for endpoint in ("/api/jobs", "/api/jobs/stream"):
+            with self.subTest(endpoint):
+                response = self.client.post(endpoint, json={"query": "q", "shell_history": "{not json"})
+                self.assertEqual(response.status_code, 400)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,77 @@
+"""Batch questions (see dm050.batch): POST /api/chat_batch and its command line counterpart, which answers the questions of a file without
+going through the API (from the backend directory):
+
+    python -m api.batch [api/questions.txt] [--parallelism 4] [--output results.ndjson]
+
+Both produce NDJSON: one {"type": "result", "index", "query", "status", "elapsed_ms", "items", "history"} frame per question as soon as
+it is answered ("error" instead of "history" when it failed), items being the text, table and graphics frames of api.protocol, then
+{"type": "done", "answered": ..., "failed": ...}.
+"""
+
+import argparse
+import asyncio
+import os
+import sys
+from typing import AsyncIterator
+
+from api.protocol import element_fields, frame
+from dm050.batch import BatchResult
+
+# upper bound of the questions answered at once by a batch; a request may ask for less
+BATCH_PARALLELISM = int(os.getenv("BATCH_PARALLELISM", "4"))
+BATCH_MAX_QUESTIONS = int(os.getenv("BATCH_MAX_QUESTIONS", "100"))
+
+
+def parallelism(requested: int | None) -> int:
+    if requested is None:
+        return BATCH_PARALLELISM
+    return max(1, min(requested, BATCH_PARALLELISM))
+
+
+def result_frame(result: BatchResult) -> str:
+    fields = {"index": result.index, "query": result.query, "status": result.status, "elapsed_ms": result.elapsed_ms}
+    items = [element_fields(element) for element in result.elements]
+    if result.history is not None:
+        return frame("result", **fields, items=items, history=result.history)
+    return frame("result", **fields, items=items, error=result.error)
+
+
+async def batch_frames(results: AsyncIterator[BatchResult]) -> AsyncIterator[str]:
+    counts = {"answered": 0, "failed": 0}
+    async for result in results:
+        counts[result.status] += 1
+        yield result_frame(result)
+    yield frame("done", **counts)
+
+
+async def run(path: str, output: str | None, parallelism: int) -> None:
+    from dm050.setup import DM050Shell
+
+    with open(path) as f:
+        questions = [line.strip() for line in f if line.strip()]
+    shell = DM050Shell()
+    out = open(output, "w") if output else sys.stdout
+    try:
+        async for line in batch_frames(shell.arequest_batch(questions, parallelism=parallelism)):
+            out.write(line)
+            out.flush()
+    finally:
+        if out is not sys.stdout:
+            out.close()
+        await shell.aclose()
+
+
+def main() -> None:
+    from dotenv import load_dotenv
+
+    load_dotenv()
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("questions", nargs="?", default=os.path.join(os.path.dirname(__file__), "questions.txt"))
+    parser.add_argument("--parallelism", type=int, default=BATCH_PARALLELISM)
+    parser.add_argument("--output", help="where to write the results, standard output by default")
+    args = parser.parse_args()
+    asyncio.run(run(args.questions, args.output, max(1, args.parallelism)))
+
+
+if __name__ == "__main__":
+    main()
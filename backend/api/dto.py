@@ -21,7 +21,21 @@ class ChatRequest(BaseModel):
     query: str
     # history: list[lb.RecStrDict]
     # history: list[History]
-    shell_history: str
+    shell_history: str = ""
+    # when set, the history is kept on the server (see POST /api/sessions) and shell_history is ignored
+    session_id: str | None = None
+
+
+class BatchRequest(BaseModel):
+    questions: list[str]
+    # the history every question is asked with, as in ChatRequest
+    shell_history: str = ""
+    # questions answered at once, at most BATCH_PARALLELISM
+    parallelism: int | None = None
+
+
+class SessionResponse(BaseModel):
+    session_id: str
 
 
 class AuthenticationResponse(BaseModel):
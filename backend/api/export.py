@@ -0,0 +1,160 @@
+"""Export of the full result behind a table of an answer: GET /api/exports/{handle}?format=csv|arrow|parquet.
+
+The table frames carry an export handle (see QueryCache in langutils.llm_tools) naming the validated SQL of the table, prefix.txt included;
+the export runs it again on a connection of its own, outside the LLM path and the chat admission control, and streams the result in
+constant memory. CSV is written by the database (COPY ... TO STDOUT); Arrow IPC and Parquet are built from a server-side cursor,
+EXPORT_BATCH_ROWS rows at a time, and need the optional pyarrow package. At most EXPORT_MAX_CONCURRENT exports run at once per worker.
+"""
+
+import asyncio
+import os
+from dataclasses import dataclass
+from datetime import timezone
+from typing import Any, AsyncIterator, Callable
+
+from api.admission import AdmissionController
+from langutils.context import ExecutionContext, ResultColumn
+
+EXPORT_BATCH_ROWS = int(os.getenv("EXPORT_BATCH_ROWS", "10000"))
+EXPORT_MAX_CONCURRENT = int(os.getenv("EXPORT_MAX_CONCURRENT", "2"))
+
+
+@dataclass(frozen=True)
+class ExportFormat:
+    media_type: str
+    extension: str
+    needs_pyarrow: bool
+
+
+FORMATS = {
+    "csv": ExportFormat("text/csv; charset=utf-8", "csv", False),
+    "arrow": ExportFormat("application/vnd.apache.arrow.stream", "arrow", True),
+    "parquet": ExportFormat("application/vnd.apache.parquet", "parquet", True),
+}
+
+
+def create_export_admission() -> AdmissionController:
+    """Exports take long and hold a database connection each: beyond EXPORT_MAX_CONCURRENT they are turned away at once, not queued."""
+    return AdmissionController(EXPORT_MAX_CONCURRENT, 0, 0.0)
+
+
+# PostgreSQL type OIDs with an Arrow counterpart; every other type is exported as its string form
+_BOOL, _INT8, _INT2, _INT4, _FLOAT4, _FLOAT8, _DATE, _TIMESTAMP, _TIMESTAMPTZ, _NUMERIC = 16, 20, 21, 23, 700, 701, 1082, 1114, 1184, 1700
+
+
+def pyarrow_available() -> bool:
+    try:
+        import pyarrow  # type: ignore[import-not-found]  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def arrow_field(column: ResultColumn) -> tuple[Any, Callable[[Any], Any]]:
+    """The Arrow type of a column and the conversion of its values to it."""
+    import pyarrow as pa  # type: ignore[import-not-found]
+
+    keep: Callable[[Any], Any] = lambda v: v
+    plain = {
+        _BOOL: pa.bool_(),
+        _INT2: pa.int64(),
+        _INT4: pa.int64(),
+        _INT8: pa.int64(),
+        _FLOAT4: pa.float64(),
+        _FLOAT8: pa.float64(),
+        _DATE: pa.date32(),
+        _TIMESTAMP: pa.timestamp("us"),
+    }
+    if column.type_code in plain:
+        return plain[column.type_code], keep
+    if column.type_code == _NUMERIC:
+        if column.precision is not None and column.precision <= 38:
+            return pa.decimal128(column.precision, column.scale or 0), keep
+        # numeric without a declared precision may not fit a decimal128
+        return pa.float64(), lambda v: float(v) if v is not None else None
+    if column.type_code == _TIMESTAMPTZ:
+        return pa.timestamp("us", tz="UTC"), lambda v: v.astimezone(timezone.utc) if v is not None else None
+    return pa.string(), lambda v: str(v) if v is not None else None
+
+
+class _Chunks:
+    """Write-only file collecting what the Arrow writers produce, handed out after every batch."""
+
+    closed = False
+
+    def __init__(self):
+        self.parts: list[bytes] = []
+        self.position = 0
+
+    def write(self, data: Any) -> int:
+        chunk = bytes(data)
+        self.parts.append(chunk)
+        self.position += len(chunk)
+        return len(chunk)
+
+    def tell(self) -> int:
+        return self.position
+
+    def flush(self) -> None:
+        pass
+
+    def close(self) -> None:
+        self.closed = True
+
+    def take(self) -> bytes:
+        data = b"".join(self.parts)
+        self.parts = []
+        return data
+
+
+class _ArrowWriter:
+    """Turns batches of rows into Arrow IPC stream or Parquet bytes; the writer is opened with the schema of the first batch."""
+
+    def __init__(self, kind: str):
+        self.kind = kind
+        self.sink = _Chunks()
+        self.fields: list[tuple[Any, Callable[[Any], Any]]] = []
+        self.schema: Any = None
+        self.writer: Any = None
+
+    def open(self, columns: list[ResultColumn]) -> None:
+        import pyarrow as pa  # type: ignore[import-not-found]
+
+        self.fields = [arrow_field(column) for column in columns]
+        self.schema = pa.schema([pa.field(column.name, arrow_type) for column, (arrow_type, _) in zip(columns, self.fields)])
+        if self.kind == "parquet":
+            import pyarrow.parquet as pq  # type: ignore[import-not-found]
+
+            self.writer = pq.ParquetWriter(self.sink, self.schema, compression="zstd")
+        else:
+            self.writer = pa.ipc.new_stream(self.sink, self.schema)
+
+    def write(self, columns: list[ResultColumn], rows: list[tuple[Any, ...]]) -> bytes:
+        import pyarrow as pa  # type: ignore[import-not-found]
+
+        if self.writer is None:
+            self.open(columns)
+        values = list(zip(*rows)) if rows else [() for _ in columns]
+        arrays = [pa.array([convert(v) for v in column], type=arrow_type) for column, (arrow_type, convert) in zip(values, self.fields)]
+        # each batch of the cursor is one record batch, respectively one row group
+        self.writer.write_batch(pa.RecordBatch.from_arrays(arrays, schema=self.schema))
+        return self.sink.take()
+
+    def close(self, columns: list[ResultColumn]) -> bytes:
+        if self.writer is None:
+            self.open(columns)
+        self.writer.close()
+        return self.sink.take()
+
+
+async def export_stream(context: ExecutionContext, sql: str, kind: str, batch_rows: int = EXPORT_BATCH_ROWS) -> AsyncIterator[bytes]:
+    """The result of sql in the format kind (a key of FORMATS), in chunks. The Arrow conversion runs in a worker thread."""
+    if kind == "csv":
+        async for chunk in context.acopy_csv(sql, batch_rows):
+            yield chunk
+        return
+    writer = _ArrowWriter(kind)
+    columns: list[ResultColumn] = []
+    async for columns, rows in context.astream_query(sql, batch_rows):
+        yield await asyncio.to_thread(writer.write, columns, rows)
+    yield writer.close(columns)
@@ -0,0 +1,59 @@
+import asyncio
+import io
+import unittest
+from decimal import Decimal
+
+from api.export import export_stream, pyarrow_available
+from api.protocol import element_fields
+from dm050.shellutils import PagedTableElement
+from langutils.context import ExecutionContext, ResultColumn
+
+
+class ListContext(ExecutionContext):
+    def execute_query(self, query):
+        return [{"name": "MOL, Nyrt.", "price": 1}, {"name": 'say "hi"', "price": None}]
+
+
+class TypedContext(ExecutionContext):
+    def execute_query(self, query):
+        raise AssertionError("exports must not materialize the result")
+
+    async def astream_query(self, query, batch_rows):
+        columns = [ResultColumn("id", 23), ResultColumn("price", 1700, 10, 2), ResultColumn("note", 25)]
+        for batch in range(3):
+            yield columns, [(batch * batch_rows + i, Decimal("1.25"), None) for i in range(batch_rows)]
+
+
+def export(context, kind, batch_rows=2) -> list[bytes]:
+    async def collect():
+        return [chunk async for chunk in export_stream(context, "select 1", kind, batch_rows)]
+
+    return asyncio.run(collect())
+
+
+class TestExport(unittest.TestCase):
+    def test_csv_is_quoted_and_has_a_header(self):
+        self.assertEqual(b"".join(export(ListContext(), "csv")), b'name,price\n"MOL, Nyrt.",1\n"say ""hi""",\n')
+
+    @unittest.skipUnless(pyarrow_available(), "pyarrow is not installed")
+    def test_arrow_and_parquet_keep_the_column_types(self):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        chunks = export(TypedContext(), "arrow")
+        # one chunk per batch of the cursor, and the end of stream
+        self.assertEqual(len(chunks), 4)
+        table = pa.ipc.open_stream(b"".join(chunks)).read_all()
+        self.assertEqual([str(t) for t in table.schema.types], ["int64", "decimal128(10, 2)", "string"])
+        self.assertEqual(table.column("id").to_pylist(), list(range(6)))
+
+        parquet = pq.ParquetFile(io.BytesIO(b"".join(export(TypedContext(), "parquet"))))
+        self.assertEqual((parquet.metadata.num_rows, parquet.metadata.num_row_groups), (6, 3))
+
+    def test_table_frames_carry_the_export_handle(self):
+        fields = element_fields(PagedTableElement([{"a": 1}], "t1", "h1", 9000, _export="e1"))
+        self.assertEqual(fields["export"], "e1")
+
+
+if __name__ == "__main__":
+    unittest.main()
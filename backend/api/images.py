@@ -0,0 +1,43 @@
+import re
+
+from fastapi import Request
+from starlette.responses import Response
+
+from shell import ImgData
+
+# The image behind an id never changes, so browsers and proxies may keep it for as long as they like.
+IMAGE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+_range = re.compile(r"bytes=(\d*)-(\d*)$")
+
+
+def image_url(img_name: str) -> str:
+    return f"/api/images/{img_name}"
+
+
+def image_response(request: Request, img: ImgData) -> Response:
+    """Serves a cached chart honouring If-None-Match and a single byte range (Range: bytes=start-end, bytes=start- or bytes=-suffix).
+    Multiple ranges and invalid ones (bytes=5-3) are not supported; such requests get the whole image, which RFC 9110 allows.
+    """
+    headers = {"ETag": img.etag, "Cache-Control": IMAGE_CACHE_CONTROL, "Accept-Ranges": "bytes"}
+    if img.etag in [tag.strip() for tag in request.headers.get("if-none-match", "").split(",")]:
+        return Response(status_code=304, headers=headers)
+
+    body = img.img_buffer.getvalue()
+    size = len(body)
+    requested = request.headers.get("range")
+    if_range = request.headers.get("if-range")
+    if requested is None or (if_range is not None and if_range != img.etag) or (m := _range.match(requested.strip())) is None:
+        return Response(body, media_type="image/png", headers=headers)
+
+    start, end = m.group(1), m.group(2)
+    if (start == "" and end == "") or (start != "" and end != "" and int(end) < int(start)):
+        return Response(body, media_type="image/png", headers=headers)
+    if start == "":
+        first, last = max(size - int(end), 0), size - 1
+    else:
+        first, last = int(start), min(int(end), size - 1) if end else size - 1
+    if first >= size or first > last:
+        return Response(status_code=416, headers={**headers, "Content-Range": f"bytes */{size}"})
+    headers["Content-Range"] = f"bytes {first}-{last}/{size}"
+    return Response(body[first : last + 1], status_code=206, media_type="image/png", headers=headers)
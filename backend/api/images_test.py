@@ -0,0 +1,71 @@
+import io
+import os
+import unittest
+from unittest import mock
+
+from fastapi import FastAPI, Request
+from fastapi.testclient import TestClient
+
+from api.images import image_response
+from langutils.llm_tools import ImgCache
+from shell import ImgData
+
+IMAGE = ImgData("chart", io.BytesIO(bytes(range(10))))
+
+app = FastAPI()
+
+
+@app.get("/image")
+def image(request: Request):
+    return image_response(request, IMAGE)
+
+
+class TestImageResponse(unittest.TestCase):
+    def setUp(self):
+        self.client = TestClient(app)
+
+    def get(self, **headers: str):
+        return self.client.get("/image", headers=headers)
+
+    def test_etag_revalidation(self):
+        response = self.get()
+        self.assertEqual((response.status_code, response.content), (200, bytes(range(10))))
+        self.assertEqual(response.headers["etag"], IMAGE.etag)
+        self.assertEqual(self.get(**{"If-None-Match": f'"other", {IMAGE.etag}'}).status_code, 304)
+        self.assertEqual(self.get(**{"If-None-Match": '"other"'}).status_code, 200)
+
+    def test_ranges(self):
+        for requested, content_range, content in [
+            ("bytes=2-4", "bytes 2-4/10", bytes([2, 3, 4])),
+            ("bytes=8-", "bytes 8-9/10", bytes([8, 9])),
+            ("bytes=-3", "bytes 7-9/10", bytes([7, 8, 9])),
+            ("bytes=5-100", "bytes 5-9/10", bytes([5, 6, 7, 8, 9])),
+        ]:
+            with self.subTest(requested):
+                response = self.get(Range=requested)
+                self.assertEqual(response.status_code, 206)
+                self.assertEqual(response.headers["content-range"], content_range)
+                self.assertEqual(response.content, content)
+
+    def test_unsatisfiable_range(self):
+        response = self.get(Range="bytes=10-")
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response.headers["content-range"], "bytes */10")
+
+    def test_invalid_or_stale_ranges_get_the_whole_image(self):
+        for headers in ({"Range": "bytes=5-3"}, {"Range": "bytes=0-1,4-5"}, {"Range": "bytes=0-1", "If-Range": '"other"'}):
+            with self.subTest(headers):
+                response = self.get(**headers)
+                self.assertEqual((response.status_code, len(response.content)), (200, 10))
+
+
+class TestImgCache(unittest.TestCase):
+    def test_images_live_as_long_as_tables_by_default(self):
+        with mock.patch.dict(os.environ, {"TABLE_CACHE_TTL": "900"}):
+            self.assertEqual(ImgCache().ttl_seconds, 900)
+        with mock.patch.dict(os.environ, {"TABLE_CACHE_TTL": "900", "IMG_CACHE_TTL": "60"}):
+            self.assertEqual(ImgCache().ttl_seconds, 60)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,201 @@
+"""Job mode: chat requests run by a pool of worker processes fed from a broker queue (see langutils.broker), so that the executors scale
+independently of the API and bursts wait in the queue instead of in the API processes.
+
+A job is a JSON message {"job_id", "query", "history", "deadline"} on JOB_QUEUE (default /queue/dm050.jobs). The worker taking it publishes
+the frames of api.protocol (progress, text, table, graphics, history, error) to the reply topic of the job (its reply-to header,
+/topic/dm050.jobs.<job_id>) and ends with {"type": "done", "status": ...}, status being answered, failed or expired (the job waited longer than
+JOB_TTL, default 600 seconds, and was dropped). Charts are served by the API from the shared store, so the workers and the API must share
+SHARED_STORE.
+
+The workers are started with (from the backend directory, with JOB_BROKER=stomp and the STOMP_* variables set):
+
+    python -m api.jobs [--workers N] [--concurrency 2] [--max-worker-memory-mb 0]
+
+With JOB_BROKER=inprocess the API runs the jobs itself on an in-process broker, which needs no broker and serves for development and tests.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import signal
+import time
+import uuid
+from typing import AsyncIterator
+
+from loguru import logger
+
+from api.protocol import OnHistory, frame, frame_response
+from blockz.LLMBlockz import RecStrDict
+from dm050.setup import DM050Shell
+from langutils.broker import Broker, Subscription, create_broker
+from langutils.metrics import JOBS
+
+JOB_QUEUE = os.getenv("JOB_QUEUE", "/queue/dm050.jobs")
+REPLY_TOPIC_PREFIX = "/topic/dm050.jobs."
+JOB_TTL = float(os.getenv("JOB_TTL", "600"))
+# seconds a stopping worker waits for its running jobs before leaving them to be redelivered
+DRAIN_TIMEOUT = 60.0
+
+
+def reply_topic(job_id: str) -> str:
+    return REPLY_TOPIC_PREFIX + job_id
+
+
+async def submit(broker: Broker, query: str, history: list[RecStrDict], job_id: str | None = None) -> str:
+    """Queues a job and returns its id; the answer is published to reply_topic(job_id)."""
+    job_id = job_id or uuid.uuid4().hex
+    deadline = time.time() + JOB_TTL
+    body = json.dumps({"job_id": job_id, "query": query, "history": history, "deadline": deadline}, default=str, ensure_ascii=False)
+    headers = {
+        "reply-to": reply_topic(job_id),
+        "job-id": job_id,
+        "content-type": "application/json",
+        "persistent": "true",
+        # brokers drop the message once it has expired (milliseconds since the epoch); the worker checks the deadline as well
+        "expires": str(int(deadline * 1000)),
+    }
+    await broker.send(JOB_QUEUE, body, headers)
+    return job_id
+
+
+async def relay(
+    broker: Broker, query: str, history: list[RecStrDict], on_history: OnHistory | None = None
+) -> AsyncIterator[str]:
+    """Queues a job and yields the frames its worker publishes, as NDJSON lines, up to and including the done frame.
+    The reply topic is subscribed to before the job is sent, as topics do not keep messages for late subscribers.
+    """
+    job_id = uuid.uuid4().hex
+    inbox: asyncio.Queue[bytes] = asyncio.Queue()
+
+    async def on_reply(headers: dict[str, str], body: bytes) -> bool:
+        inbox.put_nowait(body)
+        return True
+
+    subscription = await broker.subscribe(reply_topic(job_id), on_reply)
+    try:
+        await submit(broker, query, history, job_id)
+        while True:
+            try:
+                body = await asyncio.wait_for(inbox.get(), JOB_TTL)
+            except asyncio.TimeoutError:
+                yield frame("error", message=f"No news of job {job_id} for {JOB_TTL:g} seconds")
+                yield frame("done", status="expired")
+                return
+            message = json.loads(body)
+            if message["type"] == "history" and on_history is not None:
+                yield frame("history", history=await on_history(message["history"]))
+                continue
+            yield body.decode("utf-8") + "\n"
+            if message["type"] == "done":
+                return
+    finally:
+        subscription.cancel()
+
+
+class JobWorker:
+    """Takes jobs from the queue, at most concurrency at a time, and answers them with the shell.
+    A job that cannot be decoded is dropped; one that fails is answered with an error frame; both are acknowledged so that they do not come
+    back. Only the jobs cut short by stop() are redelivered, to another worker.
+    """
+
+    def __init__(self, broker: Broker, shell: DM050Shell, concurrency: int = 1):
+        self.broker = broker
+        self.shell = shell
+        self.concurrency = concurrency
+        self.running = 0
+        self._subscription: Subscription | None = None
+
+    async def start(self) -> None:
+        self._subscription = await self.broker.subscribe(JOB_QUEUE, self.handle, prefetch=self.concurrency)
+
+    async def stop(self, timeout: float = DRAIN_TIMEOUT) -> None:
+        """Stops taking jobs and gives the running ones up to timeout seconds to finish."""
+        if self._subscription is not None:
+            self._subscription.cancel()
+            self._subscription = None
+        deadline = time.monotonic() + timeout
+        while self.running and time.monotonic() < deadline:
+            await asyncio.sleep(0.1)
+
+    async def publish(self, destination: str, line: str) -> None:
+        await self.broker.send(destination, line.rstrip("\n"), {"content-type": "application/json"})
+
+    async def handle(self, headers: dict[str, str], body: bytes) -> bool:
+        try:
+            job = json.loads(body)
+            job_id, query, history = job["job_id"], job["query"], job.get("history") or []
+        except (ValueError, KeyError, TypeError):
+            logger.error("Dropping malformed job {!r}", body[:200])
+            JOBS.inc(outcome="malformed")
+            return True
+        reply_to = headers.get("reply-to") or reply_topic(job_id)
+        if time.time() > job.get("deadline", float("inf")):
+            JOBS.inc(outcome="expired")
+            await self.publish(reply_to, frame("done", status="expired"))
+            return True
+
+        self.running += 1
+        status = "failed"
+        try:
+            logger.info("Running job {}", job_id)
+            async for line in frame_response(self.shell.arequest_stream(query, history)):
+                if json.loads(line)["type"] == "history":
+                    status = "answered"
+                await self.publish(reply_to, line)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.exception("Job {} failed", job_id)
+            await self.publish(reply_to, frame("error", message=f"Internal error: {type(e).__name__}"))
+        finally:
+            self.running -= 1
+        JOBS.inc(outcome=status)
+        await self.publish(reply_to, frame("done", status=status))
+        return True
+
+
+async def run_worker(concurrency: int) -> None:
+    """One worker process: its own broker connection and shell, until SIGTERM or SIGINT."""
+    broker = create_broker()
+    if broker is None:
+        raise SystemExit("The job workers need a broker, set JOB_BROKER=stomp and STOMP_HOST")
+    await broker.connect()
+    shell = DM050Shell()
+    worker = JobWorker(broker, shell, concurrency)
+    stopping = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stopping.set)
+    await worker.start()
+    logger.info("Job worker {} taking jobs from {}", os.getpid(), JOB_QUEUE)
+    try:
+        await stopping.wait()
+    finally:
+        await worker.stop()
+        await shell.aclose()
+        await broker.close()
+
+
+def main() -> None:
+    from dotenv import load_dotenv
+
+    from serve import Supervisor, preload
+
+    load_dotenv()
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", type=int, default=int(os.getenv("JOB_WORKERS", "0")) or os.cpu_count() or 1)
+    parser.add_argument("--concurrency", type=int, default=int(os.getenv("JOB_CONCURRENCY", "2")), help="jobs run at a time by a worker")
+    parser.add_argument("--max-worker-memory-mb", type=float, default=float(os.getenv("WORKER_MAX_MEMORY_MB", "0")))
+    parser.add_argument("--check-interval", type=float, default=5.0, help="seconds between two memory checks of the workers")
+    args = parser.parse_args()
+    if os.getenv("JOB_BROKER") != "stomp":
+        raise SystemExit("The job workers need a broker, set JOB_BROKER=stomp and STOMP_HOST")
+
+    preload()
+    logger.info("Starting {} job workers running {} jobs each", args.workers, args.concurrency)
+    Supervisor(lambda: asyncio.run(run_worker(args.concurrency)), args).run()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+import asyncio
+import json
+import unittest
+
+from api.jobs import JOB_QUEUE, JobWorker, relay, reply_topic
+from dm050.shellutils import HistoryUpdate, ShellError, TextElement
+from langutils.broker import InProcessBroker
+
+
+class FakeShell:
+    async def arequest_stream(self, req, history):
+        if req == "fail":
+            raise ShellError("no answer")
+        yield TextElement(f"answer to {req}")
+        yield HistoryUpdate(history + [{"user": req}])
+
+
+async def run_jobs(*queries):
+    broker = InProcessBroker()
+    worker = JobWorker(broker, FakeShell(), concurrency=2)  # type: ignore
+    await worker.start()
+    try:
+        results = []
+        for query in queries:
+            results.append([json.loads(line) async for line in relay(broker, query, [])])
+        return results
+    finally:
+        await worker.stop(timeout=0)
+        await broker.close()
+
+
+class TestJobs(unittest.TestCase):
+    def test_frames_relayed_up_to_done(self):
+        answered, failed = asyncio.run(run_jobs("q", "fail"))
+        self.assertEqual(
+            answered,
+            [
+                {"type": "text", "content": "answer to q"},
+                {"type": "history", "history": [{"user": "q"}]},
+                {"type": "done", "status": "answered"},
+            ],
+        )
+        self.assertEqual(failed, [{"type": "error", "message": "no answer"}, {"type": "done", "status": "failed"}])
+
+    def test_expired_and_malformed_jobs_are_dropped(self):
+        async def scenario():
+            broker = InProcessBroker()
+            replies: list[bytes] = []
+
+            async def on_reply(headers, body):
+                replies.append(body)
+                return True
+
+            await broker.subscribe(reply_topic("old"), on_reply)
+            worker = JobWorker(broker, FakeShell())  # type: ignore
+            await worker.start()
+            await broker.send(JOB_QUEUE, "not json")
+            await broker.send(JOB_QUEUE, json.dumps({"job_id": "old", "query": "q", "deadline": 0}))
+            for _ in range(100):
+                await asyncio.sleep(0)
+            await broker.close()
+            return replies
+
+        self.assertEqual(asyncio.run(scenario()), [b'{"type": "done", "status": "expired"}'])
+
+    def test_frames_are_told_apart_by_their_type_not_their_layout(self):
+        async def scenario():
+            broker = InProcessBroker()
+
+            # a worker writing its frames compactly, with the type last
+            async def answer(headers, body):
+                job = json.loads(body)
+                for message in ({"history": [{"user": job["query"]}], "type": "history"}, {"status": "answered", "type": "done"}):
+                    await broker.send(headers["reply-to"], json.dumps(message, separators=(",", ":")))
+                return True
+
+            async def on_history(history):
+                return history + [{"assistant": "a"}]
+
+            await broker.subscribe(JOB_QUEUE, answer)
+            try:
+                relayed = relay(broker, "q", [], on_history=on_history)
+                return [json.loads(line) async for line in relayed]
+            finally:
+                await broker.close()
+
+        frames = asyncio.run(asyncio.wait_for(scenario(), 5))
+        history = [{"user": "q"}, {"assistant": "a"}]
+        self.assertEqual(frames, [{"type": "history", "history": history}, {"status": "answered", "type": "done"}])
@@ -0,0 +1,185 @@
+"""Load generator for the chat endpoints. Replays the questions of a file (questions.txt next to this module by default) against a running
+server and reports time to first byte, total latency, errors and rejections.
+
+Usage (from the backend directory, with the server running):
+
+    python -m api.loadgen [--url http://localhost:8000] [--endpoint chat_rq_stream] [--concurrency 4] [--rate 0] [--requests 0]
+                          [--questions api/questions.txt] [--timeout 300] [--label release-x] [--report report.json]
+
+--concurrency caps the requests in flight. With --rate 0 (the default) every worker sends its next request as soon as the previous one
+is over (closed loop); with --rate R requests arrive as a Poisson process of R requests per second regardless of how fast they are
+served (open loop), which is what exposes queueing. --requests limits the number of requests sent, by default each question is asked once.
+
+In the open loop the latencies are measured from the time each request was scheduled to arrive, not from the time it was sent: a request
+held back because --concurrency requests were already in flight (or because the generator itself fell behind) has been waiting for its
+answer all along, and leaving that wait out would hide exactly the queueing the run is meant to show. The wait before sending is reported
+separately as wait_ms. In the closed loop a request is due when a worker is free to send it, so its wait is nil.
+The report is a JSON document with the configuration, the counts and the latency percentiles, plus one record per request, so that two
+runs can be compared with any JSON tool.
+"""
+
+import argparse
+import asyncio
+import json
+import math
+import pathlib
+import random
+import statistics
+import time
+from collections import Counter
+from dataclasses import asdict, dataclass
+from datetime import datetime, timezone
+from typing import Any
+
+import httpx
+
+REJECTION_STATUSES = (429, 503)
+
+
+@dataclass
+class Sample:
+    question: str
+    status: int | None
+    ttfb_ms: float | None
+    total_ms: float
+    bytes: int
+    error: str | None = None
+    # time between the scheduled arrival of the request and its sending, included in ttfb_ms and total_ms
+    wait_ms: float = 0.0
+
+    @property
+    def outcome(self) -> str:
+        if self.error is not None or self.status is None:
+            return "error"
+        if self.status in REJECTION_STATUSES:
+            return "rejected"
+        return "ok" if self.status == 200 else "error"
+
+
+def percentile(values: list[float], p: float) -> float | None:
+    """Nearest-rank percentile, None for an empty list."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(p / 100.0 * len(ordered)) - 1)]
+
+
+def summary(values: list[float]) -> dict[str, float | None]:
+    return {
+        "mean": round(statistics.mean(values), 3) if values else None,
+        "p50": percentile(values, 50),
+        "p95": percentile(values, 95),
+        "p99": percentile(values, 99),
+        "max": max(values) if values else None,
+    }
+
+
+def _stream_error(endpoint: str, body: bytes) -> str | None:
+    """The framed endpoint reports failures of the shell in an error frame of an otherwise successful response."""
+    if endpoint != "chat_stream":
+        return None
+    for line in body.splitlines():
+        if line.startswith(b'{"type": "error"'):
+            return json.loads(line)["message"]
+    return None
+
+
+async def ask(client: httpx.AsyncClient, url: str, endpoint: str, question: str, scheduled: float | None = None) -> Sample:
+    """Sends the question and times the answer from scheduled, the time.perf_counter() at which the request was due (now by default)."""
+    sent = time.perf_counter()
+    start = sent if scheduled is None else scheduled
+    wait = (sent - start) * 1000.0
+    ttfb: float | None = None
+    body = bytearray()
+    try:
+        async with client.stream("POST", url, json={"query": question, "shell_history": ""}) as response:
+            async for chunk in response.aiter_bytes():
+                if ttfb is None:
+                    ttfb = (time.perf_counter() - start) * 1000.0
+                body.extend(chunk)
+        total = (time.perf_counter() - start) * 1000.0
+        return Sample(question, response.status_code, ttfb, total, len(body), _stream_error(endpoint, bytes(body)), wait)
+    except httpx.HTTPError as e:
+        return Sample(question, None, ttfb, (time.perf_counter() - start) * 1000.0, len(body), f"{type(e).__name__}: {e}", wait)
+
+
+async def run(
+    args: argparse.Namespace, questions: list[str], transport: httpx.AsyncBaseTransport | None = None
+) -> tuple[list[Sample], float]:
+    url = f"{args.url.rstrip('/')}/api/{args.endpoint}"
+    count = args.requests or len(questions)
+    slots = asyncio.Semaphore(args.concurrency)
+    samples: list[Sample] = []
+    rnd = random.Random(args.seed)
+
+    async def one(i: int, scheduled: float | None) -> None:
+        async with slots:
+            samples.append(await ask(client, url, args.endpoint, questions[i % len(questions)], scheduled))
+
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    async with httpx.AsyncClient(timeout=args.timeout, limits=limits, transport=transport) as client:
+        start = time.perf_counter()
+        tasks: list[asyncio.Task[None]] = []
+        # the arrival times are drawn in advance and kept to, a late wake-up delays the sending of a request but not its arrival
+        arrival = start
+        for i in range(count):
+            if args.rate > 0 and i > 0:
+                arrival += rnd.expovariate(args.rate)
+                await asyncio.sleep(max(0.0, arrival - time.perf_counter()))
+            tasks.append(asyncio.create_task(one(i, arrival if args.rate > 0 else None)))
+        await asyncio.gather(*tasks)
+        elapsed = time.perf_counter() - start
+    return samples, elapsed
+
+
+def report(args: argparse.Namespace, samples: list[Sample], elapsed: float) -> dict[str, Any]:
+    ok = [s for s in samples if s.outcome == "ok"]
+    return {
+        "label": args.label,
+        "started_at": args.started_at,
+        "config": {k: v for k, v in vars(args).items() if k not in ("label", "started_at", "report")},
+        "elapsed_s": round(elapsed, 3),
+        "requests": len(samples),
+        "ok": len(ok),
+        "rejected": sum(1 for s in samples if s.outcome == "rejected"),
+        "errors": sum(1 for s in samples if s.outcome == "error"),
+        "statuses": dict(sorted(Counter(str(s.status) if s.status is not None else "none" for s in samples).items())),
+        "throughput_rps": round(len(ok) / elapsed, 3) if elapsed > 0 else None,
+        # latencies of the successful requests only; rejections are fast by design and would flatter the numbers
+        "ttfb_ms": summary([s.ttfb_ms for s in ok if s.ttfb_ms is not None]),
+        "total_ms": summary([s.total_ms for s in ok]),
+        "wait_ms": summary([s.wait_ms for s in ok]),
+        "samples": [asdict(s) | {"outcome": s.outcome} for s in samples],
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default="http://localhost:8000")
+    parser.add_argument("--endpoint", default="chat_rq_stream", choices=["chat_rq_stream", "chat_stream"])
+    parser.add_argument("--questions", default=str(pathlib.Path(__file__).parent / "questions.txt"))
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--rate", type=float, default=0.0, help="arrivals per second, 0 for a closed loop")
+    parser.add_argument("--requests", type=int, default=0, help="number of requests, 0 to ask every question once")
+    parser.add_argument("--timeout", type=float, default=300.0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--label", default="")
+    parser.add_argument("--report", help="where to write the JSON report")
+    args = parser.parse_args()
+    args.started_at = datetime.now(timezone.utc).isoformat()
+
+    with open(args.questions) as f:
+        questions = [line.strip() for line in f if line.strip()]
+    if not questions:
+        raise SystemExit(f"No questions in {args.questions}")
+
+    samples, elapsed = asyncio.run(run(args, questions))
+    result = report(args, samples, elapsed)
+    if args.report:
+        with open(args.report, "w") as f:
+            json.dump(result, f, indent=2)
+    print(json.dumps({k: v for k, v in result.items() if k != "samples"}, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,61 @@
+import argparse
+import asyncio
+import unittest
+
+import httpx
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse, PlainTextResponse
+from starlette.routing import Route
+
+from api import loadgen
+
+SERVICE_TIME = 0.05
+
+
+async def chat(request: Request):
+    question = (await request.json())["query"]
+    if question == "busy":
+        return JSONResponse(status_code=429, content="busy")
+    await asyncio.sleep(SERVICE_TIME)
+    return PlainTextResponse(f"answer to {question}")
+
+
+# a server answering one request every SERVICE_TIME seconds
+stub = Starlette(routes=[Route("/api/chat_rq_stream", chat, methods=["POST"])])
+
+
+def arguments(**overrides) -> argparse.Namespace:
+    values = dict(url="http://stub", endpoint="chat_rq_stream", concurrency=1, rate=0.0, requests=0, timeout=10.0, seed=0, label="")
+    values.update(overrides, started_at="now", report=None)
+    return argparse.Namespace(**values)
+
+
+class TestLoadgen(unittest.TestCase):
+    def test_open_loop_latency_includes_the_wait_for_a_connection(self):
+        # ten arrivals a millisecond apart on one connection: each request waits for the ones before it
+        args = arguments(rate=1000.0)
+        samples, elapsed = asyncio.run(loadgen.run(args, ["q"] * 10, httpx.ASGITransport(app=stub)))
+        self.assertEqual([s.outcome for s in samples], ["ok"] * 10)
+        for sample in samples:
+            self.assertGreaterEqual(sample.total_ms, sample.wait_ms + SERVICE_TIME * 1000.0 * 0.9)
+        self.assertGreater(samples[-1].wait_ms, 8 * SERVICE_TIME * 1000.0 * 0.9)
+
+        result = loadgen.report(args, samples, elapsed)
+        self.assertEqual((result["requests"], result["ok"]), (10, 10))
+        self.assertGreater(result["wait_ms"]["max"], 8 * SERVICE_TIME * 1000.0 * 0.9)
+        self.assertGreater(result["total_ms"]["p50"], 4 * SERVICE_TIME * 1000.0)
+
+    def test_closed_loop_does_not_wait(self):
+        args = arguments()
+        samples, elapsed = asyncio.run(loadgen.run(args, ["q", "busy", "q"], httpx.ASGITransport(app=stub)))
+        self.assertEqual([s.wait_ms for s in samples], [0.0] * 3)
+        self.assertLess(max(s.total_ms for s in samples), 5 * SERVICE_TIME * 1000.0)
+
+        result = loadgen.report(args, samples, elapsed)
+        self.assertEqual((result["ok"], result["rejected"], result["statuses"]), (2, 1, {"200": 2, "429": 1}))
+        self.assertEqual(result["wait_ms"]["max"], 0.0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,71 @@
+import json
+from typing import Any, AsyncIterator, Awaitable, Callable
+
+from api.images import image_url
+from blockz.LLMBlockz import RecStrDict
+from dm050.shellutils import Element, GraphicsElement, HistoryUpdate, PagedTableElement, Progress, ShellError, TableElement, TextElement
+from langutils.metrics import STAGE_SECONDS
+
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+
+# Keeps nginx and similar proxies from holding back the frames until the response is complete.
+STREAMING_HEADERS = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+
+# receives the complete new history of an exchange and returns what is to be sent to the client instead (see api.api.session_delta)
+OnHistory = Callable[[list[RecStrDict]], Awaitable[list[RecStrDict]]]
+
+
+def frame(kind: str, **fields: Any) -> str:
+    """One frame of the stream: a JSON object on a single line, with its kind under "type".
+    Values the JSON encoder does not know (dates, decimals from the database) are sent as their string form.
+    """
+    return json.dumps({"type": kind, **fields}, default=str, ensure_ascii=False) + "\n"
+
+
+def element_fields(item: Element) -> dict[str, Any]:
+    """The frame of an element as a dict, for the frames that carry several elements (see api.batch)."""
+    match item:
+        case TextElement(_content=content):
+            return {"type": "text", "content": content}
+        case GraphicsElement(_content=content, _id=identifier):
+            return {"type": "graphics", "id": identifier, "src": image_url(content)}
+        case PagedTableElement(_content=rows, _id=identifier, _handle=handle, _total_rows=total_rows, _export=export):
+            # the first page of a table kept on the server; the rest comes from /api/tables/{handle}
+            columns = list(rows[0].keys()) if rows else []
+            fields = {"type": "table", "id": identifier, "columns": columns, "rows": rows, "handle": handle, "total_rows": total_rows}
+        case TableElement(_content=rows, _id=identifier, _export=export):
+            fields = {"type": "table", "id": identifier, "columns": list(rows[0].keys()) if rows else [], "rows": rows}
+        case _:
+            raise TypeError(f"Unexpected element {item}")
+    if export is not None:
+        # the full result, from /api/exports/{export}
+        fields["export"] = export
+    return fields
+
+
+def element_frame(item: Element) -> str:
+    fields = element_fields(item)
+    return frame(fields.pop("type"), **fields)
+
+
+async def frame_response(
+    stream: AsyncIterator[Element | Progress | HistoryUpdate],
+    on_history: OnHistory | None = None,
+) -> AsyncIterator[str]:
+    """NDJSON counterpart of api.combine_response: every element, progress report and the final history goes out as a separate frame
+    of type text, table, graphics, progress or history, so that the client can render each one as soon as its line is complete.
+    A ShellError ends the stream with an error frame instead of a broken response.
+    """
+    try:
+        async for item in stream:
+            match item:
+                case HistoryUpdate(history=history):
+                    yield frame("history", history=history if on_history is None else await on_history(history))
+                case Progress(stage=stage, message=message, elapsed_ms=elapsed_ms):
+                    yield frame("progress", stage=stage, message=message, elapsed_ms=elapsed_ms)
+                case _:
+                    with STAGE_SECONDS.time(stage="serialize"):
+                        rendered = element_frame(item)
+                    yield rendered
+    except ShellError as e:
+        yield frame("error", message=str(e))
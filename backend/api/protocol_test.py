@@ -0,0 +1,41 @@
+import asyncio
+import json
+import unittest
+
+from api.protocol import frame_response
+from dm050.shellutils import HistoryUpdate, Progress, ShellError, TableElement, TextElement
+
+
+async def _collect(items, error=None) -> list[dict]:
+    async def stream():
+        for item in items:
+            yield item
+        if error is not None:
+            raise error
+
+    return [json.loads(line) async for line in frame_response(stream())]
+
+
+class TestFrameResponse(unittest.TestCase):
+    def test_one_frame_per_item(self):
+        frames = asyncio.run(
+            _collect(
+                [
+                    Progress("sql", "running SQL", 5),
+                    TextElement("Hello"),
+                    TableElement([{"a": 1, "b": "x"}], "t1"),
+                    HistoryUpdate([{"user": "q"}]),
+                ]
+            )
+        )
+        self.assertEqual([f["type"] for f in frames], ["progress", "text", "table", "history"])
+        self.assertEqual(frames[2]["columns"], ["a", "b"])
+        self.assertEqual(frames[3]["history"], [{"user": "q"}])
+
+    def test_shell_error_becomes_error_frame(self):
+        frames = asyncio.run(_collect([TextElement("partial")], ShellError("gave up")))
+        self.assertEqual(frames[-1], {"type": "error", "message": "gave up"})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,137 @@
+import asyncio
+import json
+import os
+import sqlite3
+import threading
+import uuid
+from collections import OrderedDict
+
+from blockz.LLMBlockz import RecStrDict
+
+
+class UnknownSession(KeyError):
+    """Raised by SessionStore.append() for a session the store does not know (any more) when the caller cannot give its history."""
+
+
+class SessionStore:
+    """Server-side conversation histories keyed by session id, so that clients only send the new question and the session id.
+    The most recently used max_sessions histories are kept in memory. If db_path is given, every delta is also written to an SQLite
+    database, which survives restarts, serves the sessions evicted from memory and is shared by the worker processes of the host: a cached
+    history is only used while it has as many entries as the database.
+    The methods block on the database, where a write may wait for another process to finish its own; the event loop uses acreate(),
+    aload() and aappend(), which run them in a worker thread when there is a database and in place otherwise.
+    """
+
+    def __init__(self, max_sessions: int = 1000, db_path: str | None = None):
+        self.max_sessions = max_sessions
+        self._sessions: OrderedDict[str, list[RecStrDict]] = OrderedDict()
+        self._lock = threading.Lock()
+        self._db: sqlite3.Connection | None = None
+        if db_path:
+            self._db = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("CREATE TABLE IF NOT EXISTS sessions (session_id TEXT PRIMARY KEY, created REAL DEFAULT (julianday('now')))")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS session_entries (session_id TEXT NOT NULL, seq INTEGER NOT NULL, entry TEXT NOT NULL, "
+                "PRIMARY KEY (session_id, seq))"
+            )
+
+    def create(self) -> str:
+        session_id = uuid.uuid4().hex
+        with self._lock:
+            self._remember(session_id, [])
+            if self._db is not None:
+                self._db.execute("INSERT INTO sessions (session_id) VALUES (?)", (session_id,))
+        return session_id
+
+    def load(self, session_id: str) -> list[RecStrDict] | None:
+        """Returns the history of the session or None if there is no such session."""
+        with self._lock:
+            if self._db is None:
+                if session_id not in self._sessions:
+                    return None
+                self._sessions.move_to_end(session_id)
+                return list(self._sessions[session_id])
+            if self._db.execute("SELECT 1 FROM sessions WHERE session_id = ?", (session_id,)).fetchone() is None:
+                return None
+            # other worker processes may have extended the session since it was cached here
+            stored = self._db.execute("SELECT COUNT(*) FROM session_entries WHERE session_id = ?", (session_id,)).fetchone()[0]
+            cached = self._sessions.get(session_id)
+            if cached is not None and len(cached) == stored:
+                self._sessions.move_to_end(session_id)
+                return list(cached)
+            history = self._read(session_id)
+            self._remember(session_id, history)
+            return list(history)
+
+    def _read(self, session_id: str) -> list[RecStrDict]:
+        assert self._db is not None
+        rows = self._db.execute("SELECT entry FROM session_entries WHERE session_id = ? ORDER BY seq", (session_id,)).fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    def append(self, session_id: str, delta: list[RecStrDict], previous: list[RecStrDict] | None = None) -> None:
+        """Appends the entries of the latest exchange to the history of the session. previous is the history the exchange started from:
+        it restores a session that was evicted from memory meanwhile and is not in the database. Without it such a session raises
+        UnknownSession rather than going on with the delta alone.
+        """
+        with self._lock:
+            history = self._sessions.get(session_id)
+            if history is None:
+                if self._db is not None and self._db.execute("SELECT 1 FROM sessions WHERE session_id = ?", (session_id,)).fetchone():
+                    history = self._read(session_id)
+                elif previous is not None:
+                    history = list(previous)
+                else:
+                    raise UnknownSession(session_id)
+                self._remember(session_id, history)
+            known = len(history)
+            history.extend(delta)
+            self._sessions.move_to_end(session_id)
+            if self._db is not None:
+                # IMMEDIATE takes the write lock up front, so that concurrent writers in other processes wait instead of failing
+                self._db.execute("BEGIN IMMEDIATE")
+                try:
+                    created = self._db.execute("INSERT OR IGNORE INTO sessions (session_id) VALUES (?)", (session_id,)).rowcount == 1
+                    base = self._db.execute("SELECT COUNT(*) FROM session_entries WHERE session_id = ?", (session_id,)).fetchone()[0]
+                    # a session restored from previous is written in full
+                    entries = history if created else delta
+                    self._db.executemany(
+                        "INSERT INTO session_entries (session_id, seq, entry) VALUES (?, ?, ?)",
+                        [(session_id, base + i, json.dumps(entry)) for i, entry in enumerate(entries)],
+                    )
+                    self._db.execute("COMMIT")
+                except BaseException:
+                    self._db.execute("ROLLBACK")
+                    raise
+                if not created and base != known:
+                    self._remember(session_id, self._read(session_id))
+
+    async def acreate(self) -> str:
+        if self._db is None:
+            return self.create()
+        return await asyncio.to_thread(self.create)
+
+    async def aload(self, session_id: str) -> list[RecStrDict] | None:
+        if self._db is None:
+            return self.load(session_id)
+        return await asyncio.to_thread(self.load, session_id)
+
+    async def aappend(self, session_id: str, delta: list[RecStrDict], previous: list[RecStrDict] | None = None) -> None:
+        if self._db is None:
+            return self.append(session_id, delta, previous)
+        await asyncio.to_thread(self.append, session_id, delta, previous)
+
+    def _remember(self, session_id: str, history: list[RecStrDict]) -> None:
+        self._sessions[session_id] = history
+        self._sessions.move_to_end(session_id)
+        while len(self._sessions) > self.max_sessions:
+            self._sessions.popitem(last=False)
+
+    def close(self) -> None:
+        if self._db is not None:
+            self._db.close()
+
+
+def create_session_store() -> SessionStore:
+    """Builds the store from the environment: SESSION_CACHE_SIZE (default 1000) sessions in memory, SESSION_DB for the optional SQLite file."""
+    return SessionStore(int(os.getenv('SESSION_CACHE_SIZE', '1000')), os.getenv('SESSION_DB') or None)
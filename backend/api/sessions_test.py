@@ -0,0 +1,86 @@
+import asyncio
+import os
+import sqlite3
+import tempfile
+import unittest
+
+from api.sessions import SessionStore, UnknownSession
+
+
+class TestSessionStore(unittest.TestCase):
+    def test_unknown_session(self):
+        self.assertIsNone(SessionStore().load("nope"))
+
+    def test_append_extends_history(self):
+        store = SessionStore()
+        sid = store.create()
+        store.append(sid, [{"user": "a"}, {"assistant": "b"}])
+        store.append(sid, [{"user": "c"}])
+        self.assertEqual(store.load(sid), [{"user": "a"}, {"assistant": "b"}, {"user": "c"}])
+
+    def test_evicted_session_reloaded_from_db(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            store = SessionStore(max_sessions=1, db_path=os.path.join(tmp, "sessions.db"))
+            first = store.create()
+            store.append(first, [{"user": "a"}])
+            store.append(store.create(), [{"user": "b"}])
+            self.assertEqual(store.load(first), [{"user": "a"}])
+            store.close()
+
+    def test_evicted_session_is_not_restarted_from_the_delta(self):
+        store = SessionStore(max_sessions=1)
+        first = store.create()
+        store.append(first, [{"u": 1}])
+        store.create()
+        with self.assertRaises(UnknownSession):
+            store.append(first, [{"u": 2}])
+        store.append(first, [{"u": 2}], previous=[{"u": 1}])
+        self.assertEqual(store.load(first), [{"u": 1}, {"u": 2}])
+
+    def test_history_extended_by_another_worker(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "sessions.db")
+            first, second = SessionStore(db_path=path), SessionStore(db_path=path)
+            sid = first.create()
+            first.append(sid, [{"user": "a"}])
+            self.assertEqual(second.load(sid), [{"user": "a"}])
+            second.append(sid, [{"assistant": "b"}])
+            self.assertEqual(first.load(sid), [{"user": "a"}, {"assistant": "b"}])
+            first.append(sid, [{"user": "c"}])
+            self.assertEqual(second.load(sid), [{"user": "a"}, {"assistant": "b"}, {"user": "c"}])
+            first.close()
+            second.close()
+
+    def test_waiting_for_the_database_does_not_block_the_loop(self):
+        async def scenario(store: SessionStore, sid: str, other: sqlite3.Connection) -> int:
+            ticks = 0
+
+            async def tick() -> None:
+                nonlocal ticks
+                while True:
+                    ticks += 1
+                    await asyncio.sleep(0.01)
+
+            ticker = asyncio.create_task(tick())
+            # another worker holds the write lock for a while
+            asyncio.get_running_loop().call_later(0.2, other.execute, "COMMIT")
+            await store.aappend(sid, [{"user": "a"}])
+            ticker.cancel()
+            self.assertEqual(await store.aload(sid), [{"user": "a"}])
+            return ticks
+
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "sessions.db")
+            store = SessionStore(db_path=path)
+            sid = store.create()
+            other = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+            other.execute("BEGIN IMMEDIATE")
+            try:
+                self.assertGreater(asyncio.run(scenario(store, sid, other)), 5)
+            finally:
+                other.close()
+                store.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,18 @@
+import os
+import unittest
+
+from bench.startup import profile_import
+
+# well above what the import takes now (about 0.5 s, nearly all of it FastAPI and pydantic) and well below what it took when everything
+# was imported eagerly (over 2 s); STARTUP_BUDGET_MS tightens or loosens it for slower or faster machines
+STARTUP_BUDGET_MS = float(os.getenv("STARTUP_BUDGET_MS", "1500"))
+
+
+class TestStartup(unittest.TestCase):
+    def test_import_within_budget(self):
+        # the best of three runs, so that a busy machine does not fail the test
+        total = min(profile_import("api.api").total_ms for _ in range(3))
+        self.assertLess(total, STARTUP_BUDGET_MS, f"importing api.api took {total:.0f} ms, see python -m bench.startup")
+
+    def test_heavy_modules_loaded_lazily(self):
+        self.assertEqual(profile_import("api.api").heavy_loaded, [])
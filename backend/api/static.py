@@ -0,0 +1,206 @@
+"""Serving of the frontend bundle built by Vite into dist/.
+
+The bundle is compressed once, at build time, by running this module (the Docker image does it after copying dist/):
+
+    python -m api.static [dist] [--min-size 1024]
+
+which writes a .gz (and a .br when the brotli package is installed) next to every compressible file that gets smaller. At run time
+PrecompressedStaticFiles serves /assets picking the variant the client accepts, and IndexPage keeps index.html with its compressed variants
+in memory. Asset names carry a content hash, so they are cached for good; index.html is revalidated on every load (and answered with 304
+when unchanged) so that a deploy reaches the browsers at once.
+"""
+
+import argparse
+import gzip
+import hashlib
+import mimetypes
+import os
+import re
+import threading
+from dataclasses import dataclass
+
+from fastapi import Request
+from starlette.datastructures import Headers
+from starlette.responses import FileResponse, Response
+from starlette.staticfiles import NotModifiedResponse, StaticFiles
+from starlette.types import Scope
+
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+REVALIDATE_CACHE_CONTROL = "no-cache"
+
+# content coding -> file suffix, in order of preference
+ENCODINGS = {"br": ".br", "gzip": ".gz"}
+# already compressed formats, compressing them again only costs time
+INCOMPRESSIBLE = {".br", ".gz", ".png", ".jpg", ".jpeg", ".gif", ".webp", ".avif", ".woff", ".woff2", ".zip"}
+
+# Vite names the chunks and assets [name]-[hash].[ext], the hash being 8 characters of base64url
+_hashed_name = re.compile(r"-[A-Za-z0-9_-]{8}\.[A-Za-z0-9]+$")
+
+
+def is_hashed(name: str) -> bool:
+    return _hashed_name.search(os.path.basename(name)) is not None
+
+
+def accepted_encodings(headers: Headers) -> list[str]:
+    """The encodings of ENCODINGS the client accepts (Accept-Encoding, q=0 excluded), in order of preference."""
+    accepted: set[str] = set()
+    for item in headers.get("accept-encoding", "").split(","):
+        coding, _, params = item.strip().partition(";")
+        q = params.strip()
+        if q.startswith("q=") and q[2:].strip() in ("0", "0.0", "0.00", "0.000"):
+            continue
+        accepted.add(coding.strip().lower())
+    if "*" in accepted:
+        return list(ENCODINGS)
+    return [encoding for encoding in ENCODINGS if encoding in accepted]
+
+
+def _brotli():
+    try:
+        import brotli  # type: ignore[import-not-found]
+    except ImportError:
+        return None
+    return brotli
+
+
+def compress(data: bytes, encoding: str) -> bytes:
+    if encoding == "gzip":
+        # mtime=0 keeps the output identical from one build to the next
+        return gzip.compress(data, compresslevel=9, mtime=0)
+    brotli = _brotli()
+    if brotli is None:
+        raise ValueError("brotli is not installed")
+    return brotli.compress(data, quality=11)
+
+
+def available_encodings() -> list[str]:
+    return [encoding for encoding in ENCODINGS if encoding != "br" or _brotli() is not None]
+
+
+def precompress(directory: str, min_size: int = 1024) -> list[str]:
+    """Writes the compressed variants of every file of the directory worth compressing; returns the paths written."""
+    written: list[str] = []
+    encodings = available_encodings()
+    for root, _, files in os.walk(directory):
+        for name in files:
+            path = os.path.join(root, name)
+            if os.path.splitext(name)[1].lower() in INCOMPRESSIBLE or os.path.getsize(path) < min_size:
+                continue
+            with open(path, "rb") as f:
+                data = f.read()
+            for encoding in encodings:
+                compressed = compress(data, encoding)
+                # a variant that saves little is not worth the header juggling
+                if len(compressed) > len(data) * 0.9:
+                    continue
+                with open(path + ENCODINGS[encoding], "wb") as f:
+                    f.write(compressed)
+                written.append(path + ENCODINGS[encoding])
+    return written
+
+
+class PrecompressedStaticFiles(StaticFiles):
+    """StaticFiles serving the .br or .gz sibling of a file when there is one and the client accepts it, with long-lived caching for
+    hashed names. Conditional requests are answered with 304 by StaticFiles, each variant having its own ETag.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # (path, mtime, size) of a file -> its compressed variants; the bundle only changes with a deploy, i.e. a restart
+        self._variants: dict[tuple[str, int, int], dict[str, tuple[str, os.stat_result]]] = {}
+
+    def variants(self, full_path: str, stat_result: os.stat_result) -> dict[str, tuple[str, os.stat_result]]:
+        key = (full_path, stat_result.st_mtime_ns, stat_result.st_size)
+        found = self._variants.get(key)
+        if found is None:
+            found = {}
+            for encoding, suffix in ENCODINGS.items():
+                try:
+                    found[encoding] = (full_path + suffix, os.stat(full_path + suffix))
+                except OSError:
+                    pass
+            self._variants[key] = found
+        return found
+
+    def file_response(self, full_path, stat_result: os.stat_result, scope: Scope, status_code: int = 200) -> Response:
+        request_headers = Headers(scope=scope)
+        full_path = str(full_path)
+        headers = {"Cache-Control": IMMUTABLE_CACHE_CONTROL if is_hashed(full_path) else REVALIDATE_CACHE_CONTROL}
+        path = full_path
+        variants = self.variants(full_path, stat_result)
+        if variants:
+            headers["Vary"] = "Accept-Encoding"
+            for encoding in accepted_encodings(request_headers):
+                if encoding in variants:
+                    path, stat_result = variants[encoding]
+                    headers["Content-Encoding"] = encoding
+                    break
+        media_type = mimetypes.guess_type(full_path)[0] or "application/octet-stream"
+        response = FileResponse(path, status_code=status_code, headers=headers, media_type=media_type, stat_result=stat_result)
+        if self.is_not_modified(response.headers, request_headers):
+            return NotModifiedResponse(response.headers)
+        return response
+
+
+@dataclass
+class _Representation:
+    body: bytes
+    etag: str
+
+
+class IndexPage:
+    """index.html held in memory, identity and compressed. The compressed variants written at build time are used when present; otherwise
+    the page is compressed (gzip only) when it is first loaded.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._representations: dict[str, _Representation] | None = None
+        self._lock = threading.Lock()
+
+    def _load(self) -> dict[str, _Representation]:
+        with open(self.path, "rb") as f:
+            body = f.read()
+        digest = hashlib.sha256(body).hexdigest()[:32]
+        representations = {"identity": _Representation(body, f'"{digest}"')}
+        for encoding, suffix in ENCODINGS.items():
+            try:
+                with open(self.path + suffix, "rb") as f:
+                    compressed = f.read()
+            except OSError:
+                if encoding != "gzip":
+                    continue
+                compressed = compress(body, encoding)
+            representations[encoding] = _Representation(compressed, f'"{digest}-{suffix[1:]}"')
+        return representations
+
+    def representations(self) -> dict[str, _Representation]:
+        if self._representations is None:
+            with self._lock:
+                if self._representations is None:
+                    self._representations = self._load()
+        return self._representations
+
+    def response(self, request: Request) -> Response:
+        representations = self.representations()
+        encoding = next((e for e in accepted_encodings(request.headers) if e in representations), "identity")
+        chosen = representations[encoding]
+        headers = {"ETag": chosen.etag, "Cache-Control": REVALIDATE_CACHE_CONTROL, "Vary": "Accept-Encoding"}
+        if encoding != "identity":
+            headers["Content-Encoding"] = encoding
+        if chosen.etag in [tag.strip().removeprefix("W/") for tag in request.headers.get("if-none-match", "").split(",")]:
+            return Response(status_code=304, headers=headers)
+        return Response(chosen.body, media_type="text/html", headers=headers)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("directory", nargs="?", default="dist")
+    parser.add_argument("--min-size", type=int, default=1024, help="files smaller than this many bytes are left alone")
+    args = parser.parse_args()
+    written = precompress(args.directory, args.min_size)
+    print(f"{len(written)} compressed variants written with {', '.join(available_encodings())}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,42 @@
+import os
+import tempfile
+import unittest
+
+from starlette.applications import Starlette
+from starlette.datastructures import Headers
+from starlette.routing import Mount
+from starlette.testclient import TestClient
+
+from api.static import IMMUTABLE_CACHE_CONTROL, PrecompressedStaticFiles, accepted_encodings, is_hashed, precompress
+
+
+class TestStatic(unittest.TestCase):
+    def test_accepted_encodings(self):
+        self.assertEqual(accepted_encodings(Headers({"accept-encoding": "gzip, deflate, br"})), ["br", "gzip"])
+        self.assertEqual(accepted_encodings(Headers({"accept-encoding": "br;q=0, gzip;q=0.5"})), ["gzip"])
+        self.assertEqual(accepted_encodings(Headers({})), [])
+
+    def test_hashed_names(self):
+        self.assertTrue(is_hashed("dist/assets/index-B7xq_3Zk.js"))
+        self.assertFalse(is_hashed("dist/assets/logo.svg"))
+
+    def test_precompressed_variant_served_and_revalidated(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            with open(os.path.join(tmp, "index-B7xq_3Zk.js"), "w") as f:
+                f.write("console.log('hello');\n" * 200)
+            self.assertEqual(precompress(tmp)[-1:], [os.path.join(tmp, "index-B7xq_3Zk.js.gz")])
+            client = TestClient(Starlette(routes=[Mount("/assets", PrecompressedStaticFiles(directory=tmp))]))
+
+            response = client.get("/assets/index-B7xq_3Zk.js", headers={"accept-encoding": "gzip"})
+            self.assertEqual(response.headers["content-encoding"], "gzip")
+            self.assertEqual(response.headers["cache-control"], IMMUTABLE_CACHE_CONTROL)
+            self.assertEqual(response.text, "console.log('hello');\n" * 200)
+
+            revalidated = client.get(
+                "/assets/index-B7xq_3Zk.js", headers={"accept-encoding": "gzip", "if-none-match": response.headers["etag"]}
+            )
+            self.assertEqual(revalidated.status_code, 304)
+
+            plain = client.get("/assets/index-B7xq_3Zk.js", headers={"accept-encoding": "identity"})
+            self.assertNotIn("content-encoding", plain.headers)
+            self.assertNotEqual(plain.headers["etag"], response.headers["etag"])
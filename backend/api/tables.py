@@ -0,0 +1,86 @@
+import html
+from datetime import date, datetime
+from decimal import Decimal
+from typing import Any, Callable, Iterable, Iterator
+
+from shell import TableData
+
+Formatter = Callable[[Any], str]
+ColumnFormatter = Callable[[list[Any]], list[str]]
+
+# Rows per chunk handed to the StreamingResponse: large enough to keep the number of writes low, small enough for the browser to start
+# laying out the table before the last row is rendered.
+TABLE_BATCH_ROWS = 200
+
+
+def _escaped(value: Any) -> str:
+    return "" if value is None else html.escape(str(value), quote=False)
+
+
+def _escape_all(values: list[str]) -> list[str]:
+    # one html.escape over the whole column instead of one per cell; the separator cannot occur in the escaped text
+    joined = "\x00".join(values)
+    if joined.count("\x00") != len(values) - 1:
+        return [_escaped(v) for v in values]
+    return html.escape(joined, quote=False).split("\x00")
+
+
+def column_formatter(values: Iterable[Any]) -> ColumnFormatter:
+    """Picks the formatter of a column once, from its first non-empty value, instead of inspecting the type of every cell.
+    Numbers need no escaping, dates are written in ISO format and Decimals in positional notation. Cells that do not match the type of
+    the column (or any other type) are escaped strings.
+    The returned function formats a whole slice of the column; slices holding nothing but the type of the column take a fast path.
+    """
+    sample = next((v for v in values if v is not None), None)
+    fmt: Formatter
+    if isinstance(sample, str):
+        return lambda col: _escape_all(col) if set(map(type, col)) == {str} else [_escaped(v) for v in col]
+    if isinstance(sample, bool) or not isinstance(sample, (int, float, datetime, date, Decimal)):
+        return lambda col: [_escaped(v) for v in col]
+    if isinstance(sample, (int, float)):
+        fmt = str
+    elif isinstance(sample, datetime):
+        fmt = lambda v: v.isoformat(sep=" ")
+    elif isinstance(sample, date):
+        fmt = date.isoformat
+    else:
+        fmt = lambda v: format(v, "f")
+    kind = type(sample)
+
+    def format_column(col: list[Any]) -> list[str]:
+        if set(map(type, col)) == {kind}:
+            return list(map(fmt, col))
+        return [fmt(v) if type(v) is kind else _escaped(v) for v in col]
+
+    return format_column
+
+
+def render_table(table_data: list[dict[str, Any]], batch_rows: int = TABLE_BATCH_ROWS, attributes: dict[str, Any] | None = None) -> Iterator[str]:
+    """Renders a TableElement as HTML in chunks: the header first, then batch_rows rows at a time.
+    Each batch is formatted column by column and assembled with joins, which keeps the work linear in the size of the table.
+    attributes are added to the table tag, escaped.
+    """
+    table_tag = "<table" + "".join(f' {name}="{html.escape(str(value))}"' for name, value in (attributes or {}).items()) + ">"
+    if not table_data:
+        yield table_tag + "</table>"
+        return
+    headers = list(table_data[0].keys())
+    formatters = [column_formatter(row.get(h) for row in table_data) for h in headers]
+
+    yield table_tag + "<tr>" + "".join(f"<th>{html.escape(str(h))}</th>" for h in headers) + "</tr>"
+    for start in range(0, len(table_data), batch_rows):
+        batch = table_data[start : start + batch_rows]
+        cells = [fmt([row.get(h) for row in batch]) for h, fmt in zip(headers, formatters)]
+        yield "".join(["<tr><td>" + "</td><td>".join(row) + "</td></tr>" for row in zip(*cells)])
+    yield "</table>"
+
+
+def table_page(table: TableData, offset: int, limit: int, sort: list[str]) -> dict[str, Any]:
+    """Body of the /api/tables response; raises KeyError for sort keys that are not columns of the table."""
+    return {
+        "id": table.table_id,
+        "columns": table.columns,
+        "total_rows": table.total_rows,
+        "offset": offset,
+        "rows": table.page(offset, limit, sort),
+    }
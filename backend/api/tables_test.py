@@ -0,0 +1,63 @@
+import unittest
+from datetime import date, datetime
+from decimal import Decimal
+
+from api.tables import render_table, table_page
+from shell import TableData
+
+
+class TestRenderTable(unittest.TestCase):
+    def test_empty(self):
+        self.assertEqual("".join(render_table([])), "<table></table>")
+
+    def test_cells_are_escaped(self):
+        html = "".join(render_table([{"a<b": "x & <y>", "n": None}]))
+        self.assertEqual(html, "<table><tr><th>a&lt;b</th><th>n</th></tr><tr><td>x &amp; &lt;y&gt;</td><td></td></tr></table>")
+
+    def test_column_formats(self):
+        rows = [
+            {"d": date(2024, 1, 2), "t": datetime(2024, 1, 2, 3, 4), "m": Decimal("1E+2"), "i": 7},
+            {"d": None, "t": "n/a", "m": Decimal("0.50"), "i": 8},
+        ]
+        html = "".join(render_table(rows))
+        self.assertIn("<tr><td>2024-01-02</td><td>2024-01-02 03:04:00</td><td>100</td><td>7</td></tr>", html)
+        self.assertIn("<tr><td></td><td>n/a</td><td>0.50</td><td>8</td></tr>", html)
+
+    def test_rows_come_in_batches(self):
+        chunks = list(render_table([{"a": i} for i in range(5)], batch_rows=2))
+        self.assertEqual(len(chunks), 1 + 3 + 1)
+        self.assertEqual("".join(chunks).count("<tr>"), 6)
+
+
+class TestTablePage(unittest.TestCase):
+    rows = [{"k": 2, "v": "b"}, {"k": None, "v": "c"}, {"k": 1, "v": "a"}, {"k": 2, "v": "a"}]
+
+    def test_page_in_original_order(self):
+        page = table_page(TableData("t", self.rows), 1, 2, [])
+        self.assertEqual(page["total_rows"], 4)
+        self.assertEqual(page["rows"], self.rows[1:3])
+
+    def test_sort_keys_and_empty_values_last(self):
+        page = table_page(TableData("t", self.rows), 0, 10, ["-k", "v"])
+        self.assertEqual([(r["k"], r["v"]) for r in page["rows"]], [(2, "a"), (2, "b"), (1, "a"), (None, "c")])
+
+    def test_sort_orders_are_normalized_and_bounded(self):
+        table = TableData("t", self.rows)
+        self.assertEqual(table.page(0, 10, ["-k", "v", "k", "-v"]), table.page(0, 10, ["-k", "v"]))
+        self.assertEqual(list(table._orders), [("-k", "v")])
+        keys = ("k", "-k", "v", "-v")
+        sorts = [(first,) for first in keys] + [(first, second) for first in keys for second in keys if first[-1] != second[-1]]
+        for sort in sorts:
+            table.page(0, 1, list(sort))
+            table.page(0, 1, ["-k", "v"])
+        self.assertEqual(len(table._orders), table.max_orders)
+        self.assertIn(("-k", "v"), table._orders)
+        self.assertNotIn(sorts[0], table._orders)
+
+    def test_unknown_sort_column(self):
+        with self.assertRaises(KeyError):
+            table_page(TableData("t", self.rows), 0, 10, ["x"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,108 @@
+import asyncio
+import os
+import time
+from typing import Any, Awaitable, Callable
+
+from loguru import logger
+
+from dm050.setup import DM050Shell
+from langutils.context import SQLContext
+from langutils.llm_tools import warm_up_charts
+
+# a query shaped like the ones the evaluator writes, so that parsing it loads the parts of the T-SQL dialect the requests use
+SAMPLE_SQL = (
+    "SELECT TOP 10 s.stdate AS day, SUM(s.quantity) AS total FROM stocks s WHERE s.stdate >= '2024-01-01' "
+    "GROUP BY s.stdate ORDER BY s.stdate DESC"
+)
+
+
+def warm_up_sql() -> None:
+    """Parses a sample query: the first T-SQL parse builds sqlglot's dialect, tokenizer and parser tables."""
+    import sqlglot
+
+    sqlglot.parse_one(SAMPLE_SQL, dialect="tsql")
+
+
+class Warmup:
+    """Runs the warm-up steps of a worker in the background and tells whether they are over.
+    Until they are, /ready answers 503 and the load balancer keeps real traffic away from the worker. A failing step (OpenAI or the
+    database unreachable for the moment) is logged and reported by /ready but does not keep the worker out of rotation forever: the
+    requests would then fail the same way with or without the warm-up.
+    """
+
+    def __init__(self, timeout: float, connections: int):
+        self.timeout = timeout
+        self.connections = connections
+        # step -> "ok" or the error; filled in as the steps complete
+        self.steps: dict[str, str] = {}
+        self.seconds: dict[str, float] = {}
+        self.started = time.monotonic()
+        self.finished: float | None = None
+        self._task: asyncio.Task[None] | None = None
+
+    @property
+    def ready(self) -> bool:
+        return self.finished is not None
+
+    async def _step(self, name: str, body: Callable[[], Awaitable[Any]]) -> None:
+        start = time.perf_counter()
+        try:
+            await asyncio.wait_for(body(), self.timeout)
+            self.steps[name] = "ok"
+        except asyncio.TimeoutError:
+            self.steps[name] = f"timed out after {self.timeout:g} s"
+        except Exception as e:
+            self.steps[name] = f"{type(e).__name__}: {e}"
+        self.seconds[name] = round(time.perf_counter() - start, 3)
+        if self.steps[name] != "ok":
+            logger.warning("Warm-up step {} failed: {}", name, self.steps[name])
+
+    async def run(self, shell: DM050Shell) -> None:
+        async def database() -> None:
+            if isinstance(shell.context, SQLContext):
+                await shell.context.aprefill(self.connections)
+
+        async def similarity() -> None:
+            await asyncio.to_thread(lambda: shell.tools.similars_cache)
+
+        async def openai() -> None:
+            # the cheapest authenticated call; it opens the pooled TLS connection the first question would otherwise wait for
+            await shell.aclient.models.list()
+
+        # CPU-bound steps one after the other in a worker thread, the network ones concurrently with them
+        async def local() -> None:
+            await self._step("sqlglot", lambda: asyncio.to_thread(warm_up_sql))
+            await self._step("charts", lambda: asyncio.to_thread(warm_up_charts))
+
+        await asyncio.gather(
+            local(),
+            self._step("database", database),
+            self._step("similarity", similarity),
+            self._step("openai", openai),
+        )
+        self.finished = time.monotonic()
+        logger.info("Warm-up done in {:.2f} s: {}", self.finished - self.started, self.steps)
+
+    def start(self, shell: DM050Shell) -> None:
+        self._task = asyncio.create_task(self.run(shell))
+
+    async def stop(self) -> None:
+        if self._task is not None and not self._task.done():
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+
+    def as_dict(self) -> dict[str, Any]:
+        end = self.finished if self.finished is not None else time.monotonic()
+        return {"ready": self.ready, "elapsed_s": round(end - self.started, 3), "steps": self.steps, "seconds": self.seconds}
+
+
+def create_warmup() -> Warmup | None:
+    """The warm-up configured by the environment: WARMUP (1 by default; 0 turns it off and the worker is ready at once), WARMUP_TIMEOUT
+    (seconds allowed to each step, default 30), WARMUP_CONNECTIONS (database connections opened ahead into the pool, default 2).
+    """
+    if os.getenv("WARMUP", "1") == "0":
+        return None
+    return Warmup(float(os.getenv("WARMUP_TIMEOUT", "30")), int(os.getenv("WARMUP_CONNECTIONS", "2")))
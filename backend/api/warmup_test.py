@@ -0,0 +1,41 @@
+import asyncio
+import unittest
+
+from api.warmup import Warmup
+
+
+class FakeModels:
+    async def list(self):
+        raise ConnectionError("unreachable")
+
+
+class FakeClient:
+    models = FakeModels()
+
+
+class FakeTools:
+    similars_cache = [("MOL", "name", "stocks")]
+
+
+class FakeShell:
+    context = None
+    tools = FakeTools()
+    aclient = FakeClient()
+
+
+class TestWarmup(unittest.TestCase):
+    def test_ready_once_every_step_is_over_even_if_one_failed(self):
+        async def scenario():
+            warmup = Warmup(timeout=5, connections=1)
+            warmup.start(FakeShell())  # type: ignore
+            self.assertFalse(warmup.ready)
+            await warmup._task
+            return warmup
+
+        warmup = asyncio.run(scenario())
+        self.assertTrue(warmup.ready)
+        self.assertEqual(
+            warmup.steps,
+            {"sqlglot": "ok", "charts": "ok", "database": "ok", "similarity": "ok", "openai": "ConnectionError: unreachable"},
+        )
+        self.assertTrue(warmup.as_dict()["ready"])
@@ -0,0 +1,148 @@
+import asyncio
+import json
+import time
+from contextlib import suppress
+
+from fastapi import WebSocket, WebSocketDisconnect
+from loguru import logger
+
+from api.admission import ANONYMOUS, AdmissionController, Rejected
+from api.protocol import element_frame, frame
+from api.sessions import SessionStore
+from blockz.LLMBlockz import RecStrDict
+from dm050.setup import DM050Shell
+from dm050.shellutils import Element, HistoryUpdate, Progress, ShellError
+from langutils.metrics import STAGE_SECONDS
+
+# close code of a connection naming a session the server does not know (4000-4999 are left to applications)
+UNKNOWN_SESSION = 4404
+
+
+class Conversation:
+    """The server side of a chat WebSocket: the history and the tables and charts produced so far stay here for the lifetime of the
+    connection, so that the client only sends its new questions. Every exchange is also appended to the session store, which lets a client
+    reconnect to the same session after the connection was lost.
+
+    Client messages are JSON objects: {"type": "question", "query": "..."} asks a question, {"type": "cancel"} abandons the one being
+    answered. The server sends the frames of api.protocol (progress, text, table, graphics, error) as separate messages, opens with
+    {"type": "session", "session_id": ..., "entries": ...} and ends each answer with {"type": "done", "status": ...}, status being answered,
+    failed, cancelled or rejected (the chat admission control turned the question away, see retry_after in the preceding error frame).
+    One question is answered at a time; asking another meanwhile gets an error frame.
+    """
+
+    def __init__(
+        self,
+        websocket: WebSocket,
+        shell: DM050Shell,
+        sessions: SessionStore,
+        admission: AdmissionController,
+        session_id: str,
+        history: list[RecStrDict],
+        user: str = ANONYMOUS,
+    ):
+        self.websocket = websocket
+        self.shell = shell
+        self.sessions = sessions
+        self.admission = admission
+        self.user = user
+        self.session_id = session_id
+        self.history = list(history)
+        self.resources: dict[str, Element] = {}
+        self._answering: asyncio.Task[None] | None = None
+
+    async def send(self, message: str) -> None:
+        await self.websocket.send_text(message.rstrip("\n"))
+
+    async def serve(self) -> None:
+        await self.send(frame("session", session_id=self.session_id, entries=len(self.history)))
+        try:
+            while True:
+                await self.receive(await self.websocket.receive_text())
+        except WebSocketDisconnect:
+            pass
+        finally:
+            await self.cancel()
+
+    async def receive(self, text: str) -> None:
+        try:
+            message = json.loads(text)
+            kind = message.get("type", "question")
+        except (ValueError, AttributeError):
+            await self.send(frame("error", message="Messages must be JSON objects"))
+            return
+        if kind == "cancel":
+            if await self.cancel():
+                await self.send(frame("done", status="cancelled"))
+        elif kind != "question" or not isinstance(message.get("query"), str):
+            await self.send(frame("error", message=f"Unexpected message {text[:200]}"))
+        elif self._answering is not None and not self._answering.done():
+            await self.send(frame("error", message="A question is already being answered"))
+        else:
+            self._answering = asyncio.create_task(self.answer(message["query"]))
+
+    async def cancel(self) -> bool:
+        """Abandons the question being answered, if any; True if there was one."""
+        if self._answering is None or self._answering.done():
+            return False
+        self._answering.cancel()
+        with suppress(asyncio.CancelledError):
+            await self._answering
+        return True
+
+    async def answer(self, query: str) -> None:
+        try:
+            await self.admission.acquire(self.user)
+        except Rejected as e:
+            logger.warning('Chat question rejected: {} ({})', e.reason, e.status_code)
+            await self.send(frame("error", message=e.reason, retry_after=e.retry_after))
+            await self.send(frame("done", status="rejected"))
+            return
+
+        start = time.monotonic()
+        status = "failed"
+        try:
+            stream = self.shell.arequest_stream(query, self.history, self.resources)
+            try:
+                async for item in stream:
+                    match item:
+                        case HistoryUpdate(history=history):
+                            await self.sessions.aappend(self.session_id, history[len(self.history) :], self.history)
+                            self.history = list(history)
+                            status = "answered"
+                        case Progress(stage=stage, message=message, elapsed_ms=elapsed_ms):
+                            await self.send(frame("progress", stage=stage, message=message, elapsed_ms=elapsed_ms))
+                        case _:
+                            with STAGE_SECONDS.time(stage="serialize"):
+                                rendered = element_frame(item)
+                            await self.send(rendered)
+            finally:
+                await stream.aclose()  # type: ignore[attr-defined]
+        except ShellError as e:
+            await self.send(frame("error", message=str(e)))
+        except WebSocketDisconnect:
+            return
+        except Exception as e:
+            # the connection outlives the question; the client is told and may ask the next one
+            logger.exception("Chat question failed")
+            await self.send(frame("error", message=f"Internal error: {type(e).__name__}"))
+        finally:
+            self.admission.release(time.monotonic() - start, self.user)
+        await self.send(frame("done", status=status))
+
+
+async def serve_conversation(
+    websocket: WebSocket,
+    shell: DM050Shell,
+    sessions: SessionStore,
+    admission: AdmissionController,
+    session_id: str | None,
+    user: str = ANONYMOUS,
+) -> None:
+    """Runs a chat WebSocket until the client disconnects. Without session_id the connection starts a new session."""
+    await websocket.accept()
+    if session_id is None:
+        session_id, history = await sessions.acreate(), []
+    elif (history := await sessions.aload(session_id)) is None:
+        await websocket.close(code=UNKNOWN_SESSION, reason="Unknown session")
+        return
+    await Conversation(websocket, shell, sessions, admission, session_id, history, user).serve()
@@ -0,0 +1,54 @@
+import unittest
+
+from fastapi import FastAPI, WebSocket
+from fastapi.testclient import TestClient
+
+from api.admission import AdmissionController
+from api.sessions import SessionStore
+from api.websocket import serve_conversation
+from dm050.shellutils import HistoryUpdate, TextElement
+
+
+class FakeShell:
+    def __init__(self):
+        self.calls = []
+
+    async def arequest_stream(self, req, history, resources):
+        self.calls.append((req, list(history), resources))
+        resources[f"t{len(self.calls)}"] = TextElement(req)
+        yield TextElement(f"answer to {req}")
+        yield HistoryUpdate(history + [{"user": req}, {"assistant": f"answer to {req}"}])
+
+
+class TestConversation(unittest.TestCase):
+    def setUp(self):
+        self.shell = FakeShell()
+        self.sessions = SessionStore()
+        app = FastAPI()
+
+        @app.websocket("/ws")
+        async def ws(websocket: WebSocket, session_id: str | None = None):
+            await serve_conversation(websocket, self.shell, self.sessions, AdmissionController(1, 0, 1), session_id)  # type: ignore
+
+        self.client = TestClient(app)
+
+    def ask(self, ws, query):
+        ws.send_json({"type": "question", "query": query})
+        frames = []
+        while not frames or frames[-1]["type"] != "done":
+            frames.append(ws.receive_json())
+        return frames
+
+    def test_history_and_resources_stay_on_the_server(self):
+        with self.client.websocket_connect("/ws") as ws:
+            session_id = ws.receive_json()["session_id"]
+            self.assertEqual(self.ask(ws, "a"), [{"type": "text", "content": "answer to a"}, {"type": "done", "status": "answered"}])
+            self.ask(ws, "b")
+        (_, first_history, first_resources), (_, second_history, second_resources) = self.shell.calls
+        self.assertEqual(first_history, [])
+        self.assertEqual(second_history, [{"user": "a"}, {"assistant": "answer to a"}])
+        self.assertIs(first_resources, second_resources)
+        self.assertEqual(len(self.sessions.load(session_id) or []), 4)
+
+        with self.client.websocket_connect(f"/ws?session_id={session_id}") as ws:
+            self.assertEqual(ws.receive_json(), {"type": "session", "session_id": session_id, "entries": 4})
@@ -0,0 +1,16 @@
+import statistics
+import time
+from typing import Callable
+
+
+def measure(label: str, iterations: int, body: Callable[[], None]) -> list[float]:
+    """Runs body iterations times and prints mean, median and p95 wall time in milliseconds; returns the sorted timings."""
+    timings: list[float] = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        body()
+        timings.append((time.perf_counter() - start) * 1000.0)
+    timings.sort()
+    p95 = timings[min(len(timings) - 1, int(len(timings) * 0.95))]
+    print(f"{label:<28} mean={statistics.mean(timings):9.3f} ms  p50={statistics.median(timings):9.3f} ms  p95={p95:9.3f} ms")
+    return timings
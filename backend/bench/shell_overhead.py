@@ -0,0 +1,57 @@
+"""Per-request shell overhead: a fresh DM050Shell per chat request (the old behaviour of chat_rq_stream) versus the single
+lifespan-managed instance.
+
+Usage (from the backend directory):
+
+    python -m bench.shell_overhead [--iterations 20] [--with-network]
+
+Without --with-network only object construction is measured (SQL context, similarity cache load when SIMILARITY_QUERY is set,
+OpenAI client and tool handler). With --with-network every iteration also performs one cheap OpenAI round trip, so the cost of new
+connections and TLS handshakes on fresh clients shows up as well. That mode needs a valid OPENAI_API_KEY.
+"""
+
+import argparse
+import os
+import statistics
+
+from dotenv import load_dotenv
+
+from bench import measure
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--iterations", type=int, default=20)
+    parser.add_argument("--with-network", action="store_true", help="include one OpenAI round trip per iteration")
+    args = parser.parse_args()
+
+    load_dotenv()
+    if not args.with_network:
+        # constructing the client does not touch the network, any key will do
+        os.environ.setdefault("OPENAI_API_KEY", "bench")
+
+    from dm050.setup import DM050Shell
+
+    def per_request() -> None:
+        shell = DM050Shell()
+        if args.with_network:
+            shell.client.models.list()
+        shell.close()
+
+    shared = DM050Shell()
+
+    def lifespan_managed() -> None:
+        if args.with_network:
+            shared.client.models.list()
+
+    if args.with_network:
+        shared.client.models.list()  # the lifespan-managed client is warm by the time real traffic arrives
+
+    before = measure("before (shell per request)", args.iterations, per_request)
+    after = measure("after (shared shell)", args.iterations, lifespan_managed)
+    shared.close()
+    print(f"per-request overhead saved: {statistics.mean(before) - statistics.mean(after):.3f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+"""Startup time of the API: imports api.api in fresh interpreters under `python -X importtime` and reports the cumulative import time, the
+most expensive modules, and which of the heavy dependencies (pandas, matplotlib, the OpenAI SDK, ...) were loaded although the application
+only needs them on first use.
+
+Usage (from the backend directory):
+
+    python -m bench.startup [--module api.api] [--runs 5] [--top 15]
+
+api/startup_test.py holds the import to a budget with the same measurement.
+"""
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+from dataclasses import dataclass
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# imported on first use by the application (and preloaded by serve.py), never by importing the API
+HEAVY_MODULES = ("pandas", "numpy", "matplotlib", "openai", "psycopg", "sqlglot", "rapidfuzz")
+
+
+@dataclass
+class ImportProfile:
+    # cumulative import time of the module, in milliseconds
+    total_ms: float
+    # module -> (self, cumulative) in milliseconds, for every module imported on the way
+    modules: dict[str, tuple[float, float]]
+    heavy_loaded: list[str]
+
+    def top(self, count: int) -> list[tuple[str, float, float]]:
+        """The modules taking the longest to import themselves, excluding what they import in turn."""
+        ranked = sorted(self.modules.items(), key=lambda item: item[1][0], reverse=True)
+        return [(name, own, cumulative) for name, (own, cumulative) in ranked[:count]]
+
+
+def profile_import(module: str = "api.api") -> ImportProfile:
+    """Imports the module in a new interpreter, started from the backend directory, and parses the -X importtime report."""
+    probe = f"import sys, {module}; print(','.join(m for m in {HEAVY_MODULES!r} if m in sys.modules))"
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", probe], cwd=BACKEND_DIR, capture_output=True, text=True, check=False
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f"Importing {module} failed:\n{result.stderr[-2000:]}")
+
+    modules: dict[str, tuple[float, float]] = {}
+    for line in result.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        if not line.startswith("import time:"):
+            continue
+        own, cumulative, name = line[len("import time:") :].split("|", 2)
+        if not own.strip().isdigit():
+            continue
+        modules[name.strip()] = (int(own) / 1000.0, int(cumulative) / 1000.0)
+    if module not in modules:
+        raise RuntimeError(f"{module} does not appear in the import time report, was it imported before?")
+    heavy = result.stdout.strip()
+    return ImportProfile(modules[module][1], modules, heavy.split(",") if heavy else [])
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--module", default="api.api")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--top", type=int, default=15)
+    args = parser.parse_args()
+
+    profiles = [profile_import(args.module) for _ in range(args.runs)]
+    totals = sorted(p.total_ms for p in profiles)
+    print(f"import {args.module}: min={totals[0]:.1f} ms  median={statistics.median(totals):.1f} ms  max={totals[-1]:.1f} ms")
+    print(f"heavy modules loaded: {', '.join(profiles[-1].heavy_loaded) or 'none'}")
+    print(f"{'module':<48} {'self ms':>9} {'cumulative ms':>14}")
+    for name, own, cumulative in profiles[-1].top(args.top):
+        print(f"{name:<48} {own:9.1f} {cumulative:14.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+"""HTML rendering of a TableElement: the original convert_table_to_html (string concatenation, no escaping, one string at the end) versus
+api.tables.render_table (escaped, per-column formatters, row batches).
+
+Usage (from the backend directory):
+
+    python -m bench.table_render [--rows 5000] [--columns 20] [--iterations 10]
+
+The generated table mixes text, integers, Decimals and dates, as the results of the DM050 queries do.
+"""
+
+import argparse
+import random
+import statistics
+from datetime import date, timedelta
+from decimal import Decimal
+from typing import Any
+
+from api.tables import render_table
+from bench import measure
+
+
+def legacy_convert_table_to_html(table_data: list[dict[str, Any]]) -> str:
+    """convert_table_to_html as it was in api.api before the chunked renderer."""
+    if not table_data:
+        return "<table></table>"
+    headers = table_data[0].keys()
+    html = "<table><tr>"
+    for header in headers:
+        html += f"<th>{header}</th>"
+    html += "</tr>"
+    for row in table_data:
+        html += "<tr>"
+        for header in headers:
+            html += f"<td>{row[header]}</td>"
+        html += "</tr>"
+    html += "</table>"
+    return html
+
+
+def make_table(rows: int, columns: int) -> list[dict[str, Any]]:
+    rnd = random.Random(42)
+    start = date(2020, 1, 1)
+    makers = [
+        lambda i: f"Item <{i}> & co",
+        lambda i: rnd.randint(0, 10**6),
+        lambda i: Decimal(rnd.randint(0, 10**8)) / 100,
+        lambda i: start + timedelta(days=i % 2000),
+    ]
+    return [{f"col{c}": makers[c % len(makers)](r) for c in range(columns)} for r in range(rows)]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=5000)
+    parser.add_argument("--columns", type=int, default=20)
+    parser.add_argument("--iterations", type=int, default=10)
+    args = parser.parse_args()
+
+    table = make_table(args.rows, args.columns)
+    size = len(legacy_convert_table_to_html(table))
+    print(f"{args.rows} rows x {args.columns} columns, {size / 1024:.0f} KiB of HTML")
+
+    before = measure("before (concatenation)", args.iterations, lambda: legacy_convert_table_to_html(table))
+    after = measure("after (chunked renderer)", args.iterations, lambda: "".join(render_table(table)))
+
+    first_chunk = measure("after, time to first rows", args.iterations, lambda: [next(chunks) for chunks in [render_table(table)] for _ in range(2)])
+    print(f"speedup: {statistics.mean(before) / statistics.mean(after):.2f}x, first rows after {statistics.mean(first_chunk):.3f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,11 @@
+import asyncio
 import json
 import logging
+import time
 from abc import ABC, abstractmethod
 from collections.abc import Mapping
 from dataclasses import dataclass, replace
-from typing import Annotated, Any, Callable, Iterator, Tuple, TypeAlias, cast, final
+from typing import Annotated, Any, AsyncIterator, Awaitable, Callable, Iterator, Tuple, TypeAlias, cast, final
 
 logger = logging.getLogger(__name__)
 logger.addHandler(logging.NullHandler())
@@ -155,6 +157,11 @@ class RawEntry(Entry):
 
 
 ToolFunction: TypeAlias = Callable[[str, Mapping[str, str]], str]
+AsyncToolFunction: TypeAlias = Callable[[str, Mapping[str, str]], Awaitable[str]]
+StepObserver: TypeAlias = Callable[[str, Mapping[str, Any]], None]
+"""Callback through which the tool loops of the a*answer() functions report what they are doing. The first argument is the kind of event:
+'step' (with 'seconds', the time the LLM took to reply, and 'iteration') after every turn, 'toolcalls' (with 'names' and 'iteration')
+before the calls of a reply are evaluated, 'text' when the final, plain answer starts arriving."""
 
 
 @dataclass
@@ -234,6 +241,15 @@ def _evaluate_singletoolcall(toolfunction: ToolFunction, singletoolcall: SingleT
             raise TypeError("ToolCallsReply.evaluate_single_call received a singletoolcall value that is not of SingleToolCall type")
 
 
+async def _aevaluate_singletoolcall(atoolfunction: AsyncToolFunction, singletoolcall: SingleToolCall) -> ToolResultEntry:
+    """Asynchronous counterpart of _evaluate_singletoolcall"""
+    match singletoolcall:
+        case SingleToolCall(call_id=call_id, name=name, paramvalues=paramvalues):
+            return ToolResultEntry(call_id, name, await atoolfunction(name, paramvalues))
+        case _:
+            raise TypeError("ToolCallsReply.aevaluate_single_call received a singletoolcall value that is not of SingleToolCall type")
+
+
 def print_Entry(indent: str, entry: Entry) -> None:
     """Prints the Entry with a general indent of 'indent'"""
     match entry:
@@ -621,6 +637,16 @@ class ToolCallsReply(NonStreamingReply):
         toolresultentries: list[Entry] = [_evaluate_singletoolcall(toolfunction, singletoolcall) for singletoolcall in self.calls]
         return self.lastquery.with_history(self.history() + toolresultentries)
 
+    async def aevaluate(self, atoolfunction: AsyncToolFunction) -> Query:
+        """Asynchronous counterpart of .evaluate(). The calls of one message are independent of each other, so they are awaited concurrently;
+        the tool result entries are still appended in the order of the calls.
+        """
+        logger.debug(f"ToolCallsReply.aevaluate called with atoolfunction={atoolfunction.__qualname__}")
+        toolresultentries: list[Entry] = list(
+            await asyncio.gather(*(_aevaluate_singletoolcall(atoolfunction, singletoolcall) for singletoolcall in self.calls))
+        )
+        return self.lastquery.with_history(self.history() + toolresultentries)
+
 
 def print_NonStreamingReply(indent: str, nonstreamingreply: NonStreamingReply) -> None:
     """Prints a non-streaming reply after an initial indent. (Streaming replies have state, so it is hard to tell what to print about them.)"""
@@ -777,6 +803,102 @@ class StreamingToolCallsReply(StreamingReply):
         return self.lastquery.with_history(self.history() + toolresultentries)
 
 
+class AsyncStreamingTextReply(StreamingReply):
+    """Asynchronous counterpart of StreamingTextReply: the tokens come from an asynchronous iterator, .stream() and .text() are awaited."""
+
+    def __init__(self, lastquery: Query, rootstream: AsyncIterator[str]) -> None:
+        super().__init__(lastquery)
+        self._rootstream: Annotated[AsyncIterator[str], "The stream of tokens-as-strings that resulted from the call"] = rootstream
+        self._textlist: Annotated[list[str], "The list of tokens read from _rootstream so far."] = []
+        self._done: Annotated[bool, "Whether the _rootstream has ended (True) or not (False)"] = False
+
+    @staticmethod
+    def of_text(query: Query, text: str) -> 'AsyncStreamingTextReply':
+        """Creates an AsyncStreamingTextReply from a text."""
+        retval: AsyncStreamingTextReply = AsyncStreamingTextReply(query, _empty_astream())
+        retval._done = True
+        parts: list[str] = text.split(' ')
+        retval._textlist = [part + ' ' for part in parts[:-1]] + [parts[-1]] if parts else []
+        return retval
+
+    async def _progress_to(self, mark: int) -> None:
+        """Same as StreamingTextReply._progress_to, reading the asynchronous _rootstream."""
+        while not self._done and len(self._textlist) <= mark:
+            try:
+                nextchunk: str = await self._rootstream.__anext__()
+                self._textlist.append(nextchunk)
+            except StopAsyncIteration:
+                self._done = True
+                break
+
+    async def stream(self) -> AsyncIterator[str]:
+        """Creates and returns a new asynchronous stream of tokens-as-strings. As with StreamingTextReply.stream(), the streams are
+        independent of each other and all go through the whole output of _rootstream.
+        """
+        mark: int = 0
+        while True:
+            if mark < len(self._textlist):
+                yield self._textlist[mark]
+                mark += 1
+            else:
+                if self._done:
+                    break
+                await self._progress_to(mark)
+                if mark >= len(self._textlist):
+                    break
+
+    async def text(self) -> str:
+        """Returns the text returned with this reply in one chunk, reading the rest of _rootstream if needed."""
+        if not self._done:
+            async for chunk in self._rootstream:
+                self._textlist.append(chunk)
+            self._done = True
+        return "".join(self._textlist)
+
+    async def history(self) -> History:
+        return self.lastquery.history() + [AssistantEntry(await self.text())]
+
+
+class AsyncStreamingToolCallsReply(StreamingReply):
+    """Asynchronous counterpart of StreamingToolCallsReply. The call list is assembled by awaiting callsbuilder."""
+
+    def __init__(self, lastquery: Query, callsbuilder: Callable[[], Awaitable[list[SingleToolCall]]]) -> None:
+        super().__init__(lastquery)
+        self._callsbuilder: Annotated[Callable[[], Awaitable[list[SingleToolCall]]], "The closure that builds the call list."] = callsbuilder
+        self._calls: list[SingleToolCall] | None = None
+
+    async def _get_calls(self) -> list[SingleToolCall]:
+        if self._calls is None:
+            self._calls = await self._callsbuilder()
+        return self._calls
+
+    @staticmethod
+    def of_calls(query: Query, calls: list[SingleToolCall]) -> 'AsyncStreamingToolCallsReply':
+        """Builds an AsyncStreamingToolCallsReply from a list of single calls."""
+
+        async def callsbuilder() -> list[SingleToolCall]:
+            return calls
+
+        return AsyncStreamingToolCallsReply(query, callsbuilder)
+
+    async def history(self) -> History:
+        return self.lastquery.history() + [ToolCallsEntry(await self._get_calls())]
+
+    async def aevaluate(self, atoolfunction: AsyncToolFunction) -> Query:
+        """Asynchronous counterpart of StreamingToolCallsReply.evaluate(); the calls are awaited concurrently."""
+        logger.debug(f"AsyncStreamingToolCallsReply.aevaluate called with atoolfunction={atoolfunction.__qualname__}")
+        calls: list[SingleToolCall] = await self._get_calls()
+        toolresultentries: list[Entry] = list(
+            await asyncio.gather(*(_aevaluate_singletoolcall(atoolfunction, singletoolcall) for singletoolcall in calls))
+        )
+        return self.lastquery.with_history(await self.history() + toolresultentries)
+
+
+async def _empty_astream() -> AsyncIterator[str]:
+    return
+    yield
+
+
 def manual_toolfunction(name: str, params: Mapping[str, str]) -> str:
     """Utility toolfunction meant for debugging. It simply asks for the result of the tool call."""
     return input(f"Evaluate the tool \"{name}\" called on {params}: ")
@@ -787,6 +909,11 @@ def sentinel_toolfunction(name: str, params: Mapping[str, str]) -> str:
     raise LLMBlockzException("No toolfunction provided")
 
 
+async def sentinel_atoolfunction(name: str, params: Mapping[str, str]) -> str:
+    """Asynchronous counterpart of sentinel_toolfunction."""
+    raise LLMBlockzException("No toolfunction provided")
+
+
 ##################################################################################
 
 
@@ -875,6 +1002,113 @@ class LLM(ABC):
                 case _:
                     raise TypeError("Wrong type in LLM.streamanswer")
 
+    async def astep(self, query: Query, temperature: float | None, model: str | None, **kwargs: Any) -> NonStreamingReply:
+        """.astep() is the asynchronous counterpart of .step(). The default implementation runs .step() in a worker thread, LLMs with an
+        asynchronous client are expected to override it.
+        """
+        return await asyncio.to_thread(self.step, query, temperature, model, **kwargs)
+
+    async def aanswer(
+        self,
+        query: Query,
+        temperature: float | None = None,
+        model: str | None = None,
+        atoolfunction: AsyncToolFunction | None = None,
+        cycle_limit: int | None = None,
+        observer: StepObserver | None = None,
+        **kwargs: Any,
+    ) -> TextReply:
+        """.aanswer() is the asynchronous counterpart of .answer(): it keeps awaiting .astep() and evaluates the tool calls via atoolfunction
+        until a final, plain answer is received. The event loop is free to serve other requests while waiting for the LLM or the tools.
+        observer, if set, is notified about the progress of the tool loop.
+        """
+        if temperature is None:
+            raise ValueError("LLM.aanswer() called with temperature=None")
+        if model is None:
+            raise ValueError("LLM.aanswer() called with model=None")
+        if atoolfunction is None:
+            raise ValueError("LLM.aanswer() called with atoolfunction=None")
+        if cycle_limit is None:
+            raise ValueError("LLM.aanswer() called with cycle_limit=None")
+        iterations: int = 0
+        while True:
+            start = time.perf_counter()
+            reply: NonStreamingReply = await self.astep(query, temperature=temperature, model=model, **kwargs)
+            if observer is not None:
+                observer("step", {"seconds": time.perf_counter() - start, "iteration": iterations})
+            match reply:
+                case TextReply():
+                    if observer is not None:
+                        observer("text", {})
+                    return reply
+                case ToolCallsReply():
+                    iterations += 1
+                    if iterations > cycle_limit:
+                        raise LLMBlockzException(f"Cycle limit of {cycle_limit} exceeded")
+                    if observer is not None:
+                        observer("toolcalls", {"names": [call.name for call in reply.calls], "iteration": iterations})
+                    query = await reply.aevaluate(atoolfunction)
+                    continue
+                case _:
+                    raise TypeError("Wrong type in LLM.aanswer")
+
+    async def astreamstep(self, query: Query, temperature: float | None, model: str | None, **kwargs: Any) -> StreamingReply:
+        """.astreamstep() is the asynchronous counterpart of .streamstep(). The default implementation awaits .astep() and wraps the complete
+        reply, LLMs with an asynchronous streaming client are expected to override it.
+        """
+        reply: NonStreamingReply = await self.astep(query, temperature, model, **kwargs)
+        match reply:
+            case TextReply():
+                return AsyncStreamingTextReply.of_text(query, reply.text())
+            case ToolCallsReply():
+                return AsyncStreamingToolCallsReply.of_calls(query, reply.calls)
+            case _:
+                raise TypeError("Wrong type in LLM.astreamstep")
+
+    async def astreamanswer(
+        self,
+        query: Query,
+        temperature: float | None = None,
+        model: str | None = None,
+        atoolfunction: AsyncToolFunction | None = None,
+        cycle_limit: int | None = None,
+        observer: StepObserver | None = None,
+        **kwargs: Any,
+    ) -> AsyncStreamingTextReply:
+        """.astreamanswer() is the asynchronous counterpart of .streamanswer(): tool calls are evaluated via atoolfunction, and the final,
+        plain answer is returned as soon as its first tokens arrive. observer, if set, is notified about the progress of the tool loop.
+        """
+        if temperature is None:
+            raise ValueError("LLM.astreamanswer() called with temperature=None")
+        if model is None:
+            raise ValueError("LLM.astreamanswer() called with model=None")
+        if atoolfunction is None:
+            raise ValueError("LLM.astreamanswer() called with atoolfunction=None")
+        if cycle_limit is None:
+            raise ValueError("LLM.astreamanswer() called with cycle_limit=None")
+        iterations: int = 0
+        while True:
+            start = time.perf_counter()
+            reply: StreamingReply = await self.astreamstep(query, temperature=temperature, model=model, **kwargs)
+            if observer is not None:
+                # for a streamed plain answer this is the time to its first tokens
+                observer("step", {"seconds": time.perf_counter() - start, "iteration": iterations})
+            match reply:
+                case AsyncStreamingTextReply():
+                    if observer is not None:
+                        observer("text", {})
+                    return reply
+                case AsyncStreamingToolCallsReply():
+                    iterations += 1
+                    if iterations > cycle_limit:
+                        raise LLMBlockzException(f"Cycle limit of {cycle_limit} exceeded")
+                    if observer is not None:
+                        observer("toolcalls", {"names": [call.name for call in await reply._get_calls()], "iteration": iterations})
+                    query = await reply.aevaluate(atoolfunction)
+                    continue
+                case _:
+                    raise TypeError("Wrong type in LLM.astreamanswer")
+
 
 #    @abstractmethod
 #    def tokencount(self,target: Query | History | str) -> int:
@@ -1059,16 +1293,28 @@ class OpenAILikeLLM(LLM):
         else:
             return "unknown"
 
-    def __init__(self, client: Any, default_model: str, default_temperature: float = 0.7) -> None:
+    def __init__(
+        self,
+        client: Any,
+        default_model: str,
+        default_temperature: float = 0.7,
+        aclient: Any | None = None,
+        timeout: Callable[[], float | None] | None = None,
+    ) -> None:
         super().__init__()
         logger.debug(
             f"OpenAILikeLLM constructor called with client.base_url={client.base_url}, default_model={default_model} and default_temperature={default_temperature}"
         )
         self._client: Annotated[Any, "An ollama client"] = client
+        self._aclient: Annotated[Any | None, "The asynchronous twin of _client (e.g. AsyncOpenAI), used by the a*() member functions"] = aclient
         self._default_temperature: Annotated[float, "The temperature to be used if not explicitly supplied"] = default_temperature
         self._default_model: Annotated[str, "The model to be used if not explicitly supplied"] = default_model
         self._service_name: Annotated[str, "Service name: openai, azure, ollama, vllm or unknown"] = self._get_service_name(client)
         self._can_stream: Annotated[bool, "Whether the inner client supports streaming"] = self._service_name in ["openai", "azure"]
+        self._timeout: Annotated[
+            Callable[[], float | None] | None,
+            "Called before every completion request for its HTTP timeout in seconds (None: the client's own); may raise to abort the request",
+        ] = timeout
         logger.debug(
             f"OpenAILikeLLM instance created with service={self._service_name}, \
 default_model={default_model},default_temperature={default_temperature}"
@@ -1141,6 +1387,12 @@ default_model={default_model},default_temperature={default_temperature}"
         retval: list[RecStrDict] = combined_list
         return retval
 
+    def _request_options(self) -> dict[str, Any]:
+        """Per-request options of the completion calls: the timeout, when one is given."""
+        if self._timeout is None or (timeout := self._timeout()) is None:
+            return {}
+        return {"timeout": timeout}
+
     def _step(self, query: Query, temperature: float, model: str, **kwargs: Any) -> str | list[SingleToolCall]:
         logger.debug(f"OpenAILikeLLM._step called with temperature={temperature}, model={model}, **kwargs={kwargs} and query={query}")
         tools: list[RecStrDict] = self._format_tools_of(query)
@@ -1149,8 +1401,28 @@ default_model={default_model},default_temperature={default_temperature}"
             messages=self._format_messages_of(query),
             temperature=temperature,
             stream=False,
-            **{**({"tools": tools} if len(tools) > 0 else {}), **kwargs},
+            **{**({"tools": tools} if len(tools) > 0 else {}), **self._request_options(), **kwargs},
         ).choices[0]
+        return self._essence_of(query, response)
+
+    async def _astep(self, query: Query, temperature: float, model: str, **kwargs: Any) -> str | list[SingleToolCall]:
+        logger.debug(f"OpenAILikeLLM._astep called with temperature={temperature}, model={model}, **kwargs={kwargs} and query={query}")
+        if self._aclient is None:
+            raise LLMBlockzException("OpenAILikeLLM._astep called on an instance created without an asynchronous client")
+        tools: list[RecStrDict] = self._format_tools_of(query)
+        response = (
+            await self._aclient.chat.completions.create(
+                model=model,
+                messages=self._format_messages_of(query),
+                temperature=temperature,
+                stream=False,
+                **{**({"tools": tools} if len(tools) > 0 else {}), **self._request_options(), **kwargs},
+            )
+        ).choices[0]
+        return self._essence_of(query, response)
+
+    def _essence_of(self, query: Query, response: Any) -> str | list[SingleToolCall]:
+        """Extracts either the text or the tool calls from the first choice of a non-streaming completion."""
         if (finish_reason := getattr(response, "finish_reason", None)) is None:
             raise LLMBlockzException("LLM did not return a finish_reason when non-streaming.")
         elif finish_reason == "stop":
@@ -1200,6 +1472,19 @@ default_model={default_model},default_temperature={default_temperature}"
             logger.debug(f"Tool call reply is about to be returned from OpenAILikeLLM.step() with calls={essence}")
             return ToolCallsReply(query, essence)
 
+    async def astep(self, query: Query, temperature: float | None = None, model: str | None = None, **kwargs: Any) -> NonStreamingReply:
+        if self._aclient is None:
+            return await super().astep(query, temperature, model, **kwargs)
+        temperature, model, _toolfunction, _cycle_limit = self._resolve_named_parameters(temperature, model, None, None)
+        logger.debug(f"OpenAILikeLLM.astep() called with temperature={temperature}, model={model}, extra arguments={kwargs}\nQuery={query}")
+        essence: str | list[SingleToolCall] = await self._astep(query, temperature, model, **kwargs)
+        if isinstance(essence, str):
+            logger.debug(f"Final reply is about to be returned from OpenAILikeLLM.astep(): {essence}")
+            return TextReply(query, essence)
+        else:  # isinstance(essence,list):
+            logger.debug(f"Tool call reply is about to be returned from OpenAILikeLLM.astep() with calls={essence}")
+            return ToolCallsReply(query, essence)
+
     def _tokenstream_of(self, chunkstream: Iterator[Any], firstmessage: Any) -> Iterator[str]:
         """Stream of string fragments in the case of a plain reply.
         chunkstream is consumed completely."""
@@ -1288,7 +1573,7 @@ default_model={default_model},default_temperature={default_temperature}"
                 messages=self._format_messages_of(query),
                 temperature=temperature,
                 stream=True,
-                **{**({"tools": tools} if len(tools) > 0 else {}), **kwargs},
+                **{**({"tools": tools} if len(tools) > 0 else {}), **self._request_options(), **kwargs},
             )
             while True:
                 firstmessage: Any = next(chunkstream).choices[0]
@@ -1309,6 +1594,103 @@ default_model={default_model},default_temperature={default_temperature}"
             else:  # isinstance(essence,list):
                 return StreamingToolCallsReply.of_calls(query, essence)
 
+    async def _atokenstream_of(self, chunkstream: AsyncIterator[Any], firstmessage: Any) -> AsyncIterator[str]:
+        """Asynchronous counterpart of _tokenstream_of. chunkstream is consumed completely."""
+        nextmessage: Any = firstmessage
+        logger.debug("OpenAILLM._atokenstream_of called")
+        while True:
+            if (
+                (delta_end := getattr(nextmessage, "delta", None)) is not None
+                and (content_end := getattr(delta_end, "content", None)) is not None
+                and isinstance(content_end, str)
+            ):
+                yield content_end
+            if (finish_reason := getattr(nextmessage, "finish_reason", None)) is None:
+                try:
+                    nextmessage = (await chunkstream.__anext__()).choices[0]
+                except StopAsyncIteration:
+                    raise LLMBlockzException(
+                        "Raw stream came to an end in OpenAILLM._atokenstream_of without first seeing finish_reason = 'stop'"
+                    )
+            elif finish_reason == 'stop':
+                logger.debug("finish_reason=stop")
+                break
+            else:
+                raise LLMBlockzException(f"Raw stream yielded finish_reason = {finish_reason}")
+        logger.debug("Proper finish_reason received, emptying stream.")
+        async for _ in chunkstream:
+            pass
+
+    async def _acalls_of(self, query: Query, chunkstream: AsyncIterator[Any], firstmessage: Any) -> list[SingleToolCall]:
+        """Asynchronous counterpart of _calls_of. Completely consumes chunkstream in the process"""
+        collection: dict[int, dict[str, Any]] = dict()
+        nextmessage: Any = firstmessage
+        while True:
+            if (delta_end := getattr(nextmessage, "delta", None)) is not None and (
+                toolcalls_end := getattr(delta_end, "tool_calls", None)
+            ) is not None:
+                for toolcallfragment in toolcalls_end:
+                    self._update_tool_call_item(toolcallfragment, collection)
+            if (finish_reason := getattr(nextmessage, "finish_reason", None)) is None:
+                try:
+                    nextmessage = (await chunkstream.__anext__()).choices[0]
+                except StopAsyncIteration:
+                    raise LLMBlockzException(
+                        "Raw stream came to an end in OpenAILLM._acalls_of without first seeing finish_reason = 'tool_calls'"
+                    )
+            elif finish_reason == "tool_calls":
+                break
+            else:
+                raise LLMBlockzException(f"Raw stream yielded finish_reason = {finish_reason}")
+        async for _ in chunkstream:
+            pass
+        calls: list[SingleToolCall] = []
+        for call in collection.values():
+            if "call_id" not in call or "name" not in call or "argl" not in call:
+                raise LLMBlockzException(f"call in OpenAILLM._acalls_of is missing a required field")
+            calls.append(SingleToolCall(call["call_id"], call["name"], json.loads("".join(call["argl"]))))
+        if not valid_tools_against_calls(query.tools(), calls):
+            raise LLMBlockzException("LLM returned tool calls that do not match the tool declarations")
+        return calls
+
+    async def astreamstep(self, query: Query, temperature: float | None = None, model: str | None = None, **kwargs: Any) -> StreamingReply:
+        if self._aclient is None:
+            return await super().astreamstep(query, temperature, model, **kwargs)
+        temperature, model, _toolfunction, _cycle_limit = self._resolve_named_parameters(temperature, model, None, None)
+        logger.debug(
+            f"OpenAILikeLLM.astreamstep() called with temperature={temperature}, model={model}, extra arguments={kwargs}\nQuery={query}"
+        )
+        tools = self._format_tools_of(query)
+        if self._can_stream:
+            chunkstream = await self._aclient.chat.completions.create(
+                model=model,
+                messages=self._format_messages_of(query),
+                temperature=temperature,
+                stream=True,
+                **{**({"tools": tools} if len(tools) > 0 else {}), **self._request_options(), **kwargs},
+            )
+            while True:
+                try:
+                    firstmessage: Any = (await chunkstream.__anext__()).choices[0]
+                except StopAsyncIteration:
+                    raise LLMBlockzException("Message stream ended without any content")
+                if (delta_end := getattr(firstmessage, "delta", None)) is None:
+                    raise LLMBlockzException("Streamed message has no 'delta' field")
+                if getattr(delta_end, "tool_calls", None) is not None:
+                    return AsyncStreamingToolCallsReply(query, lambda: self._acalls_of(query, chunkstream, firstmessage))
+                if (content_end := getattr(delta_end, "content", None)) is not None and content_end != '':
+                    return AsyncStreamingTextReply(query, self._atokenstream_of(chunkstream, firstmessage))
+                if (finish_reason := getattr(firstmessage, "finish_reason", None)) is None:
+                    continue
+                else:
+                    raise LLMBlockzException(f"Message stream reached finish_reason = {finish_reason} without any content")
+        else:
+            essence: str | list[SingleToolCall] = await self._astep(query, temperature, model, **kwargs)
+            if isinstance(essence, str):
+                return AsyncStreamingTextReply.of_text(query, essence)
+            else:  # isinstance(essence,list):
+                return AsyncStreamingToolCallsReply.of_calls(query, essence)
+
     def answer(
         self,
         query: Query,
@@ -1338,5 +1720,39 @@ default_model={default_model},default_temperature={default_temperature}"
         logger.debug(f"ToolFunction={toolfunction.__qualname__}, cycle_limit={cycle_limit}")
         return super().streamanswer(query, temperature, model, toolfunction, cycle_limit, **kwargs)
 
+    async def aanswer(
+        self,
+        query: Query,
+        temperature: float | None = None,
+        model: str | None = None,
+        atoolfunction: AsyncToolFunction | None = None,
+        cycle_limit: int | None = None,
+        observer: StepObserver | None = None,
+        **kwargs: Any,
+    ) -> TextReply:
+        """Overridden only to provide defaults."""
+        temperature, model, _toolfunction, cycle_limit = self._resolve_named_parameters(temperature, model, None, cycle_limit)
+        atoolfunction = sentinel_atoolfunction if atoolfunction is None else atoolfunction
+        logger.info(f"Calling model {model}, in asynchronous mode, with query {query.last_message()}")
+        logger.debug(f"AsyncToolfunction={atoolfunction.__qualname__}, cycle_limit={cycle_limit}")
+        return await super().aanswer(query, temperature, model, atoolfunction, cycle_limit, observer, **kwargs)
+
+    async def astreamanswer(
+        self,
+        query: Query,
+        temperature: float | None = None,
+        model: str | None = None,
+        atoolfunction: AsyncToolFunction | None = None,
+        cycle_limit: int | None = None,
+        observer: StepObserver | None = None,
+        **kwargs: Any,
+    ) -> AsyncStreamingTextReply:
+        """Overridden only to provide defaults."""
+        temperature, model, _toolfunction, cycle_limit = self._resolve_named_parameters(temperature, model, None, cycle_limit)
+        atoolfunction = sentinel_atoolfunction if atoolfunction is None else atoolfunction
+        logger.info(f"Calling model {model}, in asynchronous streaming mode, with query {query.last_message()}")
+        logger.debug(f"AsyncToolfunction={atoolfunction.__qualname__}, cycle_limit={cycle_limit}")
+        return await super().astreamanswer(query, temperature, model, atoolfunction, cycle_limit, observer, **kwargs)
+
 
 # class OpenAIEmbedding(Embedding):
@@ -0,0 +1,157 @@
+"""Batches of questions answered together, for report packs and regression runs.
+
+The questions run concurrently, at most parallelism at a time, and share what they have in common: the triage of a question asked more than
+once, the result of an SQL query and a chart asked for by several of them are computed once for the whole batch. The results come out as
+the questions are answered, each tagged with the index of its question, so the order is that of completion, not that of the questions.
+"""
+
+import asyncio
+import contextlib
+import logging
+import time
+from dataclasses import dataclass, field
+from typing import Any, AsyncContextManager, AsyncIterator, Callable, Hashable
+
+import blockz.LLMBlockz as lb
+from shell import ImgData, T2SQLTools, TableData
+
+from . import shellutils as su
+from .shell import TriageCache, arequest_stream
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+
+class BatchTools(T2SQLTools):
+    """The tools of a shell with the SQL results and the line charts of the asynchronous path shared by the requests of one batch. Everything
+    else goes to the wrapped tools; the tables and images stay in their caches, so the URLs of the answers work as usual.
+    """
+
+    def __init__(self, tools: T2SQLTools):
+        self.tools = tools
+        self._data: dict[Hashable, asyncio.Future[list[dict[str, str]]]] = {}
+        self._charts: dict[Hashable, asyncio.Future[str]] = {}
+
+    def similar(self, ref: str) -> list[tuple[str, str, str]]:
+        return self.tools.similar(ref)
+
+    def data(self, sql: str) -> list[dict[str, str]]:
+        return self.tools.data(sql)
+
+    async def adata(self, sql: str) -> list[dict[str, str]]:
+        # a copy, so that a request reordering its rows does not reorder those of the others
+        return list(await su.shared(self._data, sql, lambda: self.tools.adata(sql)))
+
+    def piechart(self, sql: str, labelfield: str, valuefield: str) -> str:
+        return self.tools.piechart(sql, labelfield, valuefield)
+
+    def linechart(self, sql: str, xfield: str, ylabel: str, name: str, value: str) -> str:
+        return self.tools.linechart(sql, xfield, ylabel, name, value)
+
+    async def alinechart(self, sql: str, xfield: str, ylabel: str, name: str, value: str) -> str:
+        key = (sql, xfield, ylabel, name, value)
+        return await su.shared(self._charts, key, lambda: self.tools.alinechart(sql, xfield, ylabel, name, value))
+
+    def barchart(self, sql: str, xfield: str, ylabel: str, name: str, value: str) -> str:
+        return self.tools.barchart(sql, xfield, ylabel, name, value)
+
+    def call_function(self, name: str, args: dict[str, object]) -> str:
+        return self.tools.call_function(name, args)
+
+    def get_image(self, name: str) -> ImgData | None:
+        return self.tools.get_image(name)
+
+    def add_table(self, rows: list[dict[str, Any]]) -> TableData | None:
+        return self.tools.add_table(rows)
+
+    def get_table(self, table_id: str) -> TableData | None:
+        return self.tools.get_table(table_id)
+
+    def add_query(self, sql: str) -> str | None:
+        return self.tools.add_query(sql)
+
+    def get_query(self, handle: str) -> str | None:
+        return self.tools.get_query(handle)
+
+
+@dataclass
+class BatchResult:
+    """The answer to the question at index of the batch: the elements and the history when answered, the error otherwise."""
+
+    index: int
+    query: str
+    elements: list[su.Element] = field(default_factory=list)
+    history: list[lb.RecStrDict] | None = None
+    error: str | None = None
+    elapsed_ms: float = 0.0
+
+    @property
+    def status(self) -> str:
+        return "answered" if self.history is not None else "failed"
+
+
+async def _answer(
+    llm: lb.LLM, tools: BatchTools, history: list[lb.RecStrDict], index: int, query: str, triage_cache: TriageCache
+) -> BatchResult:
+    result = BatchResult(index, query)
+    start = time.monotonic()
+    stream = arequest_stream(llm, tools, history, query, triage_cache=triage_cache)
+    try:
+        async for item in stream:
+            match item:
+                case su.HistoryUpdate(history=updated):
+                    result.history = updated
+                case su.Progress():
+                    pass
+                case _:
+                    result.elements.append(item)
+    except su.ShellError as e:
+        result.error = str(e)
+    except Exception as e:
+        # one question going wrong does not take the batch down
+        logger.exception(f"Question #{index} of the batch failed")
+        result.error = f"Internal error: {type(e).__name__}"
+    finally:
+        await stream.aclose()  # type: ignore[attr-defined]
+    result.elapsed_ms = round((time.monotonic() - start) * 1000, 1)
+    return result
+
+
+async def arequest_batch(
+    llm: lb.LLM,
+    tools: T2SQLTools,
+    questions: list[str],
+    history: list[lb.RecStrDict] | None = None,
+    parallelism: int = 4,
+    slot: Callable[[], AsyncContextManager[Any]] | None = None,
+) -> AsyncIterator[BatchResult]:
+    """Answers every question with the same history, at most parallelism at a time, and yields each result as soon as it is complete.
+    slot, if given, is entered around each question: the API takes a chat slot of its admission control there (see
+    api.admission.BatchSlots); a question refused a slot fails with the reason. Closing the generator early cancels the questions still
+    running.
+    """
+    history = history or []
+    batch_tools = BatchTools(tools)
+    triage_cache: TriageCache = {}
+    pending = iter(enumerate(questions))
+    done: asyncio.Queue[BatchResult] = asyncio.Queue()
+
+    async def worker() -> None:
+        # the iterator is shared, every worker takes the next question left
+        for index, query in pending:
+            try:
+                async with slot() if slot is not None else contextlib.nullcontext():
+                    result = await _answer(llm, batch_tools, history, index, query, triage_cache)
+            except Exception as e:
+                # _answer() does not raise: the slot was refused
+                logger.warning(f"Question #{index} of the batch refused: {e}")
+                result = BatchResult(index, query, error=str(e))
+            done.put_nowait(result)
+
+    workers = [asyncio.create_task(worker()) for _ in range(max(1, min(parallelism, len(questions))))]
+    try:
+        for _ in questions:
+            yield await done.get()
+    finally:
+        for task in workers:
+            task.cancel()
@@ -0,0 +1,47 @@
+import asyncio
+import unittest
+
+from .batch import BatchTools
+
+
+class FakeTools:
+    def __init__(self):
+        self.queries: list[str] = []
+
+    async def adata(self, sql):
+        self.queries.append(sql)
+        await asyncio.sleep(0.01)
+        if sql == "bad":
+            raise ValueError("syntax error")
+        return [{"sql": sql}]
+
+
+class TestBatchTools(unittest.TestCase):
+    def test_concurrent_queries_run_once(self):
+        async def scenario():
+            tools = FakeTools()
+            batch_tools = BatchTools(tools)  # type: ignore
+            results = await asyncio.gather(*(batch_tools.adata(sql) for sql in ["a", "b", "a", "a"]))
+            results.append(await batch_tools.adata("a"))
+            return tools.queries, results
+
+        queries, results = asyncio.run(scenario())
+        self.assertEqual(sorted(queries), ["a", "b"])
+        self.assertEqual(results, [[{"sql": "a"}], [{"sql": "b"}], [{"sql": "a"}], [{"sql": "a"}], [{"sql": "a"}]])
+        self.assertIsNot(results[0], results[2])
+
+    def test_failures_are_not_kept(self):
+        async def scenario():
+            tools = FakeTools()
+            batch_tools = BatchTools(tools)  # type: ignore
+            outcomes = await asyncio.gather(batch_tools.adata("bad"), batch_tools.adata("bad"), return_exceptions=True)
+            await asyncio.gather(batch_tools.adata("bad"), return_exceptions=True)
+            return tools.queries, outcomes
+
+        queries, outcomes = asyncio.run(scenario())
+        self.assertEqual(queries, ["bad", "bad"])
+        self.assertTrue(all(isinstance(outcome, ValueError) for outcome in outcomes))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,36 +1,89 @@
-import json
+from typing import TYPE_CHECKING, Any, AsyncContextManager, AsyncIterator, Callable
 
 from blockz.LLMBlockz import OpenAILikeLLM, RecStrDict
+from langutils import deadline
 from langutils.context import SQLContext
 from langutils.llm_tools import ToolsHandler
-from openai import OpenAI
 from shell import ShellWrapper
 
+from . import batch
 from . import shell as dm050
 from . import shellutils as su
 
+if TYPE_CHECKING:
+    from openai import AsyncOpenAI, OpenAI
+
 
 def init_dm050_context() -> SQLContext:
     return SQLContext()
 
 
+def _history(shell_history: str | list[RecStrDict]) -> list[RecStrDict]:
+    """The history of a request, given as the JSON string sent by the client (see su.parse_history) or already parsed."""
+    if isinstance(shell_history, list):
+        return shell_history
+    if (history := su.parse_history(shell_history)) is None:
+        raise ValueError("shell_history is not a JSON list")
+    return history
+
+
 class DM050Tools(ToolsHandler):
     def __init__(self, context):
         super().__init__(context)
 
 
 class DM050Shell(ShellWrapper):
-    def __init__(self):
-        self.context = SQLContext()
-        self.tools = DM050Tools(self.context)
-        self.client = OpenAI()
+    """The shell serving chat requests.
+    Building one is expensive (OpenAI client with its connection pool, similarity cache loaded from the database on first use, image
+    cache), so the API keeps a single instance for the lifetime of the application and every request goes through it. All components are safe to share between
+    threads: the SQL context opens a connection per query, the OpenAI client is thread-safe, the similarity cache is read-only after
+    construction and the image cache is locked.
+    The a*() member functions serve the asynchronous path, which goes through AsyncOpenAI and the pooled async connections of the context.
+    """
+
+    def __init__(
+        self,
+        context: SQLContext | None = None,
+        tools: DM050Tools | None = None,
+        client: "OpenAI | None" = None,
+        aclient: "AsyncOpenAI | None" = None,
+    ):
+        # the OpenAI SDK is the heaviest import of the application, it is loaded with the first shell rather than with the API module
+        from openai import AsyncOpenAI, OpenAI
+
+        self.context = context if context is not None else SQLContext()
+        self.tools = tools if tools is not None else DM050Tools(self.context)
+        self.client = client if client is not None else OpenAI()
+        self.aclient = aclient if aclient is not None else AsyncOpenAI()
         # llm = LangUtils(context)
-        self.llm = OpenAILikeLLM(self.client, "gpt-4.1")
+        # every completion request is bounded by what is left of the deadline of the request it serves
+        self.llm = OpenAILikeLLM(self.client, "gpt-4.1", aclient=self.aclient, timeout=deadline.timeout)
+
+    def close(self) -> None:
+        self.client.close()
+
+    async def aclose(self) -> None:
+        await self.aclient.close()
+        await self.context.aclose()
+        self.close()
 
     def request(self, req: str, shell_history: str) -> tuple[list[su.Element], list[RecStrDict]]:
-        if shell_history == "":
-            history = []
-        else:
-            history = json.loads(shell_history)
+        return dm050.request(self.llm, self.tools, _history(shell_history), req)
+
+    def arequest_stream(
+        self, req: str, shell_history: str | list[RecStrDict], resources: dict[str, su.Element] | None = None
+    ) -> AsyncIterator[su.Element | su.Progress | su.HistoryUpdate]:
+        """shell_history is either the JSON string sent by the client or the already parsed history kept by the server; resources, the
+        tables and charts of earlier requests of the same conversation (see dm050.shell.arequest_stream).
+        """
+        return dm050.arequest_stream(self.llm, self.tools, _history(shell_history), req, resources)
 
-        return dm050.request(self.llm, self.tools, history, req)
+    def arequest_batch(
+        self,
+        questions: list[str],
+        shell_history: str | list[RecStrDict] = "",
+        parallelism: int = 4,
+        slot: Callable[[], AsyncContextManager[Any]] | None = None,
+    ) -> AsyncIterator[batch.BatchResult]:
+        """Answers the questions with the same history, concurrently, yielding each result as it completes (see dm050.batch)."""
+        return batch.arequest_batch(self.llm, self.tools, questions, _history(shell_history), parallelism, slot)
@@ -1,15 +1,25 @@
 import ast
+import asyncio
+import json
 import logging
+from collections.abc import Mapping
 from datetime import date
+from typing import Any, AsyncIterator
 
 import blockz.LLMBlockz as lb
+from langutils import deadline
+from langutils.metrics import DOMAINS, REQUESTS, STAGE_SECONDS, TOOL_CALLS_PER_REQUEST, TRIAGE, WRONG_ANSWERS
 from shell import T2SQLTools
 
 from . import shellutils as su
+from . import triage
 
 logger = logging.getLogger(__name__)
 logger.addHandler(logging.NullHandler())
 
+# the triage replies of requests answered together, by question and history (see arequest_stream)
+TriageCache = dict[str, "asyncio.Future[str]"]
+
 ############################################################
 
 full_tooldict: lb.ToolDict = su.complete_tool_dict
@@ -241,60 +251,276 @@ Today's date is {todays_date}
 """
 
 
-def request(llm: lb.LLM, tools: T2SQLTools, history: list[lb.RecStrDict], req: str) -> tuple[list[su.Element], list[lb.RecStrDict]]:
-    logger.debug(f"request() called with req='{req}'.")
-    lbhistory: lb.History = lb.deserialized_History(history)
-    basequery: lb.Query = lb.Query.empty().with_history(lbhistory)
-    triagequery: lb.Query = (
+sorryanswer = """I am sorry but I am unable to evaluate your request. Reframing the question might help in some cases."""
+
+
+def _triage_query(basequery: lb.Query, req: str) -> lb.Query:
+    return (
         basequery.with_systeminstr(semantic_stage_system_instruction)
         # .with_user(f"What is the data domain of the following request: {req}")
         .with_user(req)
     )
 
-    triagereply: lb.TextReply = llm.answer(triagequery, temperature=0.0)
-    logger.debug(f"Triage returned '{triagereply.text()}'.")
+
+def _parse_triage(triagetext: str) -> str | None:
+    """Turns the reply of the triage stage into the single data domain to be used, or None if no single domain can be determined."""
     try:
-        parsed: list[str] = ast.literal_eval(triagereply.text())
+        parsed: list[str] = ast.literal_eval(triagetext)
         if not isinstance(parsed, list):
-            raise su.ShellError(f"Result '{triagereply.text()}' parses to something else than a Python list-of-strings.")
+            raise su.ShellError(f"Result '{triagetext}' parses to something else than a Python list-of-strings.")
         if not all(isinstance(item, str) for item in parsed):
             raise su.ShellError(f"Not all items in '{parsed}' are strings.")
         parsedset = set(parsed)
         if 'petchem quotations' in parsedset and 'company margins' in parsedset:
             parsedset.discard('petchem quotations')
         if len(parsedset) != 1:
-            sorryanswer = """I am sorry but I am unable to evaluate your request. Reframing the question might help in some cases."""
-            return [su.TextElement(sorryanswer)], lb.serialized_History(lbhistory + [lb.UserEntry(req), lb.AssistantEntry(sorryanswer)])
+            return None
         dom: str = list(parsedset)[0]
         logger.debug(f"Data domain determined to be '{dom}'")
         if dom not in eval_systeminstr_dict:
             raise su.ShellError(f"Domain {dom} is not a valid data domain.")
+        return dom
     except (ValueError, SyntaxError):
-        raise su.ShellError(f"Result '{triagereply.text()}' is not parseable as a Python list-of-strings")
+        raise su.ShellError(f"Result '{triagetext}' is not parseable as a Python list-of-strings")
+
+
+def _classify(req: str, history: list[lb.RecStrDict]) -> str | None:
+    """The domain of the question by the rules of the triage stage (see dm050.triage), given the last question of the history if any;
+    None leaves the decision to the LLM.
+    """
+    previous = next((entry["user"] for entry in reversed(history) if "user" in entry), None)
+    dom = triage.classify(req, previous) if triage.TRIAGE_RULES else None
+    TRIAGE.inc(path="rules" if dom is not None else "llm")
+    if dom is not None:
+        logger.debug(f"Data domain '{dom}' found by the triage rules")
+    return dom
+
+
+class _EvaluatorMetrics:
+    """Collects the per-request numbers of the evaluator loop for langutils.metrics."""
+
+    def __init__(self):
+        self.tool_calls = 0
 
+    def observe(self, kind: str, details: Mapping[str, Any]) -> None:
+        match kind:
+            case "step":
+                STAGE_SECONDS.observe(details["seconds"], stage="evaluator_step")
+            case "toolcalls":
+                self.tool_calls += len(details["names"])
+
+    def counting(self, toolfunction: lb.ToolFunction) -> lb.ToolFunction:
+        """For the synchronous tool loop, which has no observer."""
+
+        def counted(name: str, params: Mapping[str, str]) -> str:
+            self.tool_calls += 1
+            return toolfunction(name, params)
+
+        return counted
+
+    def done(self) -> None:
+        TOOL_CALLS_PER_REQUEST.observe(self.tool_calls)
+
+
+def _observe_domain(dom: str | None) -> None:
+    DOMAINS.inc(domain=dom if dom is not None else "none")
+    if dom is None:
+        REQUESTS.inc(outcome="no_domain")
+
+
+def _evaluator_query(basequery: lb.Query, dom: str, req: str) -> lb.Query:
     eval_systeminstr = evaluation_stage_system_instruction_template.format(
         subdomain_description=eval_systeminstr_dict[dom], todays_date=date.today().isoformat()
     )
-    evaluatorquery: lb.Query = basequery.with_systeminstr(eval_systeminstr).with_tools(full_tooldict).with_user(req)
+    return basequery.with_systeminstr(eval_systeminstr).with_tools(full_tooldict).with_user(req)
+
+
+def request(llm: lb.LLM, tools: T2SQLTools, history: list[lb.RecStrDict], req: str) -> tuple[list[su.Element], list[lb.RecStrDict]]:
+    logger.debug(f"request() called with req='{req}'.")
+    lbhistory: lb.History = lb.deserialized_History(history)
+    basequery: lb.Query = lb.Query.empty().with_history(lbhistory)
+
+    with STAGE_SECONDS.time(stage="triage"):
+        if (dom := _classify(req, history)) is None:
+            triagereply: lb.TextReply = llm.answer(_triage_query(basequery, req), temperature=0.0)
+            logger.debug(f"Triage returned '{triagereply.text()}'.")
+            dom = _parse_triage(triagereply.text())
+    _observe_domain(dom)
+    if dom is None:
+        return [su.TextElement(sorryanswer)], lb.serialized_History(lbhistory + [lb.UserEntry(req), lb.AssistantEntry(sorryanswer)])
+
+    evaluatorquery: lb.Query = _evaluator_query(basequery, dom, req)
 
     evaluator_cycle_count: int = 1
     repcount: int = 1
     while repcount <= evaluator_cycle_count:
         logger.debug(f"Evaluator pass attempt #{repcount} out of {evaluator_cycle_count}")
         resources: dict[str, su.Element] = dict()
+        metrics = _EvaluatorMetrics()
         evaluatorreply: lb.TextReply = llm.answer(
             evaluatorquery,
             temperature=0.25,
-            toolfunction=lambda name, params: su.toolfunction(tools, resources, name, params),
+            toolfunction=metrics.counting(lambda name, params: su.toolfunction(tools, resources, name, params)),
             cycle_limit=5,
         )
+        metrics.done()
         logger.debug(f"Evaluated to '{evaluatorreply.text()}'.")
         try:
             answer: list[su.Element] = su.unparse_answer(resources, evaluatorreply.text())
             logger.debug(f"Successfully finished evaluation pass with unparsed answer={answer}'")
+            REQUESTS.inc(outcome="answered")
             return answer, lb.serialized_History(evaluatorquery.history() + [lb.AssistantEntry(su.textify_elementlist(answer))])
         except su.WrongAnswer as e:
             logger.debug(f"WrongAnswer exception received from evaluation pass: '{e}'")
+            WRONG_ANSWERS.inc(where="answer")
             repcount += 1
 
-    raise su.ShellError(f"No final answer to '{request}' after {evaluator_cycle_count} attempts.")
+    REQUESTS.inc(outcome="failed")
+    raise su.ShellError(f"No final answer to '{req}' after {evaluator_cycle_count} attempts.")
+
+
+async def arequest_stream(
+    llm: lb.LLM,
+    tools: T2SQLTools,
+    history: list[lb.RecStrDict],
+    req: str,
+    resources: dict[str, su.Element] | None = None,
+    triage_cache: TriageCache | None = None,
+    request_deadline: deadline.Deadline | None = None,
+) -> AsyncIterator[su.Element | su.Progress | su.HistoryUpdate]:
+    """Asynchronous, streaming counterpart of request(): waiting for the LLM and the database does not hold a thread. The request is worked
+    on in a separate task that reports its progress (classifying the domain, running SQL, rendering charts, composing the answer) while it
+    goes. The final evaluator turn is streamed and every element of the answer is yielded as soon as the evaluator has closed its JSON
+    object, followed by a single HistoryUpdate at the end.
+    Since elements may already have reached the client, a malformed reply cannot be retried; it raises ShellError instead.
+    The request gets REQUEST_DEADLINE seconds unless request_deadline says otherwise; the deadline bounds the LLM calls, the SQL
+    statements and the charts below (see langutils.deadline) and, once past, ends the stream with a ShellError.
+    Closing the generator early (e.g. because the client went away) cancels the deadline and the work.
+    resources holds the tables and charts made by the tools, by identifier. A conversation passing the same dict on every request lets an
+    answer refer to what an earlier one produced; by default each request starts with none.
+    triage_cache lets requests answered together (see dm050.batch) classify a question asked with the same history only once.
+    """
+    channel = su.EventChannel()
+    request_deadline = request_deadline if request_deadline is not None else deadline.Deadline(deadline.REQUEST_DEADLINE)
+    task = asyncio.create_task(
+        _arequest_into(channel, llm, tools, history, req, resources if resources is not None else {}, triage_cache, request_deadline)
+    )
+    try:
+        async for event in channel:
+            yield event
+    finally:
+        # the threads rendering charts or waiting for the database cannot be cancelled, they see the deadline instead
+        request_deadline.cancel("abandoned")
+        task.cancel()
+
+
+def _observe_evaluator(channel: su.EventChannel, metrics: _EvaluatorMetrics) -> lb.StepObserver:
+    def observer(kind: str, details: Mapping[str, Any]) -> None:
+        metrics.observe(kind, details)
+        match kind:
+            case "toolcalls":
+                channel.progress("tools", f"calling {', '.join(details['names'])}")
+            case "text":
+                channel.progress("composing", "composing answer")
+
+    return observer
+
+
+async def _arequest_into(
+    channel: su.EventChannel,
+    llm: lb.LLM,
+    tools: T2SQLTools,
+    history: list[lb.RecStrDict],
+    req: str,
+    resources: dict[str, su.Element],
+    triage_cache: TriageCache | None,
+    request_deadline: deadline.Deadline,
+) -> None:
+    try:
+        with deadline.scope(request_deadline), STAGE_SECONDS.time(stage="request"):
+            try:
+                work = _arequest_stream(channel, llm, tools, history, req, resources, triage_cache)
+                await asyncio.wait_for(work, request_deadline.remaining())
+            except asyncio.TimeoutError:
+                raise request_deadline.exceeded()
+        channel.close()
+    except asyncio.CancelledError:
+        REQUESTS.inc(outcome="cancelled")
+        raise
+    except deadline.RequestAborted as e:
+        REQUESTS.inc(outcome="timeout" if isinstance(e, deadline.DeadlineExceeded) else "cancelled")
+        channel.close(su.ShellError(str(e)))
+    except Exception as e:
+        REQUESTS.inc(outcome="failed")
+        channel.close(e)
+
+
+async def _atriage(llm: lb.LLM, query: lb.Query, history: list[lb.RecStrDict], req: str, triage_cache: TriageCache | None) -> str:
+    """The text of the triage reply. With a cache, the first request asking a question starts the triage and the others wait for it."""
+
+    async def triage() -> str:
+        return (await llm.aanswer(query, temperature=0.0)).text()
+
+    if triage_cache is None:
+        return await triage()
+    return await su.shared(triage_cache, json.dumps([history, req], default=str, sort_keys=True), triage)
+
+
+async def _arequest_stream(
+    channel: su.EventChannel,
+    llm: lb.LLM,
+    tools: T2SQLTools,
+    history: list[lb.RecStrDict],
+    req: str,
+    resources: dict[str, su.Element],
+    triage_cache: TriageCache | None = None,
+) -> None:
+    logger.debug(f"arequest_stream() called with req='{req}'.")
+    lbhistory: lb.History = lb.deserialized_History(history)
+    basequery: lb.Query = lb.Query.empty().with_history(lbhistory)
+
+    channel.progress("classifying", "classifying domain")
+    with STAGE_SECONDS.time(stage="triage"):
+        if (dom := _classify(req, history)) is None:
+            triagetext: str = await _atriage(llm, _triage_query(basequery, req), history, req, triage_cache)
+            logger.debug(f"Triage returned '{triagetext}'.")
+            dom = _parse_triage(triagetext)
+    _observe_domain(dom)
+    if dom is None:
+        channel.publish(su.TextElement(sorryanswer))
+        channel.publish(su.HistoryUpdate(lb.serialized_History(lbhistory + [lb.UserEntry(req), lb.AssistantEntry(sorryanswer)])))
+        return
+    channel.progress("classifying", f"domain: {dom}")
+
+    evaluatorquery: lb.Query = _evaluator_query(basequery, dom, req)
+    metrics = _EvaluatorMetrics()
+    evaluatorreply: lb.AsyncStreamingTextReply = await llm.astreamanswer(
+        evaluatorquery,
+        temperature=0.25,
+        atoolfunction=lambda name, params: su.atoolfunction(tools, resources, name, params, channel.progress),
+        cycle_limit=5,
+        observer=_observe_evaluator(channel, metrics),
+    )
+    metrics.done()
+    parser = su.ItemStreamParser()
+    answer: list[su.Element] = []
+    try:
+        async for chunk in evaluatorreply.stream():
+            for rawelem in parser.feed(chunk):
+                element: su.Element = su.unparse_item(resources, rawelem)
+                answer.append(element)
+                channel.publish(element)
+        if not parser.done():
+            if parser.started():
+                raise su.WrongAnswer("The 'items' list of the answer was not closed")
+            # no 'items' list in sight, let the non-incremental parser have a go at the whole reply (and report what is wrong with it)
+            for element in su.unparse_answer(resources, await evaluatorreply.text()):
+                answer.append(element)
+                channel.publish(element)
+    except su.WrongAnswer as e:
+        logger.debug(f"WrongAnswer exception received from streamed evaluation pass: '{e}'")
+        WRONG_ANSWERS.inc(where="answer")
+        raise su.ShellError(f"No final answer to '{req}': {e.msg}")
+    logger.debug(f"Successfully finished streamed evaluation pass with answer={answer}'")
+    REQUESTS.inc(outcome="answered")
+    channel.publish(su.HistoryUpdate(lb.serialized_History(evaluatorquery.history() + [lb.AssistantEntry(su.textify_elementlist(answer))])))
@@ -1,18 +1,24 @@
+import asyncio
 import json
 import logging
+import os
 import re
+import time
 import uuid
 from collections.abc import Mapping
-from dataclasses import dataclass
-from typing import Any
+from dataclasses import dataclass, field
+from typing import Any, AsyncIterator, Awaitable, Callable, Hashable, TypeVar
 
 import blockz.LLMBlockz as lb
-import sqlglot
+from langutils.metrics import STAGE_SECONDS, TOOL_CALLS, WRONG_ANSWERS
 from shell import T2SQLTools
 
 logger = logging.getLogger(__name__)
 logger.addHandler(logging.NullHandler())
 
+K = TypeVar("K", bound=Hashable)
+T = TypeVar("T")
+
 
 def safe_json_parse(text: str) -> Any:
     try:
@@ -76,6 +82,8 @@ class TableElement(Element):
 
     _content: list[dict[str, Any]]
     _id: str
+    # handle of the SQL of the table, for exporting its full result through /api/exports/{_export}
+    _export: str | None = field(default=None, kw_only=True)
 
     def __repr__(self) -> str:
         return f"""TableElement(_content={self._content}, _id={self._id})"""
@@ -84,6 +92,19 @@ class TableElement(Element):
         return self._content
 
 
+@dataclass
+class PagedTableElement(TableElement):
+    """A table too large to be sent whole: the content is its first page, the rest is paged from the snapshot kept by the tools under
+    _handle through /api/tables/{_handle}.
+    """
+
+    _handle: str
+    _total_rows: int
+
+    def __repr__(self) -> str:
+        return f"PagedTableElement(_id={self._id}, _handle={self._handle}, _total_rows={self._total_rows})"
+
+
 def textify_elementlist(elist: list[Element]) -> str:
     outelems: list[str] = []
     for elem in elist:
@@ -172,10 +193,13 @@ with open(current_file_path / "imperative-dd.txt") as f:
     domain_description = f.read()
 
 
+@STAGE_SECONDS.time(stage="validate_sql")
 def validate_sql(sql: str, fields: list[str]) -> None:
     """Checks if the 'sql' param contains an sql command starting with 'select' and not ending in 'for update'
     Also checks if the fields in the 'fields' list appear in the string, or possibly as
     """
+    import sqlglot
+
     sql = sql.replace('\\n', ' ')
     ast = sqlglot.parse_one(sql, dialect='tsql')
     if ast.key != 'select':
@@ -203,22 +227,63 @@ def validate_sql(sql: str, fields: list[str]) -> None:
 #    return lowersql.startswith('select') and not lowersql.endswith('for update') and all(field in sql for field in fields) # imperfect, will do sqlparse
 
 
+# tables above TABLE_INLINE_CELLS cells are kept on the server and only their first TABLE_FIRST_PAGE_ROWS rows go out with the answer;
+# above TABLE_MAX_CELLS cells the result is refused, as all of it is held in memory
+TABLE_INLINE_CELLS = 5000
+TABLE_MAX_CELLS = int(os.getenv("TABLE_MAX_CELLS", "1000000"))
+TABLE_FIRST_PAGE_ROWS = 100
+
+
+def _register_table(tools: T2SQLTools, resources: dict[str, Element], contents: list[dict[str, Any]], sql: str) -> str:
+    logger.debug(f"tools.data returned {len(contents)} rows.")
+    cells = len(contents) * len(contents[0]) if contents else 0
+    identifier = str(uuid.uuid4())[-12:]
+    if cells <= TABLE_INLINE_CELLS:
+        resources[identifier] = TableElement(contents, identifier, _export=tools.add_query(sql))
+        return f'{{"status":"success","identifier":"{identifier}"}}'
+    if cells <= TABLE_MAX_CELLS and (table := tools.add_table(contents)) is not None:
+        logger.debug(f"Result set of {len(contents)} rows by {len(contents[0])} columns kept as table {table.table_id}.")
+        resources[identifier] = PagedTableElement(
+            contents[:TABLE_FIRST_PAGE_ROWS], identifier, table.table_id, table.total_rows, _export=tools.add_query(sql)
+        )
+        return f'{{"status":"success","identifier":"{identifier}"}}'
+    logger.debug(f"Too much data in result set: {len(contents)} rows by {len(contents[0])} columns.")
+    return f"Too much data returned ({len(contents)} rows with {len(contents[0])} fields each), try something else."
+
+
+def _register_graphics(resources: dict[str, Element], graph: str) -> str:
+    identifier = str(uuid.uuid4())[-12:]
+    resources[identifier] = GraphicsElement(graph, identifier)
+    return f'{{"status":"success","identifier":"{identifier}"}}'
+
+
+def _data_result(res: list[dict[str, Any]]) -> str:
+    if len(res) > 0 and len(res) * len(res[0]) > 500:
+        logger.debug(f"Too much data in result set: {len(res)} rows by {len(res[0])} columns.")
+        return f"Too much data returned ({len(res)} rows with {len(res[0])} fields each), try something else."
+    else:
+        return str(res)
+
+
+def _tool_label(name: str) -> str:
+    # the name comes from the LLM; keep the label set of the metrics bounded
+    return name if name in complete_tool_dict else "unknown"
+
+
 def toolfunction(tools: T2SQLTools, resources: dict[str, Element], name: str, params: Mapping[str, str]) -> str:
     logger.debug(f"Toolfunction called with name={name} and params={params}.")
+    TOOL_CALLS.inc(tool=_tool_label(name))
+    with STAGE_SECONDS.time(stage="tool"):
+        return _toolfunction(tools, resources, name, params)
+
+
+def _toolfunction(tools: T2SQLTools, resources: dict[str, Element], name: str, params: Mapping[str, str]) -> str:
     try:
         match name:
             case "create_table":
                 validate_sql(params["sql"], [])
                 logger.debug(f"Calling tools.data with sql='{prefix + params['sql']}'")
-                contents: list[dict[str, Any]] = tools.data(prefix + params["sql"])
-                logger.debug(f"tools.data returned {len(contents)} rows.")
-                if len(contents) > 0 and len(contents) * len(contents[0]) > 5000:
-                    logger.debug(f"Too much data in result set: {len(contents)} rows by {len(contents[0])} columns.")
-                    return f"Too much data returned ({len(contents)} rows with {len(contents[0])} fields each), try something else."
-                else:
-                    identifier = str(uuid.uuid4())[-12:]
-                    resources[identifier] = TableElement(contents, identifier)
-                    return f'{{"status":"success","identifier":"{identifier}"}}'
+                return _register_table(tools, resources, tools.data(prefix + params["sql"]), prefix + params["sql"])
             case "line_chart":
                 validate_sql(params["sql"], [params["xfield"], params["labelfield"], params["valuefield"]])
                 logger.debug(
@@ -227,9 +292,7 @@ def toolfunction(tools: T2SQLTools, resources: dict[str, Element], name: str, pa
                 graph: str = tools.linechart(
                     prefix + params["sql"], params["xfield"], params["ylabel"], params["labelfield"], params["valuefield"]
                 )
-                identifier = str(uuid.uuid4())[-12:]
-                resources[identifier] = GraphicsElement(graph, identifier)
-                return f'{{"status":"success","identifier":"{identifier}"}}'
+                return _register_graphics(resources, graph)
             case "similar":
                 logger.debug(f"Calling tools.similar with ref={params['reference']}")
                 hits: str = str(tools.similar(params["reference"]))
@@ -237,15 +300,74 @@ def toolfunction(tools: T2SQLTools, resources: dict[str, Element], name: str, pa
             case "get_data":
                 validate_sql(params["sql"], [])
                 logger.debug(f"Calling tools.data with sql={params['sql']}")
-                res: list[dict[str, Any]] = tools.data(prefix + params["sql"])
-                if len(res) > 0 and len(res) * len(res[0]) > 500:
-                    logger.debug(f"Too much data in result set: {len(res)} rows by {len(res[0])} columns.")
-                    return f"Too much data returned ({len(res)} rows with {len(res[0])} fields each), try something else."
-                else:
-                    return str(res)
+                return _data_result(tools.data(prefix + params["sql"]))
             case _:
+                WRONG_ANSWERS.inc(where="tool")
                 raise WrongAnswer(f"Unknown tool {name} called with parameters {params}.")
     except ShellError as e:
+        WRONG_ANSWERS.inc(where="tool")
+        raise WrongAnswer(str(e))
+
+
+ProgressFunction = Callable[[str, str], None]
+"""Receives the stage and the human readable message of a progress event."""
+
+
+def _no_progress(stage: str, message: str) -> None:
+    pass
+
+
+async def _adata(tools: T2SQLTools, sql: str, progress: ProgressFunction) -> list[dict[str, Any]]:
+    progress("sql", "running SQL")
+    result: list[dict[str, Any]] = await tools.adata(sql)
+    progress("sql", f"running SQL ({len(result)} rows)")
+    return result
+
+
+async def atoolfunction(
+    tools: T2SQLTools, resources: dict[str, Element], name: str, params: Mapping[str, str], progress: ProgressFunction = _no_progress
+) -> str:
+    """Asynchronous counterpart of toolfunction: database access and chart rendering do not block the event loop.
+    What the tool is doing is reported through progress.
+    """
+    logger.debug(f"Async toolfunction called with name={name} and params={params}.")
+    TOOL_CALLS.inc(tool=_tool_label(name))
+    with STAGE_SECONDS.time(stage="tool"):
+        return await _atoolfunction(tools, resources, name, params, progress)
+
+
+async def _atoolfunction(
+    tools: T2SQLTools, resources: dict[str, Element], name: str, params: Mapping[str, str], progress: ProgressFunction
+) -> str:
+    try:
+        match name:
+            case "create_table":
+                validate_sql(params["sql"], [])
+                sql = prefix + params["sql"]
+                logger.debug(f"Calling tools.adata with sql='{sql}'")
+                return _register_table(tools, resources, await _adata(tools, sql, progress), sql)
+            case "line_chart":
+                validate_sql(params["sql"], [params["xfield"], params["labelfield"], params["valuefield"]])
+                logger.debug(
+                    f"Calling tools.alinechart with sql={prefix+params['sql']}, xfield={params['xfield']}, ylabel={params['ylabel']}, labelfield={params['labelfield']}, valuefield={params['valuefield']}"
+                )
+                progress("chart", "rendering chart")
+                graph: str = await tools.alinechart(
+                    prefix + params["sql"], params["xfield"], params["ylabel"], params["labelfield"], params["valuefield"]
+                )
+                return _register_graphics(resources, graph)
+            case "similar":
+                logger.debug(f"Calling tools.similar with ref={params['reference']}")
+                return str(tools.similar(params["reference"]))
+            case "get_data":
+                validate_sql(params["sql"], [])
+                logger.debug(f"Calling tools.adata with sql={params['sql']}")
+                return _data_result(await _adata(tools, prefix + params["sql"], progress))
+            case _:
+                WRONG_ANSWERS.inc(where="tool")
+                raise WrongAnswer(f"Unknown tool {name} called with parameters {params}.")
+    except ShellError as e:
+        WRONG_ANSWERS.inc(where="tool")
         raise WrongAnswer(str(e))
 
 
@@ -285,6 +407,43 @@ def extract_json_from_text(text: str) -> dict[Any, Any] | None:
         return None
 
 
+def unparse_item(resources: dict[str, Element], rawelem: Any) -> Element:
+    """Turns a single element of the 'items' list of the evaluator reply into an Element"""
+    logger.debug(f"Processing element {rawelem}.")
+    if not isinstance(rawelem, dict):
+        raise WrongAnswer("Element not a dictionary")
+    if "type" not in rawelem:
+        raise WrongAnswer("Field 'type' missing")
+    match rawelem["type"]:
+        case "text":
+            if "text" not in rawelem or not isinstance(rawelem["text"], str):
+                raise WrongAnswer("Type is text but no 'text' field with string type avaliable")
+            else:
+                return TextElement(rawelem["text"])
+        case "graphics":
+            if "graphics" not in rawelem:
+                raise WrongAnswer(f"Type is 'graphics' but no 'graphics' field is present in '{rawelem}'")
+            if rawelem["graphics"] not in resources:
+                raise WrongAnswer(f"Graphics field is present in {rawelem} but does not point to anything in resources.")
+            if not isinstance(resources[rawelem["graphics"]], GraphicsElement):
+                raise WrongAnswer(f"Graphics field in {rawelem} points to a resource that is not a GraphicsElement")
+            else:
+                return resources[rawelem["graphics"]]
+        case "table":
+            if "table" not in rawelem:
+                raise WrongAnswer(f"Type is 'table' but no 'table' field is present in '{rawelem}'")
+            elif rawelem["table"] not in resources:
+                raise WrongAnswer(
+                    f"Table field {rawelem['table']} is present in '{rawelem}' but does not point to anything in resources."
+                )
+            elif not isinstance(resources[rawelem["table"]], TableElement):
+                raise WrongAnswer(f"Table field {rawelem['table']} in '{rawelem}' points to a resource that is not a TableElement")
+            else:
+                return resources[rawelem["table"]]
+        case _:
+            raise WrongAnswer(f"Unexpected value of 'type' field in {rawelem}")
+
+
 def unparse_answer(resources: dict[str, Element], answerstring: str) -> list[Element]:
     logger.debug(f"unparse_answer called with answerstring='{answerstring}' and resources={resources}")
     if not (evaluatorresult := extract_json_from_text(answerstring)):
@@ -293,39 +452,153 @@ def unparse_answer(resources: dict[str, Element], answerstring: str) -> list[Ele
         raise WrongAnswer(f"'items' not a member of the result")
     if not isinstance(evaluatorresult["items"], list):
         raise WrongAnswer(f"Result {evaluatorresult['items']} is not a JSON list")
-    retval: list[Element] = []
-    for rawelem in evaluatorresult["items"]:
-        logger.debug(f"Processing element {rawelem}.")
-        if not isinstance(rawelem, dict):
-            raise WrongAnswer("Element not a dictionary")
-        if "type" not in rawelem:
-            raise WrongAnswer("Field 'type' missing")
-        match rawelem["type"]:
-            case "text":
-                if "text" not in rawelem or not isinstance(rawelem["text"], str):
-                    raise WrongAnswer("Type is text but no 'text' field with string type avaliable")
-                else:
-                    retval.append(TextElement(rawelem["text"]))
-            case "graphics":
-                if "graphics" not in rawelem:
-                    raise WrongAnswer(f"Type is 'graphics' but no 'graphics' field is present in '{rawelem}'")
-                if rawelem["graphics"] not in resources:
-                    raise WrongAnswer(f"Graphics field is present in {rawelem} but does not point to anything in resources.")
-                if not isinstance(resources[rawelem["graphics"]], GraphicsElement):
-                    raise WrongAnswer(f"Graphics field in {rawelem} points to a resource that is not a GraphicsElement")
-                else:
-                    retval.append(resources[rawelem["graphics"]])
-            case "table":
-                if "table" not in rawelem:
-                    raise WrongAnswer(f"Type is 'table' but no 'table' field is present in '{rawelem}'")
-                elif rawelem["table"] not in resources:
-                    raise WrongAnswer(
-                        f"Table field {rawelem['table']} is present in '{rawelem}' but does not point to anything in resources."
-                    )
-                elif not isinstance(resources[rawelem["table"]], TableElement):
-                    raise WrongAnswer(f"Table field {rawelem['table']} in '{rawelem}' points to a resource that is not a TableElement")
-                else:
-                    retval.append(resources[rawelem["table"]])
-            case _:
-                raise WrongAnswer(f"Unexpected value of 'type' field in {rawelem}")
-    return retval
+    return [unparse_item(resources, rawelem) for rawelem in evaluatorresult["items"]]
+
+
+_items_start = re.compile(r'"items"\s*:\s*\[')
+
+
+class ItemStreamParser:
+    """Incremental parser of the {"items": [...]} reply of the evaluator.
+    The reply is fed chunk by chunk as it streams in, and feed() returns the elements of the 'items' list whose JSON object has been closed
+    so far. Anything before the list (e.g. a markdown code fence) and after it is ignored; check .done() at the end of the stream to find out
+    whether the list has been closed properly.
+    """
+
+    def __init__(self) -> None:
+        self._text: str = ""
+        self._pos: int = 0
+        self._state: str = "seek"  # seek -> array <-> item -> done
+        self._start: int = 0
+        self._depth: int = 0
+        self._in_string: bool = False
+        self._escaped: bool = False
+
+    def done(self) -> bool:
+        return self._state == "done"
+
+    def started(self) -> bool:
+        return self._state != "seek"
+
+    def feed(self, chunk: str) -> list[Any]:
+        self._text += chunk
+        completed: list[Any] = []
+        if self._state == "seek":
+            # the opening of the list may be split between chunks, so look back a little
+            if (match := _items_start.search(self._text, max(0, self._pos - 16))) is None:
+                self._pos = len(self._text)
+                return completed
+            self._pos = match.end()
+            self._state = "array"
+        text = self._text
+        while self._pos < len(text) and self._state != "done":
+            c = text[self._pos]
+            if self._state == "array":
+                if c == "{":
+                    self._state, self._start, self._depth = "item", self._pos, 1
+                elif c == "]":
+                    self._state = "done"
+                elif not (c.isspace() or c == ","):
+                    raise WrongAnswer("Element not a dictionary")
+            elif self._in_string:
+                if self._escaped:
+                    self._escaped = False
+                elif c == "\\":
+                    self._escaped = True
+                elif c == '"':
+                    self._in_string = False
+            elif c == '"':
+                self._in_string = True
+            elif c in "{[":
+                self._depth += 1
+            elif c in "}]":
+                self._depth -= 1
+                if self._depth == 0:
+                    try:
+                        completed.append(json.loads(text[self._start : self._pos + 1]))
+                    except json.JSONDecodeError as e:
+                        raise WrongAnswer(f"Element '{text[self._start : self._pos + 1]}' is not valid JSON: {e}")
+                    self._state = "array"
+            self._pos += 1
+        return completed
+
+
+def parse_history(shell_history: str) -> list[lb.RecStrDict] | None:
+    """The history sent by a client as shell_history, None when it is not a JSON list."""
+    if not shell_history:
+        return []
+    try:
+        history = json.loads(shell_history)
+    except ValueError:
+        return None
+    return history if isinstance(history, list) else None
+
+
+@dataclass
+class HistoryUpdate:
+    """Last item of a streamed request: the serialized history including the current exchange."""
+
+    history: list[lb.RecStrDict]
+
+
+@dataclass
+class Progress:
+    """Progress report of a streamed request, e.g. stage='sql' and message='running SQL (12 rows)'."""
+
+    stage: str
+    message: str
+    elapsed_ms: int
+
+
+async def shared(cache: dict[K, "asyncio.Future[T]"], key: K, compute: Callable[[], Awaitable[T]]) -> T:
+    """The value of key, computed by the first caller while the others wait for it. A failure is passed to the waiters but not kept.
+    The computation is shielded, so that a caller cancelled meanwhile does not take it away from the others.
+    """
+    future = cache.get(key)
+    if future is None:
+
+        async def run() -> T:
+            try:
+                return await compute()
+            except BaseException:
+                cache.pop(key, None)
+                raise
+
+        future = cache[key] = asyncio.ensure_future(run())
+    return await asyncio.shield(future)
+
+
+class EventChannel:
+    """Queue between the task working on a streamed request and the generator handing its results to the client.
+    Elements, progress reports and the history update are published in the order they are produced; close() ends the stream, optionally
+    with the exception that ended the work, which is then re-raised on the consuming side.
+    """
+
+    def __init__(self) -> None:
+        self._queue: asyncio.Queue[Element | Progress | HistoryUpdate | _Closed] = asyncio.Queue()
+        self._started: float = time.monotonic()
+
+    def publish(self, event: Element | Progress | HistoryUpdate) -> None:
+        self._queue.put_nowait(event)
+
+    def progress(self, stage: str, message: str) -> None:
+        elapsed_ms = int((time.monotonic() - self._started) * 1000)
+        logger.info(f"Progress at {elapsed_ms} ms: [{stage}] {message}")
+        self.publish(Progress(stage, message, elapsed_ms))
+
+    def close(self, error: BaseException | None = None) -> None:
+        self._queue.put_nowait(_Closed(error))
+
+    async def __aiter__(self) -> AsyncIterator[Element | Progress | HistoryUpdate]:
+        while True:
+            event = await self._queue.get()
+            if isinstance(event, _Closed):
+                if event.error is not None:
+                    raise event.error
+                return
+            yield event
+
+
+@dataclass
+class _Closed:
+    error: BaseException | None
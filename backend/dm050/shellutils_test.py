@@ -0,0 +1,67 @@
+import unittest
+
+from .shellutils import GraphicsElement, ItemStreamParser, TableElement, TextElement, WrongAnswer, parse_history, unparse_item
+
+
+class TestItemStreamParser(unittest.TestCase):
+    reply = """```json
+{
+    "items": [
+        {"type": "text", "text": "Prices in {USD} and \\"quotes\\" [sic]", "graphics": null, "table": null},
+        {"type": "table", "text": null, "graphics": null, "table": "t1"},
+        {"type": "graphics", "text": null, "graphics": "g1", "table": null}
+    ]
+}
+```"""
+
+    def _feed_in_chunks(self, size: int) -> tuple[ItemStreamParser, list[list[object]]]:
+        parser = ItemStreamParser()
+        batches = [parser.feed(self.reply[i : i + size]) for i in range(0, len(self.reply), size)]
+        return parser, batches
+
+    def test_items_are_emitted_as_soon_as_they_are_closed(self):
+        parser = ItemStreamParser()
+        first_item_end = self.reply.index("null},") + len("null}")
+        self.assertEqual(parser.feed(self.reply[: first_item_end - 1]), [])
+        emitted = parser.feed(self.reply[first_item_end - 1 : first_item_end])
+        self.assertEqual(emitted, [{"type": "text", "text": 'Prices in {USD} and "quotes" [sic]', "graphics": None, "table": None}])
+        self.assertFalse(parser.done())
+
+    def test_chunking_does_not_matter(self):
+        for size in (1, 2, 3, 7, 64, len(self.reply)):
+            parser, batches = self._feed_in_chunks(size)
+            items = [item for batch in batches for item in batch]
+            self.assertEqual([item["type"] for item in items], ["text", "table", "graphics"], f"chunk size {size}")
+            self.assertTrue(parser.done())
+
+    def test_unclosed_list_is_not_done(self):
+        parser = ItemStreamParser()
+        parser.feed('{"items": [{"type": "text", "text": "a"}')
+        self.assertTrue(parser.started())
+        self.assertFalse(parser.done())
+
+    def test_non_object_element_is_rejected(self):
+        with self.assertRaises(WrongAnswer):
+            ItemStreamParser().feed('{"items": ["just a string"]}')
+
+    def test_unparse_item_resolves_resources(self):
+        table = TableElement([{"a": 1}], "t1")
+        graphics = GraphicsElement("img", "g1")
+        resources = {"t1": table, "g1": graphics}
+        self.assertEqual(unparse_item(resources, {"type": "text", "text": "x"}), TextElement("x"))
+        self.assertIs(unparse_item(resources, {"type": "table", "table": "t1"}), table)
+        with self.assertRaises(WrongAnswer):
+            unparse_item(resources, {"type": "graphics", "graphics": "t1"})
+
+
+class TestParseHistory(unittest.TestCase):
+    def test_only_json_lists_are_histories(self):
+        self.assertEqual(parse_history(""), [])
+        self.assertEqual(parse_history('[{"user": "q"}]'), [{"user": "q"}])
+        self.assertIsNone(parse_history("{not json"))
+        self.assertIsNone(parse_history('{"user": "q"}'))
+
+
+if __name__ == '__main__':
+
+    unittest.main()
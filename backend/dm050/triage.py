@@ -0,0 +1,167 @@
+"""Rule-based triage: the data domain of a question from the terms it names, without asking the LLM.
+
+The rules are those of semantic_stage_system_instruction in dm050.shell, compiled into a table of terms (single words and phrases) and
+matched against the words of the question, longest phrase first, so that "IEA Brent" is an IEA margin and not a Brent quotation.
+Misspelt words of five letters or more are matched to the nearest word of the rules within one edit (two from eight letters on); shorter
+names (MOL, OMV, TTF, SN ...) must be exact. A term naming several domains (MOL: a stock and a company) takes the domain of the other terms
+of the question or of a word like "margin" or "stock". As in the triage stage, a company margin wins over petchem quotations.
+
+classify() returns the domain when the question names exactly one, None when it names none or several, or when a term stays ambiguous:
+the LLM triage then decides, with the chat history at hand (a follow-up question may name no term at all). Within a conversation the rules
+settle a question only when the previous question named the same domain: "and the diesel spread that day?" after a Brent question may
+well refer back to it, which only the LLM reading the history can tell. The share of questions settled
+by the rules is counted by dm050_triage_total in langutils.metrics; for a file of questions (from the backend directory):
+
+    python -m dm050.triage [api/questions.txt]
+"""
+
+import argparse
+import functools
+import os
+import re
+import unicodedata
+
+# TRIAGE_RULES=0 sends every question to the LLM triage
+TRIAGE_RULES = os.getenv("TRIAGE_RULES", "1") != "0"
+
+# the terms implying each domain, spelt as they are matched: lower case, no accents, punctuation as spaces
+RULES: dict[str, tuple[str, ...]] = {
+    "stocks": ("mol", "omv", "orlen", "pkn"),
+    "crude quotations": (
+        "brent",
+        "dated brent",
+        "azeri",
+        "azeri light",
+        "cpc",
+        "cpc blend",
+        "urals",
+        "cif med urals",
+        "cif nwe urals",
+        "dap india urals",
+    ),
+    "natural gas quotations": ("cegh", "cegh vtp", "ttf"),
+    "lpg quotations": ("propane", "propane butane", "butane"),
+    "petchem quotations": ("benzene", "ethylene", "propylene", "butadiene", "polyethylene", "polypropylene", "ldpe", "hdpe"),
+    "spreads": ("gasoline", "diesel", "naphta", "jet", "jet fuel", "kerosene", "gasoil", "gas oil", "fuel oil", "vgo", "butadiene naphta"),
+    "iea margins": ("iea brent", "iea med urals"),
+    "company margins": (
+        "mol group",
+        "mol",
+        "sn",
+        "slovnaft",
+        "mol sn",
+        "mol and sn",
+        "mol and slovnaft",
+        "mpc",
+        "mol petrokemia",
+        "spc",
+        "ina",
+        "ina rijeka",
+        "polymer margin",
+    ),
+}
+
+# words settling a term that names several domains
+CUES: dict[str, str] = {
+    "margin": "company margins",
+    "margins": "company margins",
+    "stock": "stocks",
+    "stocks": "stocks",
+    "share": "stocks",
+    "shares": "stocks",
+}
+
+
+def _compile(rules: dict[str, tuple[str, ...]]) -> dict[tuple[str, ...], frozenset[str]]:
+    terms: dict[tuple[str, ...], set[str]] = {}
+    for domain, phrases in rules.items():
+        for phrase in phrases:
+            terms.setdefault(tuple(phrase.split()), set()).add(domain)
+    return {words: frozenset(domains) for words, domains in terms.items()}
+
+
+TERMS = _compile(RULES)
+LONGEST_TERM = max(len(words) for words in TERMS)
+# the words of the rules a misspelt word may stand for
+VOCABULARY = sorted({word for words in TERMS for word in words if len(word) >= 5})
+_KNOWN = frozenset(VOCABULARY)
+
+
+def words(text: str) -> list[str]:
+    """The words of text as the rules spell them: "MOL+SN" gives mol, sn; "Petrokémia" gives petrokemia."""
+    plain = unicodedata.normalize("NFKD", text).encode("ascii", "ignore").decode("ascii")
+    return re.findall(r"[a-z0-9]+", plain.lower())
+
+
+@functools.lru_cache(maxsize=4096)
+def _correct(word: str) -> str:
+    if len(word) < 5 or word in _KNOWN or not word.isalpha():
+        return word
+    # imported on first use, like in langutils.llm_tools
+    from rapidfuzz import process
+    from rapidfuzz.distance import OSA
+
+    match = process.extractOne(word, VOCABULARY, scorer=OSA.distance, score_cutoff=1 if len(word) < 8 else 2)
+    return match[0] if match is not None else word
+
+
+def domains(question: str) -> tuple[set[str], bool]:
+    """The domains the question names, and whether a term of it was left between several of them."""
+    found = [_correct(word) for word in words(question)]
+    definite: set[str] = set()
+    undecided: list[frozenset[str]] = []
+    i = 0
+    while i < len(found):
+        for n in range(min(LONGEST_TERM, len(found) - i), 0, -1):
+            if (term := TERMS.get(tuple(found[i : i + n]))) is not None:
+                if len(term) == 1:
+                    definite |= term
+                else:
+                    undecided.append(term)
+                i += n
+                break
+        else:
+            i += 1
+
+    cues = {CUES[word] for word in found if word in CUES}
+    ambiguous = False
+    for term in undecided:
+        choice = term & definite or term & cues
+        if len(choice) == 1:
+            definite |= choice
+        else:
+            ambiguous = True
+    if "petchem quotations" in definite and "company margins" in definite:
+        definite.discard("petchem quotations")
+    return definite, ambiguous
+
+
+def classify(question: str, previous: str | None = None) -> str | None:
+    """The single domain named by the question, or None when the rules cannot tell it. previous is the question asked before it in the
+    conversation, if any: a question that does not name the same domain as that one is left to the LLM.
+    """
+    found, ambiguous = domains(question)
+    if len(found) != 1 or ambiguous:
+        return None
+    domain = next(iter(found))
+    if previous is not None and classify(previous) != domain:
+        return None
+    return domain
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="The domain the triage rules give each question and the share of questions they settle")
+    parser.add_argument("questions", nargs="?", default=os.path.join(os.path.dirname(__file__), "..", "api", "questions.txt"))
+    args = parser.parse_args()
+    with open(args.questions) as f:
+        questions = [line.strip() for line in f if line.strip()]
+    hits = 0
+    for question in questions:
+        domain = classify(question)
+        hits += domain is not None
+        print(f"{domain or '-':<24} {question}")
+    print(f"{hits} of {len(questions)} questions settled by the rules ({100.0 * hits / max(1, len(questions)):.1f}%)")
+
+
+if __name__ == "__main__":
+    main()
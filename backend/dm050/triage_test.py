@@ -0,0 +1,43 @@
+import unittest
+
+from dm050 import shell, triage
+
+
+class TestTriageRules(unittest.TestCase):
+    def test_terms_give_their_domain(self):
+        cases = {
+            "What was the average price of CPC Blend in 2022?": "crude quotations",
+            "How did the IEA Med Urals margin change in 2023?": "iea margins",
+            "Compare the butadiene-naphtha spread to last year": "spreads",
+            "Show the TTF day-ahead price": "natural gas quotations",
+            "Slovnaft Petrokémia margin since 2018": "company margins",
+            "MPC polyethylene margin": "company margins",
+            "What was the maximum brnet price last year?": "crude quotations",
+        }
+        for question, domain in cases.items():
+            with self.subTest(question=question):
+                self.assertEqual(triage.classify(question), domain)
+
+    def test_ambiguous_terms_are_settled_by_the_others(self):
+        self.assertEqual(triage.classify("Compare OMV and MOL"), "stocks")
+        self.assertEqual(triage.classify("MOL refinery margin"), "company margins")
+        self.assertIsNone(triage.classify("MOL last month"))
+
+    def test_follow_ups_keep_the_domain_of_the_conversation(self):
+        self.assertEqual(triage.classify("And the OMV share price?", previous="MOL stock price in May"), "stocks")
+        self.assertIsNone(triage.classify("And the diesel spread that day?", previous="Highest Brent price in 2022"))
+        self.assertIsNone(triage.classify("Brent in 2021?", previous="And the year before?"))
+
+    def test_the_shell_follows_up_on_the_history(self):
+        history = [{"user": "Highest Brent price in 2022"}, {"assistant": "It was 133.18 USD/bbl on 8 March."}]
+        self.assertIsNone(shell._classify("And the diesel spread that day?", history))
+        self.assertEqual(shell._classify("Brent price in 2021", history), "crude quotations")
+        self.assertEqual(shell._classify("And the diesel spread that day?", []), "spreads")
+
+    def test_the_llm_decides_when_the_rules_cannot(self):
+        self.assertIsNone(triage.classify("And what about the year before?"))
+        self.assertIsNone(triage.classify("Compare the MOL stock with Brent"))
+
+
+if __name__ == "__main__":
+    unittest.main()
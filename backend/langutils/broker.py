@@ -0,0 +1,205 @@
+"""Message broker used by the job mode (see api.jobs): queues, whose messages each go to one consumer and are redelivered unless acknowledged,
+and topics, whose messages go to every current subscriber.
+
+StompBroker talks to a STOMP broker (ActiveMQ, Artemis, RabbitMQ with the STOMP plugin) through aiostomp; InProcessBroker gives the same
+semantics within one event loop, for tests and for running the job mode without a broker.
+"""
+
+import asyncio
+import os
+from abc import ABC, abstractmethod
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable
+
+# called with the headers and the body of a message; for queues, True acknowledges the message and False hands it back to the broker
+Handler = Callable[[dict[str, str], bytes], Awaitable[bool]]
+
+
+def is_queue(destination: str) -> bool:
+    return destination.startswith("/queue/")
+
+
+class Subscription(ABC):
+    @abstractmethod
+    def cancel(self) -> None:
+        pass
+
+
+class Broker(ABC):
+    @abstractmethod
+    async def connect(self) -> None:
+        pass
+
+    @abstractmethod
+    async def send(self, destination: str, body: str | bytes, headers: dict[str, str] | None = None) -> None:
+        pass
+
+    @abstractmethod
+    async def subscribe(self, destination: str, handler: Handler, prefetch: int = 1) -> Subscription:
+        """Calls handler for the messages of the destination. For a queue, at most prefetch messages are being handled at a time."""
+
+    @abstractmethod
+    async def close(self) -> None:
+        pass
+
+
+def _encode(body: str | bytes) -> bytes:
+    return body.encode("utf-8") if isinstance(body, str) else body
+
+
+@dataclass
+class _Message:
+    headers: dict[str, str]
+    body: bytes
+
+
+@dataclass
+class _InProcessSubscription(Subscription):
+    broker: "InProcessBroker"
+    destination: str
+    tasks: list[asyncio.Task[None]] = field(default_factory=list)
+    # topics only: the messages not yet handled, delivered one after the other in publishing order
+    inbox: "asyncio.Queue[_Message] | None" = None
+
+    def cancel(self) -> None:
+        subscriptions = self.broker._subscriptions.get(self.destination, [])
+        if self in subscriptions:
+            subscriptions.remove(self)
+        for task in self.tasks:
+            task.cancel()
+
+
+class InProcessBroker(Broker):
+    """Queues and topics held in memory. A message sent to a queue nobody consumes waits for a consumer; one sent to a topic nobody
+    subscribes to is dropped, as with a real broker.
+    """
+
+    def __init__(self):
+        self._queues: dict[str, asyncio.Queue[_Message]] = {}
+        self._subscriptions: dict[str, list[_InProcessSubscription]] = {}
+
+    def _queue(self, destination: str) -> "asyncio.Queue[_Message]":
+        return self._queues.setdefault(destination, asyncio.Queue())
+
+    async def connect(self) -> None:
+        pass
+
+    async def send(self, destination: str, body: str | bytes, headers: dict[str, str] | None = None) -> None:
+        message = _Message({**(headers or {}), "destination": destination}, _encode(body))
+        if is_queue(destination):
+            self._queue(destination).put_nowait(message)
+            return
+        for subscription in self._subscriptions.get(destination, []):
+            assert subscription.inbox is not None
+            subscription.inbox.put_nowait(message)
+
+    async def subscribe(self, destination: str, handler: Handler, prefetch: int = 1) -> Subscription:
+        subscription = _InProcessSubscription(self, destination)
+        if is_queue(destination):
+            queue = self._queue(destination)
+
+            async def consume() -> None:
+                while True:
+                    message = await queue.get()
+                    try:
+                        acknowledged = await handler(message.headers, message.body)
+                    except asyncio.CancelledError:
+                        queue.put_nowait(message)
+                        raise
+                    except Exception:
+                        acknowledged = False
+                    if not acknowledged:
+                        queue.put_nowait(message)
+
+            subscription.tasks = [asyncio.create_task(consume()) for _ in range(max(1, prefetch))]
+        else:
+            inbox: asyncio.Queue[_Message] = asyncio.Queue()
+            subscription.inbox = inbox
+
+            async def deliver() -> None:
+                while True:
+                    message = await inbox.get()
+                    try:
+                        await handler(message.headers, message.body)
+                    except Exception:
+                        pass
+
+            subscription.tasks = [asyncio.create_task(deliver())]
+        self._subscriptions.setdefault(destination, []).append(subscription)
+        return subscription
+
+    async def close(self) -> None:
+        for subscriptions in list(self._subscriptions.values()):
+            for subscription in list(subscriptions):
+                subscription.cancel()
+
+
+class _StompSubscription(Subscription):
+    def __init__(self, client: Any, subscription: Any):
+        self.client = client
+        self.subscription = subscription
+
+    def cancel(self) -> None:
+        self.client.unsubscribe(self.subscription)
+
+
+class StompBroker(Broker):
+    """A STOMP 1.1 broker. Queue subscriptions acknowledge each message individually once handled, and ask the broker (ActiveMQ's
+    activemq.prefetchSize, RabbitMQ's prefetch-count) for no more than prefetch unacknowledged messages, so that a busy worker does not hoard
+    the jobs other workers could run.
+    """
+
+    def __init__(self, host: str, port: int, username: str | None = None, password: str | None = None):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self._client: Any = None
+
+    async def connect(self) -> None:
+        from aiostomp import AioStomp
+
+        self._client = AioStomp(self.host, self.port, client_id="dm050")
+        await self._client.connect(username=self.username, password=self.password)
+
+    async def send(self, destination: str, body: str | bytes, headers: dict[str, str] | None = None) -> None:
+        self._client.send(destination, body=_encode(body), headers=dict(headers or {}))
+
+    async def subscribe(self, destination: str, handler: Handler, prefetch: int = 1) -> Subscription:
+        async def on_message(frame: Any, body: bytes | str | None) -> bool:
+            return await handler(dict(frame.headers), _encode(body or b""))
+
+        if is_queue(destination):
+            subscription = self._client.subscribe(
+                destination,
+                ack="client-individual",
+                extra_headers={"activemq.prefetchSize": str(prefetch), "prefetch-count": str(prefetch)},
+                handler=on_message,
+            )
+        else:
+            subscription = self._client.subscribe(destination, ack="auto", handler=on_message)
+        return _StompSubscription(self._client, subscription)
+
+    async def close(self) -> None:
+        if self._client is not None:
+            self._client.close()
+
+
+def create_broker() -> Broker | None:
+    """The broker configured by the environment: JOB_BROKER is stomp (STOMP_HOST, STOMP_PORT default 61613, STOMP_USER, STOMP_PASSWORD),
+    inprocess, or unset for no job mode.
+    """
+    match os.getenv("JOB_BROKER", ""):
+        case "":
+            return None
+        case "inprocess":
+            return InProcessBroker()
+        case "stomp":
+            return StompBroker(
+                os.getenv("STOMP_HOST", "localhost"),
+                int(os.getenv("STOMP_PORT", "61613")),
+                os.getenv("STOMP_USER") or None,
+                os.getenv("STOMP_PASSWORD") or None,
+            )
+        case other:
+            raise ValueError(f"Unknown JOB_BROKER {other!r}, expected stomp or inprocess")
@@ -1,12 +1,28 @@
+import asyncio
+import csv
+import io
 import os
 from abc import ABC, abstractmethod
+from contextlib import asynccontextmanager, contextmanager
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, Any, AsyncIterator, Iterator
 
-import pandas as pd
-import psycopg
+from langutils import deadline
+from langutils.metrics import SQL_ROWS, STAGE_SECONDS
 
-pd.set_option('display.max_rows', 5000)
-pd.set_option('display.max_columns', None)
-pd.set_option('display.width', 200)
+if TYPE_CHECKING:
+    # psycopg is imported on the first connection, so that importing the context (and the API with it) does not load the driver
+    import psycopg
+
+
+@dataclass
+class ResultColumn:
+    """A column of a streamed result; the type is the PostgreSQL type OID when the driver tells it."""
+
+    name: str
+    type_code: int | None = None
+    precision: int | None = None
+    scale: int | None = None
 
 
 class ExecutionContext(ABC):
@@ -15,6 +31,31 @@ class ExecutionContext(ABC):
     def execute_query(self, query: str) -> list[dict[str, str]]:
         pass
 
+    async def aexecute_query(self, query: str) -> list[dict[str, str]]:
+        """Asynchronous counterpart of execute_query. Contexts without a native asynchronous driver run execute_query in a worker thread."""
+        return await asyncio.to_thread(self.execute_query, query)
+
+    async def astream_query(self, query: str, batch_rows: int) -> AsyncIterator[tuple[list[ResultColumn], list[tuple[Any, ...]]]]:
+        """Yields the result of the query batch_rows rows at a time, with its columns, for exports that must not hold the whole result.
+        Contexts without a server-side cursor run the whole query and slice it.
+        """
+        rows = await self.aexecute_query(query)
+        columns = [ResultColumn(name) for name in (rows[0].keys() if rows else [])]
+        for start in range(0, max(len(rows), 1), batch_rows):
+            yield columns, [tuple(row.values()) for row in rows[start : start + batch_rows]]
+
+    async def acopy_csv(self, query: str, batch_rows: int = 10000) -> AsyncIterator[bytes]:
+        """The result of the query as CSV with a header line, in chunks. Written from astream_query unless overridden."""
+        header = True
+        async for columns, rows in self.astream_query(query, batch_rows):
+            buffer = io.StringIO()
+            writer = csv.writer(buffer, lineterminator="\n")
+            if header:
+                writer.writerow([column.name for column in columns])
+                header = False
+            writer.writerows(rows)
+            yield buffer.getvalue().encode("utf-8")
+
     def read_ddl(self, name: str):
         content = ""
         with open(f'redmine/{name}_ddl.sql', 'r') as file:
@@ -37,31 +78,176 @@ class ExecutionContext(ABC):
             )
 
 
+def _statement_timeout_ms() -> int | None:
+    """statement_timeout for a query of the current request: what is left of its deadline, None outside a request with a deadline."""
+    remaining = deadline.timeout()
+    return None if remaining is None else max(int(remaining * 1000), 1)
+
+
+@contextmanager
+def _canceled_as_deadline(timeout_ms: int | None) -> Iterator[None]:
+    """A query cancelled by the statement_timeout of the request surfaces as its DeadlineExceeded rather than as a database error."""
+    from psycopg.errors import QueryCanceled
+
+    try:
+        yield
+    except QueryCanceled as e:
+        if timeout_ms is None:
+            raise
+        raise deadline.DeadlineExceeded(f"SQL statement cancelled after {timeout_ms} ms, the deadline of the request") from e
+
+
+def _connection_params() -> dict[str, str]:
+    return dict(
+        host=os.getenv('PGHOST', 'localhost'),
+        port=os.getenv('PGPORT', '5432'),
+        dbname=os.getenv('PGDATABASE', 'redmine'),
+        user=os.getenv('PGUSER', 'postgres'),
+        password=os.getenv('PGPASSWORD', 'password'),
+    )
+
+
 class SQLContext(ExecutionContext):
+    """PostgreSQL context. The synchronous path opens a connection per query; the asynchronous path keeps a small pool of idle
+    AsyncConnections (at most PGPOOL_MAX, default 10, open at the same time) so that many concurrent conversations share a bounded
+    number of database connections.
+    """
+
+    def __init__(self, max_connections: int | None = None):
+        self.max_connections = max_connections if max_connections is not None else int(os.getenv('PGPOOL_MAX', '10'))
+        self._idle: list["psycopg.AsyncConnection"] = []
+        self._slots = asyncio.Semaphore(self.max_connections)
 
-    def open_connection(self) -> psycopg.Connection:
-        con = psycopg.connect(
-            host=os.getenv('PGHOST', 'localhost'),
-            port=os.getenv('PGPORT', '5432'),
-            dbname=os.getenv('PGDATABASE', 'redmine'),
-            user=os.getenv('PGUSER', 'postgres'),
-            password=os.getenv('PGPASSWORD', 'password'),
-        )
+    def open_connection(self) -> "psycopg.Connection":
+        import psycopg
+
+        con = psycopg.connect(**_connection_params())
         con.autocommit = True
         return con
 
+    async def aopen_connection(self) -> "psycopg.AsyncConnection":
+        import psycopg
+
+        return await psycopg.AsyncConnection.connect(**_connection_params(), autocommit=True)
+
+    @asynccontextmanager
+    async def aconnection(self) -> AsyncIterator["psycopg.AsyncConnection"]:
+        """Borrows a connection from the pool, opening a new one if no idle connection is available.
+        Connections that come back broken or in the middle of a transaction are closed instead of being returned to the pool.
+        """
+        from psycopg.pq import TransactionStatus
+
+        async with self._slots:
+            conn = None
+            while self._idle and conn is None:
+                candidate = self._idle.pop()
+                if candidate.closed:
+                    continue
+                conn = candidate
+            if conn is None:
+                conn = await self.aopen_connection()
+            try:
+                yield conn
+            finally:
+                if conn.closed or conn.info.transaction_status != TransactionStatus.IDLE:
+                    await conn.close()
+                else:
+                    self._idle.append(conn)
+
+    async def aprefill(self, count: int) -> int:
+        """Opens connections until the pool holds count idle ones (at most max_connections) and checks each with a trivial query, so that
+        the first requests do not pay for the TLS handshake and the authentication. Returns the number of idle connections.
+        """
+        for _ in range(min(count, self.max_connections) - len(self._idle)):
+            async with self._slots:
+                conn = await self.aopen_connection()
+                await conn.execute("SELECT 1")
+                self._idle.append(conn)
+        return len(self._idle)
+
+    async def aclose(self) -> None:
+        while self._idle:
+            await self._idle.pop().close()
+
+    @asynccontextmanager
+    async def aexport_connection(self) -> AsyncIterator["psycopg.AsyncConnection"]:
+        """A connection of its own for an export, outside the pool: an export may run for minutes and must not keep the chat requests
+        waiting for a pooled connection.
+        """
+        conn = await self.aopen_connection()
+        try:
+            yield conn
+        finally:
+            await conn.close()
+
+    async def astream_query(self, query: str, batch_rows: int) -> AsyncIterator[tuple[list[ResultColumn], list[tuple[Any, ...]]]]:
+        """Reads the result through a server-side cursor, so that only batch_rows rows are held at a time."""
+        async with self.aexport_connection() as conn:
+            # server-side cursors live in a transaction
+            async with conn.transaction():
+                async with conn.cursor(name="export") as cursor:
+                    cursor.itersize = batch_rows
+                    await cursor.execute(query)  # pyright: ignore[reportArgumentType]
+                    description = cursor.description or []
+                    columns = [ResultColumn(d.name, d.type_code, d.precision, d.scale) for d in description]
+                    rows = await cursor.fetchmany(batch_rows)
+                    # an empty result still tells its columns
+                    yield columns, rows
+                    while rows := await cursor.fetchmany(batch_rows):
+                        yield columns, rows
+
+    async def acopy_csv(self, query: str, batch_rows: int = 10000) -> AsyncIterator[bytes]:
+        """COPY ... TO STDOUT: the server writes the CSV, which is passed on in the chunks it arrives in."""
+        statement = f"COPY ({query.strip().rstrip(';')}) TO STDOUT (FORMAT csv, HEADER true)"
+        async with self.aexport_connection() as conn:
+            async with conn.cursor() as cursor:
+                async with cursor.copy(statement) as copy:  # pyright: ignore[reportArgumentType]
+                    async for data in copy:
+                        yield bytes(data)
+
+    @STAGE_SECONDS.time(stage="sql")
     def execute_query(self, query: str) -> list[dict[str, str]]:
+        timeout_ms = _statement_timeout_ms()
         conn = self.open_connection()
         cursor = conn.cursor()
         try:
-            cursor.execute(query)  # pyright: ignore[reportArgumentType]
+            if timeout_ms is not None:
+                # the connection is closed after the query, the setting goes with it
+                cursor.execute(f"SET statement_timeout = {timeout_ms}")  # pyright: ignore[reportArgumentType]
+            with _canceled_as_deadline(timeout_ms):
+                cursor.execute(query)  # pyright: ignore[reportArgumentType]
             result = cursor.fetchall()
             description = cursor.description
             if description is None:
                 return []
             columns = [desc[0] for desc in description]
             result = [dict(zip(columns, row)) for row in result]
+            SQL_ROWS.observe(len(result))
             return result
         finally:
             cursor.close()
             conn.close()
+
+    async def aexecute_query(self, query: str) -> list[dict[str, str]]:
+        """Within a request with a deadline the statement is bounded by statement_timeout as well; a request cancelled meanwhile has the
+        query cancelled on the server by psycopg.
+        """
+        timeout_ms = _statement_timeout_ms()
+        with STAGE_SECONDS.time(stage="sql"):
+            async with self.aconnection() as conn:
+                async with conn.cursor() as cursor:
+                    with _canceled_as_deadline(timeout_ms):
+                        if timeout_ms is None:
+                            await cursor.execute(query)  # pyright: ignore[reportArgumentType]
+                        else:
+                            # SET LOCAL ends with the transaction, the pooled connection keeps its own settings
+                            async with conn.transaction():
+                                await cursor.execute(f"SET LOCAL statement_timeout = {timeout_ms}")  # pyright: ignore[reportArgumentType]
+                                await cursor.execute(query)  # pyright: ignore[reportArgumentType]
+                    description = cursor.description
+                    if description is None:
+                        return []
+                    result = await cursor.fetchall()
+                    columns = [desc[0] for desc in description]
+                    SQL_ROWS.observe(len(result))
+                    return [dict(zip(columns, row)) for row in result]
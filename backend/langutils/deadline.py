@@ -0,0 +1,94 @@
+"""Deadline and cancellation of the request being served.
+
+The Deadline of a request travels in a context variable, so that the layers below it (the LLM client, the SQL context, the chart rendering)
+bound their own waits without it being handed down through every call: asyncio tasks inherit the context of the code that creates them
+and asyncio.to_thread copies it into the worker thread. Code running in a thread cannot be interrupted by asyncio; it calls check() at its
+checkpoints instead, which raises once the request is past its deadline or has been cancelled (e.g. the client went away).
+"""
+
+import os
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Iterator
+
+# seconds a chat request may take from the question to the last element of the answer; 0 for no limit
+REQUEST_DEADLINE = float(os.getenv("REQUEST_DEADLINE", "180"))
+
+
+class RequestAborted(Exception):
+    """The request is not worth finishing any more."""
+
+
+class DeadlineExceeded(RequestAborted):
+    pass
+
+
+class RequestCancelled(RequestAborted):
+    pass
+
+
+class Deadline:
+    """The point in time by which a request must be over, and its cancellation token. seconds None (or 0) means no deadline."""
+
+    def __init__(self, seconds: float | None = None):
+        self.seconds = seconds or None
+        self.expires = time.monotonic() + self.seconds if self.seconds is not None else None
+        self.reason: str | None = None
+
+    def remaining(self) -> float | None:
+        return max(self.expires - time.monotonic(), 0.0) if self.expires is not None else None
+
+    def cancel(self, reason: str = "cancelled") -> None:
+        if self.reason is None:
+            self.reason = reason
+
+    @property
+    def cancelled(self) -> bool:
+        return self.reason is not None
+
+    def exceeded(self) -> DeadlineExceeded:
+        return DeadlineExceeded(f"No answer within {self.seconds or 0:g} seconds")
+
+    def check(self) -> None:
+        if self.reason is not None:
+            raise RequestCancelled(f"Request {self.reason}")
+        if self.expires is not None and time.monotonic() >= self.expires:
+            raise self.exceeded()
+
+
+_current: ContextVar[Deadline | None] = ContextVar("deadline", default=None)
+
+
+def current() -> Deadline | None:
+    return _current.get()
+
+
+@contextmanager
+def scope(deadline: Deadline) -> Iterator[Deadline]:
+    """Makes deadline the one of the code running in the block (and of the tasks and threads it starts)."""
+    token = _current.set(deadline)
+    try:
+        yield deadline
+    finally:
+        _current.reset(token)
+
+
+def check() -> None:
+    """Raises RequestCancelled or DeadlineExceeded when the current request is over; does nothing outside a request."""
+    if (deadline := _current.get()) is not None:
+        deadline.check()
+
+
+def timeout(default: float | None = None) -> float | None:
+    """The time left to the current request for a wait that would otherwise take up to default seconds (None: unbounded). Raises like
+    check() when no time is left, so that no new wait is started for a request that is over.
+    """
+    deadline = _current.get()
+    if deadline is None:
+        return default
+    deadline.check()
+    remaining = deadline.remaining()
+    if remaining is None:
+        return default
+    return remaining if default is None else min(remaining, default)
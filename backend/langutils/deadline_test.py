@@ -0,0 +1,45 @@
+import asyncio
+import time
+import unittest
+
+from langutils import deadline
+
+
+class TestDeadline(unittest.TestCase):
+    def test_no_request_no_limit(self):
+        self.assertIsNone(deadline.timeout())
+        self.assertEqual(deadline.timeout(30.0), 30.0)
+        deadline.check()
+
+    def test_timeout_is_what_is_left(self):
+        with deadline.scope(deadline.Deadline(10.0)):
+            self.assertLessEqual(deadline.timeout(), 10.0)
+            self.assertEqual(deadline.timeout(1.0), 1.0)
+        with deadline.scope(deadline.Deadline(0.01)):
+            time.sleep(0.02)
+            self.assertRaises(deadline.DeadlineExceeded, deadline.timeout)
+
+    def test_threads_see_the_cancellation(self):
+        async def scenario():
+            request = deadline.Deadline(10.0)
+            started = asyncio.Event()
+            loop = asyncio.get_running_loop()
+
+            def render():
+                loop.call_soon_threadsafe(started.set)
+                for _ in range(100):
+                    deadline.check()
+                    time.sleep(0.01)
+
+            with deadline.scope(request):
+                work = asyncio.ensure_future(asyncio.to_thread(render))
+            await started.wait()
+            request.cancel("abandoned")
+            with self.assertRaises(deadline.RequestCancelled):
+                await work
+
+        asyncio.run(scenario())
+
+
+if __name__ == "__main__":
+    unittest.main()
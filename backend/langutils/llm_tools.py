@@ -1,36 +1,160 @@
+import asyncio
 import io
 import json
 import os
+import pickle
+import threading
+import time
 import uuid
+from collections import OrderedDict
 from datetime import datetime
 from itertools import groupby
+from typing import Any
 
-from langutils import COLORS, GRID_COLOR, MAX_VALUES_X_AXIS
+from langutils import COLORS, GRID_COLOR, MAX_VALUES_X_AXIS, deadline
 from langutils.context import ExecutionContext
-from matplotlib import pyplot as plt
-from matplotlib.colors import Normalize
-from rapidfuzz import fuzz
-from shell import ImgData, T2SQLTools
+from langutils.metrics import STAGE_SECONDS
+from langutils.shared_store import SharedStore, shared_store
+from shell import ImgData, T2SQLTools, TableData
+
+
+# matplotlib and rapidfuzz are imported where they are used: importing them takes longer than everything else the API needs at startup,
+# and the first chart or similarity search pays for it instead (serve.py preloads them before forking the workers).
+# pyplot keeps the "current figure" in global state, so concurrent requests sharing one ToolsHandler must not render at the same time
+_pyplot_lock = threading.Lock()
+
+
+def warm_up_charts() -> None:
+    """Renders a throw-away chart: the first one builds the font cache and loads the fonts and the Agg renderer, which takes seconds."""
+    from matplotlib import pyplot as plt
+
+    with _pyplot_lock:
+        plt.plot([0, 1], [0, 1], label="warm-up")
+        plt.legend()
+        plt.savefig(io.BytesIO(), format="png")
+        plt.close()
 
 
 class ImgCache:
-    def __init__(self):
+    """Short-lived cache of rendered charts. Shared by all requests served by the same ToolsHandler, hence the lock.
+    With a shared store the images are also written there, and images rendered by other worker processes are read from it.
+    Images live for IMG_CACHE_TTL seconds, by default as long as the table snapshots (TABLE_CACHE_TTL), so that the charts of an answer
+    can be loaded as long as its tables can be paged.
+    """
+
+    def __init__(self, store: SharedStore | None = None, ttl_seconds: int | None = None):
+        if ttl_seconds is None:
+            ttl_seconds = int(os.getenv("IMG_CACHE_TTL", os.getenv("TABLE_CACHE_TTL", "1800")))
+        self.ttl_seconds = ttl_seconds
         self.cache: list[ImgData] = list()
+        self._lock = threading.Lock()
+        self.store = store
 
     def flush_old_images(self):
         now = datetime.now()
-        self.cache = [img for img in self.cache if (now - img.create_dt).total_seconds() < 60 * 5]
+        with self._lock:
+            self.cache = [img for img in self.cache if (now - img.create_dt).total_seconds() < self.ttl_seconds]
 
     def add_image(self, img_name: str, img_buffer: io.BytesIO) -> ImgData:
         self.flush_old_images()
         img_data = ImgData(img_name, img_buffer)
-        self.cache.append(img_data)
+        with self._lock:
+            self.cache.append(img_data)
+        if self.store is not None:
+            self.store.put("image", img_name, img_buffer.getvalue(), self.ttl_seconds)
         return img_data
 
     def get_image(self, img_name: str) -> ImgData | None:
-        for img in self.cache:
-            if img.img_name == img_name:
-                return img
+        with self._lock:
+            for img in self.cache:
+                if img.img_name == img_name:
+                    return img
+        if self.store is not None and (data := self.store.get("image", img_name)) is not None:
+            img_data = ImgData(img_name, io.BytesIO(data))
+            with self._lock:
+                self.cache.append(img_data)
+            return img_data
+        return None
+
+
+class TableCache:
+    """Snapshots of large query results, paged by the client through /api/tables. Entries live for TABLE_CACHE_TTL seconds (default 30
+    minutes) and at most TABLE_CACHE_SIZE (default 64) of them are kept; the least recently used goes first.
+    With a shared store the snapshots are also written there (pickled), so that any worker process can serve the pages.
+    """
+
+    def __init__(self, ttl_seconds: int | None = None, max_tables: int | None = None, store: SharedStore | None = None):
+        self.ttl_seconds = ttl_seconds if ttl_seconds is not None else int(os.getenv("TABLE_CACHE_TTL", "1800"))
+        self.max_tables = max_tables if max_tables is not None else int(os.getenv("TABLE_CACHE_SIZE", "64"))
+        self.cache: OrderedDict[str, TableData] = OrderedDict()
+        self._lock = threading.Lock()
+        self.store = store
+
+    def flush_old_tables(self):
+        now = datetime.now()
+        with self._lock:
+            for table_id in [t.table_id for t in self.cache.values() if (now - t.create_dt).total_seconds() >= self.ttl_seconds]:
+                del self.cache[table_id]
+
+    def add_table(self, rows: list[dict[str, Any]]) -> TableData:
+        self.flush_old_tables()
+        table = TableData(uuid.uuid4().hex, rows)
+        self._remember(table)
+        if self.store is not None:
+            self.store.put("table", table.table_id, pickle.dumps(table, protocol=pickle.HIGHEST_PROTOCOL), self.ttl_seconds)
+        return table
+
+    def get_table(self, table_id: str) -> TableData | None:
+        with self._lock:
+            table = self.cache.get(table_id)
+            if table is not None:
+                self.cache.move_to_end(table_id)
+                return table
+        if self.store is not None and (data := self.store.get("table", table_id)) is not None:
+            # written by one of our own workers, never by a client
+            table = pickle.loads(data)
+            self._remember(table)
+            return table
+        return None
+
+    def _remember(self, table: TableData) -> None:
+        with self._lock:
+            self.cache[table.table_id] = table
+            while len(self.cache) > self.max_tables:
+                self.cache.popitem(last=False)
+
+
+class QueryCache:
+    """The validated SQL behind the tables of the answers, by export handle, so that /api/exports can run it again for the full result.
+    Handles live as long as the table snapshots (TABLE_CACHE_TTL) and at most max_queries are kept. With a shared store they are also
+    written there, so that any worker process can run the export.
+    """
+
+    max_queries = 4096
+
+    def __init__(self, ttl_seconds: int | None = None, store: SharedStore | None = None):
+        self.ttl_seconds = ttl_seconds if ttl_seconds is not None else int(os.getenv("TABLE_CACHE_TTL", "1800"))
+        self.cache: OrderedDict[str, tuple[float, str]] = OrderedDict()
+        self._lock = threading.Lock()
+        self.store = store
+
+    def add_query(self, sql: str) -> str:
+        handle = uuid.uuid4().hex
+        with self._lock:
+            self.cache[handle] = (time.monotonic() + self.ttl_seconds, sql)
+            while len(self.cache) > self.max_queries:
+                self.cache.popitem(last=False)
+        if self.store is not None:
+            self.store.put("query", handle, sql.encode("utf-8"), self.ttl_seconds)
+        return handle
+
+    def get_query(self, handle: str) -> str | None:
+        with self._lock:
+            entry = self.cache.get(handle)
+        if entry is not None and entry[0] > time.monotonic():
+            return entry[1]
+        if self.store is not None and (data := self.store.get("query", handle)) is not None:
+            return data.decode("utf-8")
         return None
 
 
@@ -41,18 +165,41 @@ class DateTimeEncoder(json.JSONEncoder):
         return super().default(o)
 
 
+_similarity_caches: dict[str, list[tuple[str, str, str]]] = {}
+_similarity_lock = threading.Lock()
+
+
+def load_similarity_cache(context: ExecutionContext, similarity_query: str) -> list[tuple[str, str, str]]:
+    """The (value, col_name, table) triplets returned by similarity_query, loaded once per process and query.
+    A preforking server calls this in the parent, so that the workers share the list copy-on-write instead of each loading its own.
+    """
+    if not similarity_query:
+        return []
+    with _similarity_lock:
+        if similarity_query not in _similarity_caches:
+            result_dict = context.execute_query(similarity_query)
+            _similarity_caches[similarity_query] = [
+                (str(rec.get("value")), str(rec.get("col_name")), str(rec.get("table"))) for rec in result_dict
+            ]
+        return _similarity_caches[similarity_query]
+
+
 class ToolsHandler(T2SQLTools):
     def __init__(self, context: ExecutionContext):
         self.context = context
-        self.img_cache = ImgCache()
-        # load the similar cache from a file or database if needed
-        similarity_query = os.getenv("SIMILARITY_QUERY", "")
-        if similarity_query:
-            result_dict = context.execute_query(similarity_query)
-            similars = [(str(rec.get("value")), str(rec.get("col_name")), str(rec.get("table"))) for rec in result_dict]
-            self.similars_cache = similars
-        else:
-            self.similars_cache: list[tuple[str, str, str]] = []
+        self.img_cache = ImgCache(shared_store())
+        self.table_cache = TableCache(store=shared_store())
+        self.query_cache = QueryCache(store=shared_store())
+        self._similars_cache: list[tuple[str, str, str]] | None = None
+
+    @property
+    def similars_cache(self) -> list[tuple[str, str, str]]:
+        """Loaded from the database on first use (the warm-up of the API or serve.py do it ahead of the requests); read-only afterwards, so it
+        can be shared between threads.
+        """
+        if self._similars_cache is None:
+            self._similars_cache = load_similarity_cache(self.context, os.getenv("SIMILARITY_QUERY", ""))
+        return self._similars_cache
 
     def similar(self, ref: str, limit: int = 0) -> list[tuple[str, str, str]]:
         """
@@ -60,6 +207,8 @@ class ToolsHandler(T2SQLTools):
         from all soft-searchable columns in all tables.
         Has to work based on some preloaded data of a database. The fields of the preloaded database has to come from a configuration.
         """
+        from rapidfuzz import fuzz
+
         ratios = [(rec[0], rec[1], rec[2], fuzz.ratio(ref, rec[0])) for rec in self.similars_cache]
         ratios.sort(key=lambda x: x[3], reverse=True)
         filtered_ratios = [(x[0], x[1], x[2]) for x in ratios if x[3] > limit]
@@ -71,6 +220,12 @@ class ToolsHandler(T2SQLTools):
         """
         return self.context.execute_query(sql)
 
+    async def adata(self, sql: str) -> list[dict[str, str]]:
+        """
+        Asynchronous counterpart of data(), going through the asynchronous path of the context.
+        """
+        return await self.context.aexecute_query(sql)
+
     def piechart(self, sql: str, labelfield: str, valuefield: str) -> str:
         """
         Executes the SQL and generates a pie chart from the result.
@@ -85,16 +240,23 @@ class ToolsHandler(T2SQLTools):
         values = [row[valuefield] for row in chart_data]
         bar_colors = self._build_color_list_scale(values)
 
-        plt.pie(values, labels=labels, autopct='%1.1f%%', colors=bar_colors)
-        img_name = f"{uuid.uuid4()}"
-        img_buffer = io.BytesIO()
-        plt.savefig(img_buffer, format='png')
-        plt.savefig("pie.png", format='png')
+        from matplotlib import pyplot as plt
+
+        with _pyplot_lock:
+            deadline.check()
+            plt.pie(values, labels=labels, autopct='%1.1f%%', colors=bar_colors)
+            img_name = f"{uuid.uuid4()}"
+            img_buffer = io.BytesIO()
+            plt.savefig(img_buffer, format='png')
+            plt.savefig("pie.png", format='png')
+            plt.close()
         self.img_cache.add_image(img_name, img_buffer)
 
         return img_name
 
     def set_axis_lables(self, x_values: list[list[str]]):
+        from matplotlib import pyplot as plt
+
         x_values_merged = []
         for x in x_values:
             x_values_merged.extend(x)
@@ -120,25 +282,43 @@ class ToolsHandler(T2SQLTools):
         xfield: column for x-axis labels, ylabel: y-axis label, linelist: list of columns for values of x-axis.
         Returns a string (e.g., image path or base64).
         """
-        data_series_names, data_series_values, x_values = self._build_chart_data(sql, xfield, name, value)
+        return self._render_linechart(self.data(sql), xfield, ylabel, name, value)
+
+    async def alinechart(self, sql: str, xfield: str, ylabel: str, name: str, value: str) -> str:
+        """
+        Asynchronous counterpart of linechart(): the data is fetched without blocking the event loop, the CPU-bound rendering runs in a
+        worker thread.
+        """
+        chart_data = await self.adata(sql)
+        return await asyncio.to_thread(self._render_linechart, chart_data, xfield, ylabel, name, value)
+
+    @STAGE_SECONDS.time(stage="chart")
+    def _render_linechart(self, chart_data: list[dict[str, str]], xfield: str, ylabel: str, name: str, value: str) -> str:
+        data_series_names, data_series_values, x_values = self._group_chart_data(chart_data, xfield, name, value)
 
         bar_colors = self._build_static_color_list(data_series_names)
 
-        plt.figure(figsize=(8, 5))  # type: ignore
-        for i, y in enumerate(data_series_values):
-            plt.plot(x_values[i], y, marker='o', label=data_series_names[i], color=bar_colors[i])
+        from matplotlib import pyplot as plt
 
-        self.set_axis_lables(x_values)
+        with _pyplot_lock:
+            # charts wait here for each other; one whose request is over is not drawn
+            deadline.check()
+            plt.figure(figsize=(8, 5))  # type: ignore
+            for i, y in enumerate(data_series_values):
+                plt.plot(x_values[i], y, marker='o', label=data_series_names[i], color=bar_colors[i])
 
-        plt.ylabel(ylabel)
-        plt.legend()
-        plt.grid(axis='y', color=GRID_COLOR)
-        plt.tight_layout()
+            self.set_axis_lables(x_values)
 
-        img_name = f"{uuid.uuid4()}"
-        img_buffer = io.BytesIO()
-        plt.savefig("line.png", format='png')
-        plt.savefig(img_buffer, format='png')
+            plt.ylabel(ylabel)
+            plt.legend()
+            plt.grid(axis='y', color=GRID_COLOR)
+            plt.tight_layout()
+
+            img_name = f"{uuid.uuid4()}"
+            img_buffer = io.BytesIO()
+            plt.savefig("line.png", format='png')
+            plt.savefig(img_buffer, format='png')
+            plt.close()
 
         self.img_cache.add_image(img_name, img_buffer)
 
@@ -156,8 +336,12 @@ class ToolsHandler(T2SQLTools):
         - list of lists with the data_series_values for each data series, the upper level list has the same size as the name list above
         - list of lists with the x_values for each data series. The length of this list is equal with number of series.
         """
+        return self._group_chart_data(self.data(sql), xfield, line_name, line_value)
 
-        chart_data = self.data(sql)
+    def _group_chart_data(
+        self, chart_data: list[dict[str, str]], xfield: str, line_name: str, line_value: str
+    ) -> tuple[list[str], list[list[str]], list[list[str]]]:
+        """Same as _build_chart_data, but works on the already fetched result of the query."""
         if not chart_data:
             raise ValueError("No data returned from the SQL query.")
 
@@ -182,8 +366,9 @@ class ToolsHandler(T2SQLTools):
         self, values_scale: list[str] | list[float], invert_order: bool = False
     ) -> list[tuple[float, float, float, float]]:
         flat_y_values_float = [float(y) for y in values_scale]
+        from matplotlib.colors import ListedColormap, Normalize
+
         norm = Normalize(min(flat_y_values_float), max(flat_y_values_float))
-        from matplotlib.colors import ListedColormap
 
         color_list = COLORS[::-1] if invert_order else COLORS
         if len(values_scale) < len(COLORS):
@@ -226,40 +411,46 @@ class ToolsHandler(T2SQLTools):
 
         # Group the bars around the labels (grouped bar chart)
         import numpy as np
+        from matplotlib import pyplot as plt
 
         num_series = len(y_values_for_x_labels)
         num_labels = len(x_labels_set)
         x = np.arange(num_labels)
         width = 0.8 / num_series if num_series > 0 else 0.8  # total width for all bars at one x-tick
 
-        plt.figure(figsize=(10, 5))
-        for i, y in enumerate(y_values_for_x_labels):
-            plt.bar(x + i * width, y, width=width, label=data_series_names[i], color=bar_colors[i], edgecolor='grey')
+        with _pyplot_lock:
+            deadline.check()
+            plt.figure(figsize=(10, 5))
+            for i, y in enumerate(y_values_for_x_labels):
+                plt.bar(x + i * width, y, width=width, label=data_series_names[i], color=bar_colors[i], edgecolor='grey')
 
-        plt.xticks(x + width * (num_series - 1) / 2, x_labels_set, rotation=45, ha='right')
+            plt.xticks(x + width * (num_series - 1) / 2, x_labels_set, rotation=45, ha='right')
 
-        # plt.figure(figsize=(10, 5))
-        # for i, y in enumerate(y_values_for_x_labels):
-        #     plt.bar(x_labels_set, y, label=data_series_names[i], color=bar_colors[i], edgecolor='grey')
+            # plt.figure(figsize=(10, 5))
+            # for i, y in enumerate(y_values_for_x_labels):
+            #     plt.bar(x_labels_set, y, label=data_series_names[i], color=bar_colors[i], edgecolor='grey')
 
-        # self.set_axis_lables(x_labels)
+            # self.set_axis_lables(x_labels)
 
-        plt.ylabel(ylabel)
-        plt.legend()
-        plt.grid(axis='y', color=GRID_COLOR)
-        plt.tight_layout()
+            plt.ylabel(ylabel)
+            plt.legend()
+            plt.grid(axis='y', color=GRID_COLOR)
+            plt.tight_layout()
 
-        img_name = f"{uuid.uuid4()}"
-        img_buffer = io.BytesIO()
-        plt.savefig(img_buffer, format='png')
-        plt.savefig("bar2.png", format='png')
+            img_name = f"{uuid.uuid4()}"
+            img_buffer = io.BytesIO()
+            plt.savefig(img_buffer, format='png')
+            plt.savefig("bar2.png", format='png')
+            plt.close()
         self.img_cache.add_image(img_name, img_buffer)
 
         return img_name
 
     def _generate_chart(self, chart_type: str, x_axis: list[str], y_axis: list[float], y_axis_label: str, title: str):
+        from matplotlib import pyplot as plt
+        from matplotlib.colors import ListedColormap, Normalize
+
         norm = Normalize(min(y_axis), max(y_axis))
-        from matplotlib.colors import ListedColormap
 
         cmap = ListedColormap(COLORS)
         bar_colors = [cmap(norm(y)) for y in y_axis]
@@ -296,5 +487,17 @@ class ToolsHandler(T2SQLTools):
     def get_image(self, name: str) -> ImgData | None:
         return self.img_cache.get_image(name)
 
+    def add_table(self, rows: list[dict[str, Any]]) -> TableData:
+        return self.table_cache.add_table(rows)
+
+    def get_table(self, table_id: str) -> TableData | None:
+        return self.table_cache.get_table(table_id)
+
+    def add_query(self, sql: str) -> str:
+        return self.query_cache.add_query(sql)
+
+    def get_query(self, handle: str) -> str | None:
+        return self.query_cache.get_query(handle)
+
     def call_function(self, name: str, args: dict[str, object]) -> str:
         raise NotImplementedError("call_function has to be implemented in the subclass")
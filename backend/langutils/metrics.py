@@ -0,0 +1,336 @@
+"""Process-wide counters and histograms, exposed in the Prometheus text format by the /metrics endpoint of the API.
+
+Only the small subset of the Prometheus client that the shell needs is implemented here (labelled counters, gauges and histograms), so
+that no new dependency is pulled in. Every metric is safe to update from worker threads and from the event loop alike.
+
+The metrics live in the memory of one process. Under serve.py the requests are spread over several workers and a scrape lands on any of
+them, so the workers share their metrics through METRICS_DIR (serve.py sets it with more than one worker): each writes its values to a file
+of its own there every METRICS_FLUSH_INTERVAL seconds, and /metrics adds up the files of all of them. Counters and histograms are summed,
+those of workers gone included so that they never go down; gauges are given per live worker, with a worker label holding its pid.
+"""
+
+import json
+import math
+import os
+import threading
+import time
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from typing import AbstractSet, Any, Iterable, Iterator
+
+# Prometheus' default buckets stretched to the minute, since LLM round trips routinely take tens of seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+ROW_BUCKETS = (0, 1, 10, 100, 1000, 10000, 100000, 1000000)
+COUNT_BUCKETS = (0, 1, 2, 3, 4, 5, 8, 13)
+
+LabelValues = tuple[str, ...]
+# the values of a metric in each worker process, see Metric.combine
+Snapshots = dict[str, dict[LabelValues, Any]]
+
+# directory through which the worker processes share their metrics, see share()
+METRICS_DIR = os.getenv("METRICS_DIR", "")
+METRICS_FLUSH_INTERVAL = float(os.getenv("METRICS_FLUSH_INTERVAL", "5"))
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _format_labels(names: Iterable[str], values: Iterable[str]) -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_number(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class Metric(ABC):
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames: tuple[str, ...] = tuple(labelnames)
+        self._lock = threading.Lock()
+        REGISTRY.register(self)
+
+    def _key(self, labels: dict[str, str]) -> LabelValues:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"Metric {self.name} takes the labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    @abstractmethod
+    def snapshot(self) -> dict[LabelValues, Any]:
+        """A copy of the values of the metric by label values, as JSON can hold them."""
+
+    @abstractmethod
+    def samples(self, values: dict[LabelValues, Any] | None = None, labelnames: tuple[str, ...] | None = None) -> list[str]:
+        """The exposition lines of values (by default those of this process), labelled with labelnames (by default those of the metric)."""
+
+    def combine(self, snapshots: Snapshots, live: AbstractSet[str]) -> tuple[dict[LabelValues, Any], tuple[str, ...]]:
+        """The values of several processes as one, and their label names. snapshots holds the values of each process by the name of its
+        file, live the names of the processes still running. Sums them by default.
+        """
+        combined: dict[LabelValues, Any] = {}
+        for values in snapshots.values():
+            for key, value in values.items():
+                combined[key] = combined[key] + value if key in combined else value
+        return combined, self.labelnames
+
+    def expose(self, values: dict[LabelValues, Any] | None = None, labelnames: tuple[str, ...] | None = None) -> str:
+        header = f"# HELP {self.name} {_escape(self.documentation)}\n# TYPE {self.name} {self.kind}\n"
+        return header + "".join(line + "\n" for line in self.samples(values, labelnames))
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: dict[LabelValues, float] = {}
+
+    def inc(self, amount: float = 1.0, **labels: str) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def value(self, **labels: str) -> float:
+        with self._lock:
+            return self._values.get(self._key(labels), 0.0)
+
+    def snapshot(self) -> dict[LabelValues, Any]:
+        with self._lock:
+            return dict(self._values)
+
+    def samples(self, values: dict[LabelValues, Any] | None = None, labelnames: tuple[str, ...] | None = None) -> list[str]:
+        items = sorted((self.snapshot() if values is None else values).items())
+        names = self.labelnames if labelnames is None else labelnames
+        return [f"{self.name}{_format_labels(names, key)} {_format_number(value)}" for key, value in items]
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: dict[LabelValues, float] = {}
+
+    def set(self, value: float, **labels: str) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def snapshot(self) -> dict[LabelValues, Any]:
+        with self._lock:
+            return dict(self._values)
+
+    def samples(self, values: dict[LabelValues, Any] | None = None, labelnames: tuple[str, ...] | None = None) -> list[str]:
+        items = sorted((self.snapshot() if values is None else values).items())
+        names = self.labelnames if labelnames is None else labelnames
+        return [f"{self.name}{_format_labels(names, key)} {_format_number(value)}" for key, value in items]
+
+    def combine(self, snapshots: Snapshots, live: AbstractSet[str]) -> tuple[dict[LabelValues, Any], tuple[str, ...]]:
+        # the state of a worker does not add up with that of the others, and means nothing once it is gone
+        combined = {
+            key + (worker.split("-")[0],): value for worker, values in snapshots.items() if worker in live for key, value in values.items()
+        }
+        return combined, self.labelnames + ("worker",)
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = (), buckets: Iterable[float] = LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets: tuple[float, ...] = tuple(sorted(buckets)) + (math.inf,)
+        # per label set: the count of observations falling into each bucket (not cumulative), the sum and the count
+        self._values: dict[LabelValues, tuple[list[int], list[float]]] = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = self._key(labels)
+        index = next(i for i, bound in enumerate(self.buckets) if value <= bound)
+        with self._lock:
+            counts, total = self._values.setdefault(key, ([0] * len(self.buckets), [0.0]))
+            counts[index] += 1
+            total[0] += value
+
+    @contextmanager
+    def time(self, **labels: str) -> Iterator[None]:
+        """Observes the wall time spent in the block, in seconds, whether or not it raises."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def count(self, **labels: str) -> int:
+        with self._lock:
+            entry = self._values.get(self._key(labels))
+            return sum(entry[0]) if entry else 0
+
+    def snapshot(self) -> dict[LabelValues, Any]:
+        with self._lock:
+            return {key: (list(counts), total[0]) for key, (counts, total) in self._values.items()}
+
+    def combine(self, snapshots: Snapshots, live: AbstractSet[str]) -> tuple[dict[LabelValues, Any], tuple[str, ...]]:
+        combined: dict[LabelValues, Any] = {}
+        for values in snapshots.values():
+            for key, (counts, total) in values.items():
+                if key in combined:
+                    counts = [a + b for a, b in zip(combined[key][0], counts)]
+                    total += combined[key][1]
+                combined[key] = (counts, total)
+        return combined, self.labelnames
+
+    def samples(self, values: dict[LabelValues, Any] | None = None, labelnames: tuple[str, ...] | None = None) -> list[str]:
+        items = sorted((self.snapshot() if values is None else values).items())
+        names = self.labelnames if labelnames is None else labelnames
+        lines: list[str] = []
+        for key, (counts, total) in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                labels = _format_labels(names + ("le",), key + (_format_number(bound),))
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(names, key)
+            lines.append(f"{self.name}_sum{labels} {_format_number(total)}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+def _alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: dict[str, Metric] = {}
+        self._lock = threading.Lock()
+        # set by share(): the directory of the metrics of all the workers, and the file of this one in it
+        self.directory = ""
+        self._path = ""
+        self._stopping = threading.Event()
+        self._flushing = threading.Lock()
+
+    def register(self, metric: Metric) -> None:
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError(f"Metric {metric.name} is already registered")
+            self._metrics[metric.name] = metric
+
+    def share(self, directory: str = METRICS_DIR, interval: float = METRICS_FLUSH_INTERVAL) -> None:
+        """Writes the metrics of this process to directory every interval seconds, for expose() in any process sharing it to add them up.
+        Called in each worker process after the fork, as the thread writing them does not survive it.
+        """
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        # the start time tells apart a process reusing the pid of a worker gone, whose counts must be kept
+        self._path = os.path.join(directory, f"{os.getpid()}-{time.time_ns()}.json")
+        self._stopping.clear()
+        self.flush()
+        threading.Thread(target=self._run, args=(interval,), name="metrics-flush", daemon=True).start()
+
+    def _run(self, interval: float) -> None:
+        while not self._stopping.wait(interval):
+            self.flush()
+
+    def stop(self) -> None:
+        """Writes the metrics of this process one last time and stops sharing them, for a worker about to exit."""
+        if self._path:
+            self._stopping.set()
+            self.flush()
+
+    def flush(self) -> None:
+        with self._lock:
+            metrics = list(self._metrics.values())
+        values = {metric.name: [[list(key), value] for key, value in metric.snapshot().items()] for metric in metrics}
+        temporary = f"{self._path}.tmp"
+        with self._flushing:
+            with open(temporary, "w") as f:
+                json.dump({"pid": os.getpid(), "metrics": values}, f)
+            # readers see the previous file or the new one, never half of one
+            os.replace(temporary, self._path)
+
+    def _snapshots(self) -> tuple[dict[str, Snapshots], set[str]]:
+        """The values of every metric by worker (the name of its file, <pid>-<start time>), and the workers still running."""
+        snapshots: dict[str, Snapshots] = {}
+        # the latest file of each pid, the others being those of workers gone whose pid was reused
+        latest: dict[int, tuple[int, str]] = {}
+        for name in os.listdir(self.directory):
+            if not name.endswith(".json"):
+                continue
+            try:
+                with open(os.path.join(self.directory, name)) as f:
+                    state = json.load(f)
+            except (OSError, ValueError):
+                continue
+            worker = name[: -len(".json")]
+            started = int(worker.split("-")[1])
+            if state["pid"] not in latest or latest[state["pid"]][0] < started:
+                latest[state["pid"]] = (started, worker)
+            for metric, values in state["metrics"].items():
+                snapshots.setdefault(metric, {})[worker] = {tuple(key): value for key, value in values}
+        return snapshots, {worker for pid, (_, worker) in latest.items() if _alive(pid)}
+
+    def expose(self) -> str:
+        """The current value of every metric in the Prometheus text exposition format, version 0.0.4: that of this process, or that of
+        all the workers sharing the directory of share().
+        """
+        with self._lock:
+            metrics = list(self._metrics.values())
+        if not self._path:
+            return "".join(metric.expose() for metric in metrics)
+        self.flush()
+        snapshots, live = self._snapshots()
+        return "".join(metric.expose(*metric.combine(snapshots.get(metric.name, {}), live)) for metric in metrics)
+
+
+REGISTRY = Registry()
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def timed_chunks(chunks: Iterable[str], histogram: Histogram, **labels: str) -> Iterator[str]:
+    """Passes the chunks of a lazy renderer through, observing the time spent producing them but not the time the consumer holds them."""
+    spent = 0.0
+    iterator = iter(chunks)
+    try:
+        while True:
+            start = time.perf_counter()
+            try:
+                chunk = next(iterator)
+            except StopIteration:
+                spent += time.perf_counter() - start
+                return
+            spent += time.perf_counter() - start
+            yield chunk
+    finally:
+        histogram.observe(spent, **labels)
+
+
+# The metrics of the chat pipeline. stage is one of: request, triage, evaluator_step, tool, validate_sql, sql, chart, serialize.
+STAGE_SECONDS = Histogram("dm050_stage_duration_seconds", "Time spent in each stage of serving a chat request", ["stage"])
+REQUESTS = Counter("dm050_requests_total", "Chat requests served by the shell, by outcome", ["outcome"])
+TRIAGE = Counter(
+    "dm050_triage_total", "Questions triaged by the rules of dm050.triage (path rules, the fast path) or by the LLM (path llm)", ["path"]
+)
+DOMAINS = Counter("dm050_domain_total", "Data domain chosen by the triage stage ('none' when no single domain was found)", ["domain"])
+TOOL_CALLS = Counter("dm050_tool_calls_total", "Tool calls made by the evaluator, by tool", ["tool"])
+TOOL_CALLS_PER_REQUEST = Histogram("dm050_tool_calls_per_request", "Tool calls made while answering one request", buckets=COUNT_BUCKETS)
+SQL_ROWS = Histogram("dm050_sql_rows", "Rows returned by a query", buckets=ROW_BUCKETS)
+WRONG_ANSWERS = Counter(
+    "dm050_wrong_answers_total", "Malformed evaluator output: rejected tool calls and unusable final answers", ["where"]
+)
+ADMISSION = Gauge("dm050_admission", "State of the chat admission controller (active and queued requests, rejections)", ["field"])
+USER_ADMISSION = Gauge(
+    "dm050_user_admission", "Per user state of the chat admission controller (active, queued, admitted, rejected, waits)", ["user", "field"]
+)
+JOBS = Counter("dm050_jobs_total", "Jobs run by the job workers, by outcome (answered, failed, expired, malformed)", ["outcome"])
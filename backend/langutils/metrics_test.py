@@ -0,0 +1,84 @@
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+
+from langutils.metrics import Counter, Gauge, Histogram, Metric, Registry, timed_chunks
+import langutils.metrics as metrics
+
+
+class TestMetrics(unittest.TestCase):
+    def setUp(self):
+        # keep the test metrics out of the process-wide registry
+        self.registry = Registry()
+        self._registry, metrics.REGISTRY = metrics.REGISTRY, self.registry
+
+    def tearDown(self):
+        metrics.REGISTRY = self._registry
+
+    def test_counter_exposition(self):
+        counter = Counter("t_calls_total", "Calls", ["tool"])
+        counter.inc(tool="get_data")
+        counter.inc(2, tool="get_data")
+        self.assertEqual(counter.value(tool="get_data"), 3)
+        self.assertIn('t_calls_total{tool="get_data"} 3\n', self.registry.expose())
+
+    def test_histogram_buckets_are_cumulative(self):
+        histogram = Histogram("t_seconds", "Latency", ["stage"], buckets=(0.1, 1.0))
+        for value in (0.05, 0.5, 5.0):
+            histogram.observe(value, stage="sql")
+        text = self.registry.expose()
+        self.assertIn('t_seconds_bucket{stage="sql",le="0.1"} 1\n', text)
+        self.assertIn('t_seconds_bucket{stage="sql",le="1"} 2\n', text)
+        self.assertIn('t_seconds_bucket{stage="sql",le="+Inf"} 3\n', text)
+        self.assertIn('t_seconds_count{stage="sql"} 3\n', text)
+        self.assertIn("# TYPE t_seconds histogram\n", text)
+
+    def test_wrong_labels_are_refused(self):
+        with self.assertRaises(ValueError):
+            Counter("t_bad_total", "Bad", ["tool"]).inc(stage="x")
+
+    def test_timed_chunks(self):
+        histogram = Histogram("t_render_seconds", "Rendering", ["stage"])
+        self.assertEqual(list(timed_chunks(iter(["a", "b"]), histogram, stage="serialize")), ["a", "b"])
+        self.assertEqual(histogram.count(stage="serialize"), 1)
+
+    def test_metric_is_abstract(self):
+        with self.assertRaises(TypeError):
+            Metric("t_abstract", "Abstract")  # type: ignore[abstract]
+
+    def test_workers_are_added_up(self):
+        counter = Counter("t_requests_total", "Requests", ["outcome"])
+        histogram = Histogram("t_latency_seconds", "Latency", buckets=(1.0,))
+        gauge = Gauge("t_active", "Active requests")
+        counter.inc(outcome="ok")
+        histogram.observe(0.5)
+        gauge.set(2)
+        # the parent of this process stands for a live worker, a process run to completion for a worker gone
+        gone = subprocess.run([sys.executable, "-c", "import os; print(os.getpid())"], capture_output=True, text=True).stdout.strip()
+        others = {
+            f"{os.getppid()}-1": {"t_requests_total": [[["ok"], 2]], "t_latency_seconds": [[[], [[0, 1], 3.0]]], "t_active": [[[], 5]]},
+            f"{gone}-1": {"t_requests_total": [[["ok"], 4]], "t_active": [[[], 7]]},
+        }
+        with tempfile.TemporaryDirectory() as directory:
+            for worker, values in others.items():
+                with open(os.path.join(directory, f"{worker}.json"), "w") as f:
+                    json.dump({"pid": int(worker.split("-")[0]), "metrics": values}, f)
+            self.registry.share(directory, interval=3600)
+            try:
+                text = self.registry.expose()
+            finally:
+                self.registry.stop()
+        self.assertIn('t_requests_total{outcome="ok"} 7\n', text)
+        self.assertIn('t_latency_seconds_bucket{le="1"} 1\n', text)
+        self.assertIn('t_latency_seconds_count 2\n', text)
+        self.assertIn('t_latency_seconds_sum 3.5\n', text)
+        self.assertIn(f't_active{{worker="{os.getpid()}"}} 2\n', text)
+        self.assertIn(f't_active{{worker="{os.getppid()}"}} 5\n', text)
+        self.assertNotIn(f'worker="{gone}"', text)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,168 @@
+"""On-demand profiling of a single chat request.
+
+A request carrying the PROFILE_TOKEN of the server is answered under a sampling profiler; without it nothing at all is done. Every
+PROFILE_INTERVAL seconds a thread takes the stack of each task working for the request (the tasks it creates are followed through a task
+factory installed on the event loop while a profile runs): the frames it is running, or the coroutines it is suspended in and what they
+await. Wall-clock time thus shows up where it is spent, waiting for the LLM or the database included, which a CPU profile of the event loop
+would not show. The samples are written in the folded stack format read by flamegraph.pl and speedscope to
+LOG_DIR/profiles/<profile id>.folded when the answer is over. The work done in worker threads (asyncio.to_thread) is seen from the task
+awaiting it, not inside the thread.
+"""
+
+import asyncio
+import hmac
+import logging
+import os
+import sys
+import threading
+import uuid
+from collections import Counter
+from contextvars import ContextVar
+from types import FrameType
+from typing import Any, AsyncIterator, TypeVar
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+# requests are profiled only if this is set and they present it, as X-Profile-Token header or ?profile= query parameter
+PROFILE_TOKEN = os.getenv("PROFILE_TOKEN", "")
+PROFILE_INTERVAL = float(os.getenv("PROFILE_INTERVAL", "0.01"))
+PROFILE_DIR = os.path.join(os.getenv("LOG_DIR", "./log"), "profiles")
+
+T = TypeVar("T")
+
+_current: ContextVar["Sampler | None"] = ContextVar("profiler", default=None)
+
+
+def authorized(token: str | None) -> bool:
+    return bool(PROFILE_TOKEN) and token is not None and hmac.compare_digest(token.encode(), PROFILE_TOKEN.encode())
+
+
+def _label(frame: FrameType) -> str:
+    code = frame.f_code
+    # ';' separates the frames of a folded stack
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})".replace(";", ":")
+
+
+def _awaited(awaitable: Any) -> tuple[list[FrameType], Any]:
+    """The frames of a chain of suspended coroutines (and generators) and what the innermost one awaits."""
+    frames: list[FrameType] = []
+    while awaitable is not None:
+        frame = getattr(awaitable, "cr_frame", None) or getattr(awaitable, "ag_frame", None) or getattr(awaitable, "gi_frame", None)
+        if frame is None:
+            break
+        frames.append(frame)
+        awaitable = getattr(awaitable, "cr_await", None) or getattr(awaitable, "ag_await", None) or getattr(awaitable, "gi_yieldfrom", None)
+    return frames, awaitable
+
+
+class Sampler:
+    """Samples the stacks of the tasks of one request. The tasks are tracked from the event loop; the sampling thread only reads them."""
+
+    def __init__(self, profile_id: str, interval: float = PROFILE_INTERVAL):
+        self.profile_id = profile_id
+        self.interval = interval
+        self.samples: Counter[str] = Counter()
+        self._tasks: list[asyncio.Task[Any]] = []
+        self._loop_thread = threading.get_ident()
+        self._stopping = threading.Event()
+        self._thread = threading.Thread(target=self._run, name=f"profiler-{profile_id[:8]}", daemon=True)
+
+    def track(self, task: "asyncio.Task[Any]") -> None:
+        self._tasks.append(task)
+
+    def start(self) -> None:
+        self._loop_thread = threading.get_ident()
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stopping.set()
+        self._thread.join()
+
+    def _run(self) -> None:
+        while not self._stopping.wait(self.interval):
+            self.sample()
+
+    def sample(self) -> None:
+        running = []
+        frame = sys._current_frames().get(self._loop_thread)
+        while frame is not None:
+            running.append(frame)
+            frame = frame.f_back
+        running.reverse()
+        for task in list(self._tasks):
+            coro = task.get_coro()
+            if task.done() or (root := getattr(coro, "cr_frame", None)) is None:
+                continue
+            name = getattr(coro, "__qualname__", task.get_name())
+            if root in running:
+                labels = [_label(frame) for frame in running[running.index(root) :]]
+            else:
+                frames, awaited = _awaited(coro)
+                labels = [_label(frame) for frame in frames] + ([f"<awaiting {type(awaited).__name__}>"] if awaited is not None else [])
+            self.samples[";".join([name] + labels)] += 1
+
+    def write(self, directory: str = PROFILE_DIR) -> str:
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, f"{self.profile_id}.folded")
+        with open(path, "w") as f:
+            for stack, count in sorted(self.samples.items()):
+                f.write(f"{stack} {count}\n")
+        return path
+
+
+# the task factory of the loop is replaced while at least one profile runs, and put back afterwards
+_active: set[Sampler] = set()
+_previous_factory: Any = None
+
+
+def _task_factory(loop: asyncio.AbstractEventLoop, coro: Any, **kwargs: Any) -> "asyncio.Future[Any]":
+    task = _previous_factory(loop, coro, **kwargs) if _previous_factory is not None else asyncio.Task(coro, loop=loop, **kwargs)
+    # the factory runs in the context of the code creating the task: the tasks of a profiled request are tracked by its sampler
+    if (sampler := _current.get()) is not None and isinstance(task, asyncio.Task):
+        sampler.track(task)
+    return task
+
+
+def _install(sampler: Sampler) -> None:
+    global _previous_factory
+    loop = asyncio.get_running_loop()
+    if not _active:
+        _previous_factory = loop.get_task_factory()
+        loop.set_task_factory(_task_factory)
+    _active.add(sampler)
+
+
+def _uninstall(sampler: Sampler) -> None:
+    _active.discard(sampler)
+    if not _active:
+        asyncio.get_running_loop().set_task_factory(_previous_factory)
+
+
+def new_profile_id() -> str:
+    return uuid.uuid4().hex
+
+
+async def profiled(
+    stream: AsyncIterator[T], profile_id: str, interval: float = PROFILE_INTERVAL, directory: str = PROFILE_DIR
+) -> AsyncIterator[T]:
+    """Passes the items of stream through while sampling the task consuming it and the tasks started while producing them."""
+    sampler = Sampler(profile_id, interval)
+    current = asyncio.current_task()
+    if current is not None:
+        sampler.track(current)
+    _current.set(sampler)
+    _install(sampler)
+    sampler.start()
+    try:
+        async for item in stream:
+            yield item
+    finally:
+        try:
+            await stream.aclose()  # type: ignore[attr-defined]
+        finally:
+            sampler.stop()
+            _uninstall(sampler)
+            _current.set(None)
+            path = sampler.write(directory)
+            logger.info(f"Profile {profile_id} written to {path} ({sum(sampler.samples.values())} samples)")
@@ -0,0 +1,36 @@
+import asyncio
+import os
+import tempfile
+import unittest
+
+from langutils import profiling
+
+
+async def _slow_step() -> str:
+    await asyncio.sleep(0.1)
+    return "answer"
+
+
+async def _answer():
+    # the work runs in a task of its own, as in dm050.shell.arequest_stream
+    yield await asyncio.create_task(_slow_step())
+
+
+class TestProfiling(unittest.TestCase):
+    def test_tasks_of_the_request_are_sampled(self):
+        async def scenario(directory: str):
+            factory = asyncio.get_running_loop().get_task_factory()
+            items = [item async for item in profiling.profiled(_answer(), "p1", interval=0.005, directory=directory)]
+            return items, factory is asyncio.get_running_loop().get_task_factory()
+
+        with tempfile.TemporaryDirectory() as directory:
+            items, restored = asyncio.run(scenario(directory))
+            with open(os.path.join(directory, "p1.folded")) as f:
+                stacks = f.read()
+        self.assertEqual(items, ["answer"])
+        self.assertTrue(restored)
+        self.assertIn("_slow_step;_slow_step (profiling_test.py:9);sleep", stacks)
+
+    def test_token_is_required(self):
+        self.assertFalse(profiling.authorized(None))
+        self.assertFalse(profiling.authorized("anything"))
@@ -0,0 +1,94 @@
+import os
+import sqlite3
+import threading
+import time
+
+# evictions run at most this often (seconds); between two of them the store may exceed its budget by what has been put meanwhile
+EVICTION_INTERVAL = 10.0
+
+
+class SharedStore:
+    """Blobs keyed by (kind, id) in an SQLite database in WAL mode, so that every worker process on the host sees what any of them has put.
+    The chart and table caches of the tools write through to it and fall back to it on a miss, hence a chart or a table page requested
+    from a worker other than the one that produced it is still found.
+    Entries expire after the ttl given to put(); above max_bytes the oldest entries are dropped. Each thread of each process uses its own
+    connection.
+    """
+
+    def __init__(self, path: str, max_bytes: int):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._local = threading.local()
+        self._last_eviction = 0.0
+        with self._connection() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS blobs (kind TEXT NOT NULL, id TEXT NOT NULL, created REAL NOT NULL, expires REAL NOT NULL, "
+                "size INTEGER NOT NULL, data BLOB NOT NULL, PRIMARY KEY (kind, id))"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS blobs_created ON blobs (created)")
+
+    def _connection(self) -> sqlite3.Connection:
+        # connections must not cross a fork, hence the pid check
+        conn: sqlite3.Connection | None = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=10.0)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def put(self, kind: str, key: str, data: bytes, ttl_seconds: float) -> None:
+        now = time.time()
+        with self._connection() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO blobs (kind, id, created, expires, size, data) VALUES (?, ?, ?, ?, ?, ?)",
+                (kind, key, now, now + ttl_seconds, len(data), data),
+            )
+        if now - self._last_eviction > EVICTION_INTERVAL:
+            self._last_eviction = now
+            self.evict()
+
+    def get(self, kind: str, key: str) -> bytes | None:
+        row = self._connection().execute(
+            "SELECT data FROM blobs WHERE kind = ? AND id = ? AND expires > ?", (kind, key, time.time())
+        ).fetchone()
+        return row[0] if row is not None else None
+
+    def evict(self) -> None:
+        """Drops the expired entries, then the oldest ones while the store is over its budget."""
+        with self._connection() as conn:
+            conn.execute("DELETE FROM blobs WHERE expires <= ?", (time.time(),))
+            total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM blobs").fetchone()[0]
+            if total <= self.max_bytes:
+                return
+            excess = total - self.max_bytes
+            freed = 0
+            victims: list[tuple[str, str]] = []
+            for kind, key, size in conn.execute("SELECT kind, id, size FROM blobs ORDER BY created"):
+                victims.append((kind, key))
+                freed += size
+                if freed >= excess:
+                    break
+            conn.executemany("DELETE FROM blobs WHERE kind = ? AND id = ?", victims)
+
+    def size(self) -> int:
+        return self._connection().execute("SELECT COALESCE(SUM(size), 0) FROM blobs").fetchone()[0]
+
+
+_store: SharedStore | None = None
+_store_lock = threading.Lock()
+
+
+def shared_store() -> SharedStore | None:
+    """The store of the process, configured by SHARED_STORE (path of the database file; unset means no sharing, which is fine for a
+    single worker) and SHARED_STORE_MAX_MB (size budget, default 512).
+    """
+    global _store
+    path = os.getenv("SHARED_STORE", "")
+    if not path:
+        return None
+    with _store_lock:
+        if _store is None or _store.path != path:
+            _store = SharedStore(path, int(float(os.getenv("SHARED_STORE_MAX_MB", "512")) * 1024 * 1024))
+        return _store
@@ -0,0 +1,50 @@
+import io
+import os
+import tempfile
+import unittest
+
+from langutils.llm_tools import ImgCache, TableCache
+from langutils.shared_store import SharedStore
+
+
+class TestSharedStore(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, "shared.db")
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_visible_through_another_instance(self):
+        SharedStore(self.path, 1 << 20).put("image", "a", b"png", 60)
+        self.assertEqual(SharedStore(self.path, 1 << 20).get("image", "a"), b"png")
+        self.assertIsNone(SharedStore(self.path, 1 << 20).get("table", "a"))
+
+    def test_expired_entries_are_not_returned(self):
+        store = SharedStore(self.path, 1 << 20)
+        store.put("image", "a", b"png", -1)
+        self.assertIsNone(store.get("image", "a"))
+
+    def test_oldest_entries_go_over_budget(self):
+        store = SharedStore(self.path, 25)
+        for key in "abc":
+            store.put("image", key, b"x" * 10, 60)
+        store.evict()
+        self.assertIsNone(store.get("image", "a"))
+        self.assertEqual(store.get("image", "c"), b"x" * 10)
+        self.assertLessEqual(store.size(), 25)
+
+    def test_caches_fall_back_to_the_store(self):
+        ImgCache(SharedStore(self.path, 1 << 20)).add_image("img", io.BytesIO(b"png"))
+        img = ImgCache(SharedStore(self.path, 1 << 20)).get_image("img")
+        self.assertIsNotNone(img)
+        self.assertEqual(img.img_buffer.getvalue(), b"png")
+
+        table = TableCache(store=SharedStore(self.path, 1 << 20)).add_table([{"a": 2}, {"a": 1}])
+        copy = TableCache(store=SharedStore(self.path, 1 << 20)).get_table(table.table_id)
+        self.assertIsNotNone(copy)
+        self.assertEqual(copy.page(0, 10, ["a"]), [{"a": 1}, {"a": 2}])
+
+
+if __name__ == "__main__":
+    unittest.main()
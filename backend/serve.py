@@ -0,0 +1,241 @@
+"""Production launcher: preloads the application in a parent process, then forks worker processes serving the same listening socket.
+
+Usage (from the backend directory):
+
+    python serve.py [--host 0.0.0.0] [--port 80] [--workers N] [--max-worker-memory-mb 0] [--max-requests 0]
+
+Everything that is read-only after startup (the FastAPI app with the DM050 prompts, tool dictionaries and prefix.txt, sqlglot's T-SQL
+dialect, matplotlib with its font cache, the similarity cache when SIMILARITY_QUERY is set) is loaded once in the parent and shared with
+the workers copy-on-write; gc.freeze() keeps the collector from dirtying those pages. What must not cross a fork (the OpenAI clients, the
+database connections, the shell itself) is built by the lifespan of each worker.
+
+The parent supervises the workers: a worker that exits is replaced, and a worker whose private memory (the pages it does not share with
+the parent) grows over --max-worker-memory-mb is recycled, its replacement being started before it is asked to finish its requests and
+stop. --max-requests recycles workers after a number of requests as well. Defaults come from WEB_CONCURRENCY (number of CPUs),
+WORKER_MAX_MEMORY_MB and WORKER_MAX_REQUESTS. With more than one worker, charts, table snapshots and sessions are shared through SQLite
+files and the metrics through METRICS_DIR, so that /metrics counts the requests of all the workers (see share_between_workers).
+start.py remains the development server.
+"""
+
+import argparse
+import atexit
+import gc
+import os
+import shutil
+import signal
+import socket
+import tempfile
+import time
+from typing import Callable
+
+from dotenv import load_dotenv
+from loguru import logger
+
+from langutils.metrics import REGISTRY
+
+# seconds a recycled or stopped worker gets to finish its requests before it is killed
+GRACEFUL_TIMEOUT = 60
+
+
+def preload() -> None:
+    import api.api  # noqa: F401  the app, dm050 prompts, tool dictionaries, prefix.txt
+    from api.warmup import warm_up_sql
+    from langutils.llm_tools import warm_up_charts
+
+    warm_up_charts()
+    warm_up_sql()
+
+    # the application imports these on first use only, so that it starts quickly; the workers would each load their own copy otherwise
+    import openai  # noqa: F401
+    import psycopg  # noqa: F401
+    import rapidfuzz.fuzz  # noqa: F401
+
+    if similarity_query := os.getenv("SIMILARITY_QUERY", ""):
+        from langutils.context import SQLContext
+        from langutils.llm_tools import load_similarity_cache
+
+        load_similarity_cache(SQLContext(), similarity_query)
+
+    gc.collect()
+    gc.freeze()
+
+
+def share_between_workers() -> None:
+    """Charts, table snapshots and sessions must be visible to every worker, as the requests of a client may land on any of them, and
+    /metrics must count the requests of all of them. Unless configured otherwise they go to SQLite files and the metrics to a directory
+    in a temporary directory, which lives as long as this server.
+    """
+    if os.getenv("SHARED_STORE") and os.getenv("SESSION_DB") and os.getenv("METRICS_DIR"):
+        return
+    directory = tempfile.mkdtemp(prefix="dm050-")
+    atexit.register(shutil.rmtree, directory, ignore_errors=True)
+    os.environ.setdefault("SHARED_STORE", os.path.join(directory, "shared.db"))
+    os.environ.setdefault("SESSION_DB", os.path.join(directory, "sessions.db"))
+    os.environ.setdefault("METRICS_DIR", os.path.join(directory, "metrics"))
+    logger.info(
+        "Sharing charts and tables through {}, sessions through {}, metrics through {}",
+        os.environ["SHARED_STORE"],
+        os.environ["SESSION_DB"],
+        os.environ["METRICS_DIR"],
+    )
+
+
+def private_memory_mb(pid: int) -> float | None:
+    """Memory of the process not shared with others (USS), or its RSS where smaps_rollup is unavailable. None if the process is gone."""
+    try:
+        with open(f"/proc/{pid}/smaps_rollup") as f:
+            fields = dict(line.split(":", 1) for line in f if ":" in line)
+        return (int(fields["Private_Clean"].split()[0]) + int(fields["Private_Dirty"].split()[0])) / 1024.0
+    except (OSError, KeyError, ValueError):
+        pass
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024.0
+    except OSError:
+        return None
+    return None
+
+
+def run_worker(sock: socket.socket, args: argparse.Namespace) -> None:
+    import uvicorn
+
+    from api.api import app
+
+    for sig in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP):
+        signal.signal(sig, signal.SIG_DFL)
+    config = uvicorn.Config(
+        app,
+        lifespan="on",
+        # the lifespan of the app routes logging to loguru; uvicorn's own logging configuration would undo that
+        log_config=None,
+        limit_max_requests=args.max_requests or None,
+        timeout_graceful_shutdown=GRACEFUL_TIMEOUT,
+    )
+    uvicorn.Server(config).run(sockets=[sock])
+
+
+class Supervisor:
+    """Keeps args.workers forked processes running target, replacing those that exit and recycling those above
+    args.max_worker_memory_mb of private memory. The job workers of api.jobs are supervised the same way.
+    """
+
+    def __init__(self, target: Callable[[], None], args: argparse.Namespace):
+        self.target = target
+        self.args = args
+        self.workers: set[int] = set()
+        # pid -> deadline of the workers asked to stop
+        self.stopping: dict[int, float] = {}
+        self.shutdown = False
+
+    def spawn(self) -> None:
+        pid = os.fork()
+        if pid == 0:
+            code = 0
+            # the metrics of the workers are added up by /metrics when they share a directory (see langutils.metrics)
+            if directory := os.getenv("METRICS_DIR"):
+                REGISTRY.share(directory)
+            try:
+                self.target()
+            except BaseException:
+                logger.exception("Worker {} failed", os.getpid())
+                code = 1
+            finally:
+                REGISTRY.stop()
+                os._exit(code)
+        self.workers.add(pid)
+        logger.info("Worker {} started", pid)
+
+    def stop(self, pid: int) -> None:
+        if pid in self.stopping:
+            return
+        self.stopping[pid] = time.monotonic() + GRACEFUL_TIMEOUT + 5
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+
+    def reap(self) -> None:
+        while self.workers:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                self.workers.clear()
+                return
+            if pid == 0:
+                return
+            self.workers.discard(pid)
+            expected = self.stopping.pop(pid, None) is not None
+            logger.info("Worker {} exited with status {}", pid, os.waitstatus_to_exitcode(status))
+            if not self.shutdown and not expected:
+                self.spawn()
+
+    def check(self) -> None:
+        now = time.monotonic()
+        for pid, deadline in list(self.stopping.items()):
+            if now > deadline:
+                logger.warning("Worker {} did not stop in time, killing it", pid)
+                try:
+                    os.kill(pid, signal.SIGKILL)
+                except ProcessLookupError:
+                    pass
+        if not self.args.max_worker_memory_mb:
+            return
+        for pid in list(self.workers - set(self.stopping)):
+            memory = private_memory_mb(pid)
+            if memory is not None and memory > self.args.max_worker_memory_mb:
+                logger.info("Worker {} uses {:.0f} MB of private memory, recycling it", pid, memory)
+                self.spawn()
+                self.stop(pid)
+
+    def run(self) -> None:
+        def request_shutdown(signum, frame) -> None:
+            self.shutdown = True
+
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            signal.signal(sig, request_shutdown)
+        for _ in range(self.args.workers):
+            self.spawn()
+        while not self.shutdown:
+            time.sleep(self.args.check_interval)
+            self.reap()
+            self.check()
+        logger.info("Shutting down {} workers", len(self.workers))
+        for pid in list(self.workers):
+            self.stop(pid)
+        while self.workers:
+            time.sleep(0.2)
+            self.reap()
+            self.check()
+
+
+def main() -> None:
+    load_dotenv()
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=80)
+    parser.add_argument("--workers", type=int, default=int(os.getenv("WEB_CONCURRENCY", "0")) or os.cpu_count() or 1)
+    parser.add_argument("--max-worker-memory-mb", type=float, default=float(os.getenv("WORKER_MAX_MEMORY_MB", "0")))
+    parser.add_argument("--max-requests", type=int, default=int(os.getenv("WORKER_MAX_REQUESTS", "0")))
+    parser.add_argument("--check-interval", type=float, default=5.0, help="seconds between two memory checks of the workers")
+    args = parser.parse_args()
+    # the workers divide the per user quotas of the admission controller between them (see api.admission)
+    os.environ["WEB_CONCURRENCY"] = str(args.workers)
+
+    if args.workers > 1:
+        share_between_workers()
+
+    sock = socket.socket(socket.AF_INET6 if ":" in args.host else socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((args.host, args.port))
+    sock.listen(2048)
+    sock.set_inheritable(True)
+
+    preload()
+    logger.info("Application preloaded, forking {} workers on {}:{}", args.workers, args.host, args.port)
+    Supervisor(lambda: run_worker(sock, args), args).run()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,13 @@
+import asyncio
+import hashlib
 import io
+import threading
 from abc import ABC, abstractmethod
+from collections import OrderedDict
 from dataclasses import dataclass
 from datetime import datetime
+from functools import cached_property
+from typing import Any
 
 from blockz.LLMBlockz import History, RecStrDict
 
@@ -68,6 +74,80 @@ class ImgData:
         self.create_dt: datetime = datetime.now()
         self.img_buffer = img_buffer
 
+    @cached_property
+    def etag(self) -> str:
+        """Strong entity tag of the image: the rendered bytes never change once the image is in the cache."""
+        return '"' + hashlib.sha256(self.img_buffer.getvalue()).hexdigest()[:32] + '"'
+
+
+class TableData:
+    """Columnar snapshot of a query result, kept on the server so that large tables can be paged instead of being sent whole."""
+
+    # sort orders kept per table, the least recently used going first: each holds an index per row
+    max_orders = 8
+
+    def __init__(self, table_id: str, rows: list[dict[str, Any]]):
+        self.table_id: str = table_id
+        self.create_dt: datetime = datetime.now()
+        self.columns: list[str] = list(rows[0].keys()) if rows else []
+        self.values: list[list[Any]] = [[row.get(c) for row in rows] for c in self.columns]
+        self.total_rows: int = len(rows)
+        self._orders: OrderedDict[tuple[str, ...], list[int]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __getstate__(self) -> dict[str, Any]:
+        # the sort orders are cheap to rebuild, the lock cannot be pickled
+        return {k: v for k, v in self.__dict__.items() if k not in ("_orders", "_lock")}
+
+    def __setstate__(self, state: dict[str, Any]) -> None:
+        self.__dict__.update(state)
+        self._orders = OrderedDict()
+        self._lock = threading.Lock()
+
+    def page(self, offset: int, limit: int, sort: list[str] | None = None) -> list[dict[str, Any]]:
+        """Returns rows [offset, offset + limit) of the table ordered by sort, a list of column names, each optionally prefixed by '-'
+        for descending order. Empty values come last; a column repeated in sort counts by its first occurrence only. Raises KeyError for
+        unknown columns.
+        """
+        order = self._order(self._sort_key(sort or []))
+        indices = order[offset : offset + limit] if order is not None else range(offset, min(offset + limit, self.total_rows))
+        return [{c: self.values[j][i] for j, c in enumerate(self.columns)} for i in indices]
+
+    def _sort_key(self, sort: list[str]) -> tuple[str, ...]:
+        """sort without the keys that cannot change the order: those of a column already sorted on."""
+        key: dict[str, str] = {}
+        for column in sort:
+            name = column.removeprefix("-")
+            if name not in self.columns:
+                raise KeyError(name)
+            key.setdefault(name, column)
+        return tuple(key.values())
+
+    def _order(self, sort: tuple[str, ...]) -> list[int] | None:
+        if not sort:
+            return None
+        with self._lock:
+            if sort in self._orders:
+                self._orders.move_to_end(sort)
+                return self._orders[sort]
+        order = list(range(self.total_rows))
+        # stable sorts from the least significant key up
+        for key in reversed(sort):
+            name = key.removeprefix("-")
+            column = self.values[self.columns.index(name)]
+            descending = key.startswith("-")
+            present = [i for i in order if column[i] is not None]
+            try:
+                present.sort(key=column.__getitem__, reverse=descending)
+            except TypeError:  # mixed types in the column
+                present.sort(key=lambda i: str(column[i]), reverse=descending)
+            order = present + [i for i in order if column[i] is None]
+        with self._lock:
+            self._orders[sort] = order
+            while len(self._orders) > self.max_orders:
+                self._orders.popitem(last=False)
+        return order
+
 
 class T2SQLTools(ABC):
     @abstractmethod
@@ -83,6 +163,12 @@ class T2SQLTools(ABC):
         Executes the given SQL and returns the result as a list of dicts (field: value).
         """
 
+    async def adata(self, sql: str) -> list[dict[str, str]]:
+        """
+        Asynchronous counterpart of data(). Runs data() in a worker thread unless overridden.
+        """
+        return await asyncio.to_thread(self.data, sql)
+
     @abstractmethod
     def piechart(self, sql: str, labelfield: str, valuefield: str) -> str:
         """
@@ -100,6 +186,12 @@ class T2SQLTools(ABC):
         Returns a string (e.g., image path or base64).
         """
 
+    async def alinechart(self, sql: str, xfield: str, ylabel: str, name: str, value: str) -> str:
+        """
+        Asynchronous counterpart of linechart(). Runs linechart() in a worker thread unless overridden.
+        """
+        return await asyncio.to_thread(self.linechart, sql, xfield, ylabel, name, value)
+
     @abstractmethod
     def barchart(self, sql: str, xfield: str, ylabel: str, name: str, value: str) -> str:
         """
@@ -122,3 +214,29 @@ class T2SQLTools(ABC):
         Retrieves an image by name.
         Returns the image data as a string (e.g., base64).
         """
+
+    def add_table(self, rows: list[dict[str, Any]]) -> TableData | None:
+        """
+        Keeps a snapshot of a query result on the server so that it can be paged later.
+        Returns None if the tools do not keep tables, which is the default.
+        """
+        return None
+
+    def get_table(self, table_id: str) -> TableData | None:
+        """
+        Retrieves a table snapshot by id.
+        """
+        return None
+
+    def add_query(self, sql: str) -> str | None:
+        """
+        Keeps the (validated) SQL behind a table on the server so that its full result can be exported later.
+        Returns the handle of the query, or None if the tools do not keep queries, which is the default.
+        """
+        return None
+
+    def get_query(self, handle: str) -> str | None:
+        """
+        Retrieves the SQL kept under handle.
+        """
+        return None
@@ -5,6 +5,9 @@ export async function askQuestionStream(question: string, history: Message[], sh
 > {
   const headers = new Headers({ "Cache-Control": "no-cache" });
     headers.set("Content-Type", "application/json");
+    // the server shares its capacity fairly between the users, keyed by their code
+    const userCode = userCodeFromLocalStore();
+    if (userCode) headers.set("X-User-Code", userCode);
     const response = await fetch("/api/chat_rq_stream", {
         method: "POST",
         headers,
@@ -16,6 +19,11 @@ export async function askQuestionStream(question: string, history: Message[], sh
   return response.body?.getReader();
 }
 
+function userCodeFromLocalStore(): string | undefined {
+  const userJson = localStorage.getItem("user_data");
+  return userJson ? JSON.parse(userJson).code : undefined;
+}
+
 export interface AuthResponse {
   code: string;
   name: string;